@@ -0,0 +1,549 @@
+from models import eclipses, routeconfig, config, arrival_history, trip_times, gtfs
+import argparse
+import io
+import json
+import math
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+# Benchmarks for performance-sensitive parts of the backend, using synthetic data
+# so that they can be run without downloading any GPS observations or GTFS feeds.
+#
+# Usage:
+#   python benchmark.py resample --vehicles 80 --hours 24
+#   python benchmark.py arrivals --stops 70 --vehicles 80 --hours 24
+#   python benchmark.py arrival-history --days 28
+#   python benchmark.py trip-times --stops 60 --vehicles 20
+#   python benchmark.py timetables --routes 50 --trips 100000
+#   python benchmark.py stop-sequences --stops 60 --reversals 200
+
+def make_synthetic_route_config(agency_id, route_id='SYN', num_stops=60, seed=0) -> routeconfig.RouteConfig:
+    # creates a route with two directions along a winding path with stops every 150-400 meters
+    rng = np.random.RandomState(seed)
+
+    lat, lon = 37.75, -122.45
+    heading = 0.0
+    lats = []
+    lons = []
+    for i in range(num_stops):
+        lats.append(lat)
+        lons.append(lon)
+        heading += rng.uniform(-0.5, 0.5)
+        step = rng.uniform(150, 400)
+        lat += step * math.cos(heading) / 111000
+        lon += step * math.sin(heading) / (111000 * math.cos(math.radians(lat)))
+
+    stops = {}
+    outbound_stop_ids = []
+    inbound_stop_ids = []
+    for i in range(num_stops):
+        outbound_stop_id = f'{route_id}_O{i}'
+        inbound_stop_id = f'{route_id}_I{i}'
+        stops[outbound_stop_id] = {'id': outbound_stop_id, 'title': outbound_stop_id, 'lat': lats[i], 'lon': lons[i]}
+        stops[inbound_stop_id] = {'id': inbound_stop_id, 'title': inbound_stop_id, 'lat': lats[i] + 0.0002, 'lon': lons[i] + 0.0002}
+        outbound_stop_ids.append(outbound_stop_id)
+        inbound_stop_ids.insert(0, inbound_stop_id)
+
+    def make_direction(direction_id, stop_ids):
+        return {
+            'id': direction_id,
+            'title': direction_id,
+            'gtfs_direction_id': direction_id,
+            'gtfs_shape_id': direction_id,
+            'stops': stop_ids,
+            'stop_geometry': {},
+        }
+
+    return routeconfig.RouteConfig(agency_id, {
+        'id': route_id,
+        'title': route_id,
+        'url': '',
+        'type': 3,
+        'sort_order': 0,
+        'gtfs_route_id': route_id,
+        'directions': [
+            make_direction('0', outbound_stop_ids),
+            make_direction('1', inbound_stop_ids),
+        ],
+        'stops': stops,
+    })
+
+def make_synthetic_route_state(route_config: routeconfig.RouteConfig, num_vehicles=80, hours=24, seed=0, start_time=1570000000) -> pd.DataFrame:
+    # creates a data frame of GPS observations (VID, DID, LAT, LON, TIME) for vehicles
+    # traveling back and forth along the route, with GPS noise, repeated observations,
+    # missing observations, and occasional long gaps
+    rng = np.random.RandomState(seed)
+
+    end_time = start_time + hours * 3600
+
+    dir_infos = route_config.get_direction_infos()
+    dir_paths = []
+    for dir_info in dir_infos:
+        stop_infos = [route_config.get_stop_info(stop_id) for stop_id in dir_info.get_stop_ids()]
+        lat_values = np.array([stop_info.lat for stop_info in stop_infos])
+        lon_values = np.array([stop_info.lon for stop_info in stop_infos])
+        path_index = np.arange(0, len(stop_infos) - 1, 0.2)
+        stop_index = np.arange(len(stop_infos))
+        dir_paths.append((
+            np.interp(path_index, stop_index, lat_values),
+            np.interp(path_index, stop_index, lon_values)
+        ))
+
+    vid_values = []
+    did_values = []
+    lat_values = []
+    lon_values = []
+    time_values = []
+
+    for vehicle_index in range(num_vehicles):
+        vid = str(1000 + vehicle_index)
+        t = start_time + rng.randint(0, 3600)
+        dir_index = vehicle_index % len(dir_infos)
+
+        while t < end_time:
+            path_lat_values, path_lon_values = dir_paths[dir_index]
+            num_path_points = len(path_lat_values)
+            path_pos = 0.0
+
+            while path_pos < num_path_points and t < end_time:
+                i = int(path_pos)
+                vid_values.append(vid)
+                did_values.append(dir_infos[dir_index].id)
+                lat_values.append(path_lat_values[i] + rng.normal(0, 0.00005))
+                lon_values.append(path_lon_values[i] + rng.normal(0, 0.00005))
+                time_values.append(t)
+
+                r = rng.rand()
+                if r < 0.002:
+                    t += rng.randint(1800, 3600)
+                elif r < 0.15:
+                    # position not updated since last observation
+                    t += 15
+                else:
+                    t += 15
+                    path_pos += rng.uniform(0, 2.5)
+
+            t += rng.randint(120, 900)
+            dir_index = (dir_index + 1) % len(dir_infos)
+
+    route_state = pd.DataFrame({
+        'VID': vid_values,
+        'DID': did_values,
+        'LAT': lat_values,
+        'LON': lon_values,
+        'TIME': np.array(time_values, dtype=np.int64),
+    })
+
+    return route_state.sort_values('TIME', kind='mergesort').reset_index(drop=True)
+
+def make_synthetic_arrivals(route_config: routeconfig.RouteConfig, num_vehicles=80, hours=24, seed=0, start_time=1570000000) -> pd.DataFrame:
+    # creates a data frame of arrivals (in the same format as eclipses.find_arrivals) for vehicles
+    # traveling back and forth along the route, taking 1-3 minutes between stops
+    rng = np.random.RandomState(seed)
+
+    end_time = start_time + hours * 3600
+
+    dir_infos = route_config.get_direction_infos()
+
+    arrivals_dfs = []
+    trip = 0
+
+    for vehicle_index in range(num_vehicles):
+        vid = str(1000 + vehicle_index)
+        t = start_time + rng.randint(0, 3600)
+        dir_index = vehicle_index % len(dir_infos)
+
+        while t < end_time:
+            dir_info = dir_infos[dir_index]
+            stop_ids = dir_info.get_stop_ids()
+            num_stops = len(stop_ids)
+
+            time_values = t + np.cumsum(rng.randint(60, 180, num_stops))
+            arrivals_dfs.append(pd.DataFrame({
+                'VID': vid,
+                'TIME': time_values,
+                'DEPARTURE_TIME': time_values + rng.randint(0, 30, num_stops),
+                'DIST': rng.uniform(0, 50, num_stops),
+                'SID': stop_ids,
+                'DID': dir_info.id,
+                'TRIP': trip,
+            }))
+
+            trip += 1
+            t = time_values[-1] + rng.randint(120, 900)
+            dir_index = (dir_index + 1) % len(dir_infos)
+
+    return pd.concat(arrivals_dfs, ignore_index=True)
+
+def make_reversing_dir_arrivals(route_config: routeconfig.RouteConfig, num_reversals=200, seed=0) -> pd.DataFrame:
+    # creates possible arrivals for one vehicle in the first direction of the route (sorted by arrival time, as in clean_arrivals),
+    # for a pathological vehicle that keeps reversing direction partway along the route, with noisy GPS observations
+    # where nearby stops are passed out of order, skipped, or seen more than once
+    rng = np.random.RandomState(seed)
+
+    dir_info = route_config.get_direction_infos()[0]
+    stop_ids = dir_info.get_stop_ids()
+    num_stops = len(stop_ids)
+
+    stop_index_arrays = []
+    stop_index = 0
+    for i in range(num_reversals):
+        next_stop_index = rng.randint(num_stops)
+        step = 1 if next_stop_index >= stop_index else -1
+        stop_indexes = np.arange(stop_index, next_stop_index + step, step)
+        stop_index = next_stop_index
+
+        num_sweep_stops = len(stop_indexes)
+        stop_indexes = stop_indexes[np.argsort(np.arange(num_sweep_stops) + rng.uniform(-2.5, 2.5, num_sweep_stops), kind='mergesort')]
+        stop_indexes = stop_indexes[rng.rand(num_sweep_stops) > 0.1]
+        stop_indexes = np.repeat(stop_indexes, np.where(rng.rand(len(stop_indexes)) < 0.1, 2, 1))
+        stop_index_arrays.append(stop_indexes)
+
+    stop_index_values = np.concatenate(stop_index_arrays)
+    num_arrivals = len(stop_index_values)
+
+    time_values = 1570000000 + np.cumsum(rng.randint(20, 90, num_arrivals))
+    departure_time_values = time_values + np.where(rng.rand(num_arrivals) < 0.2, rng.randint(0, 15, num_arrivals), 0)
+
+    return pd.DataFrame({
+        'VID': np.full(num_arrivals, 'V1', dtype=object),
+        'TIME': time_values,
+        'DEPARTURE_TIME': departure_time_values,
+        'DIST': rng.uniform(0, 100, num_arrivals),
+        'SID': np.array(stop_ids, dtype=object)[stop_index_values],
+        'DID': np.full(num_arrivals, dir_info.id, dtype=object),
+        'STOP_INDEX': stop_index_values,
+        'OBS_GROUP': np.ones(num_arrivals, dtype=np.int64),
+        'TRIP': np.full(num_arrivals, -1, dtype=np.int64),
+    }, columns=eclipses.ArrivalsColumns)
+
+def make_synthetic_gtfs_feed(route_configs: list, num_trips=100000, seed=0, start_date=date(2019, 10, 1), days=90) -> SimpleNamespace:
+    # creates an object with the same data frames as a partridge GTFS feed for the given routes,
+    # with weekday/saturday/sunday services, an extra service on some weekdays, and trips that
+    # start or end partway along the route. trips are listed in random order, like many real feeds.
+    rng = np.random.RandomState(seed)
+
+    end_date = start_date + timedelta(days=days)
+
+    calendar_df = pd.DataFrame({
+        'service_id': ['WKDY', 'SAT', 'SUN', 'EXTRA'],
+        'monday': [1, 0, 0, 1],
+        'tuesday': [1, 0, 0, 0],
+        'wednesday': [1, 0, 0, 1],
+        'thursday': [1, 0, 0, 0],
+        'friday': [1, 0, 0, 1],
+        'saturday': [0, 1, 0, 0],
+        'sunday': [0, 0, 1, 0],
+        'start_date': [start_date] * 4,
+        'end_date': [end_date] * 4,
+    })
+
+    # a holiday with sunday service
+    holiday = start_date + timedelta(days=(7 - start_date.weekday()) % 7 + 7)
+    calendar_dates_df = pd.DataFrame({
+        'service_id': ['WKDY', 'EXTRA', 'SUN'],
+        'date': [holiday, holiday, holiday],
+        'exception_type': [2, 2, 1],
+    })
+
+    service_ids = calendar_df['service_id'].values
+
+    trip_rows = []
+    stop_time_trip_ids = []
+    stop_time_arrival_times = []
+    stop_time_departure_times = []
+    stop_time_stop_ids = []
+    stop_time_sequences = []
+
+    for trip_index in rng.permutation(num_trips):
+        route_config = route_configs[trip_index % len(route_configs)]
+        dir_infos = route_config.get_direction_infos()
+        dir_info = dir_infos[rng.randint(len(dir_infos))]
+        stop_ids = dir_info.get_stop_ids()
+
+        # most trips serve the entire route, but some start late or end early
+        first_stop_index = 0 if rng.rand() < 0.8 else rng.randint(len(stop_ids) // 2)
+        last_stop_index = len(stop_ids) if rng.rand() < 0.8 else rng.randint(len(stop_ids) // 2 + 1, len(stop_ids) + 1)
+        trip_stop_ids = stop_ids[first_stop_index:last_stop_index]
+        num_trip_stops = len(trip_stop_ids)
+
+        trip_id = f'T{trip_index}'
+        trip_rows.append((route_config.gtfs_route_id, service_ids[rng.randint(len(service_ids))], trip_id, dir_info.gtfs_direction_id))
+
+        # times are rounded to the minute so that some trips arrive at the same stop at the same time
+        arrival_times = 60 * rng.randint(4 * 60, 26 * 60) + np.cumsum(60 * rng.randint(1, 4, num_trip_stops))
+        dwell_times = np.where(rng.rand(num_trip_stops) < 0.1, 60, 0)
+
+        stop_time_trip_ids.append(np.full(num_trip_stops, trip_id, dtype=object))
+        stop_time_arrival_times.append(arrival_times)
+        stop_time_departure_times.append(arrival_times + dwell_times)
+        stop_time_stop_ids.append(np.array(trip_stop_ids, dtype=object))
+        stop_time_sequences.append(np.arange(num_trip_stops) + 1)
+
+    trips_df = pd.DataFrame(trip_rows, columns=['route_id', 'service_id', 'trip_id', 'direction_id'])
+
+    stop_times_df = pd.DataFrame({
+        'trip_id': np.concatenate(stop_time_trip_ids),
+        'arrival_time': np.concatenate(stop_time_arrival_times).astype(float),
+        'departure_time': np.concatenate(stop_time_departure_times).astype(float),
+        'stop_id': np.concatenate(stop_time_stop_ids),
+        'stop_sequence': np.concatenate(stop_time_sequences),
+    })
+
+    stop_ids = sorted(set(stop_id for route_config in route_configs for stop_id in route_config.get_stop_ids()))
+
+    return SimpleNamespace(
+        trips=trips_df,
+        stop_times=stop_times_df,
+        stops=pd.DataFrame({'stop_id': stop_ids}),
+        calendar=calendar_df,
+        calendar_dates=calendar_dates_df,
+    )
+
+def time_function(func, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        times.append(time.time() - t0)
+    return min(times), result
+
+def benchmark_resample(args):
+    agency = config.get_agency(args.agency)
+    route_config = make_synthetic_route_config(agency.id)
+    route_state = make_synthetic_route_state(route_config, num_vehicles=args.vehicles, hours=args.hours)
+
+    print(f'{len(route_state)} GPS observations for {args.vehicles} vehicles over {args.hours} hours')
+
+    elapsed, buses = time_function(lambda: eclipses.resample_buses(route_state), args.repeat)
+
+    print(f'resample_buses: {len(buses)} resampled rows in {round(elapsed, 3)} sec')
+
+def benchmark_arrivals(args):
+    agency = config.get_agency(args.agency)
+    route_config = make_synthetic_route_config(agency.id, num_stops=args.stops)
+    route_state = make_synthetic_route_state(route_config, num_vehicles=args.vehicles, hours=args.hours)
+
+    print(f'{len(route_state)} GPS observations for {args.vehicles} vehicles over {args.hours} hours, {args.stops} stops per direction')
+
+    def find_arrivals():
+        with redirect_stdout(io.StringIO()):
+            return eclipses.find_arrivals(agency, route_state, route_config, date(2019, 10, 2))
+
+    elapsed, arrivals = time_function(find_arrivals, args.repeat)
+
+    print(f'find_arrivals: {len(arrivals)} arrivals in {round(elapsed, 3)} sec')
+    print(f'peak RSS: {round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)} MB')
+
+def benchmark_arrival_history(args):
+    agency = config.get_agency(args.agency)
+    route_config = make_synthetic_route_config(agency.id)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_paths = []
+        columnar_paths = []
+
+        num_arrivals = 0
+
+        for day in range(args.days):
+            start_time = 1570000000 + day * 86400
+            arrivals_df = make_synthetic_arrivals(route_config, num_vehicles=args.vehicles, seed=day, start_time=start_time)
+            num_arrivals += len(arrivals_df)
+
+            history = arrival_history.from_data_frame(agency.id, route_config.id, arrivals_df, start_time, start_time + 86400)
+
+            json_path = os.path.join(temp_dir, f'{day}.json')
+            with open(json_path, 'w') as f:
+                f.write(json.dumps(history.get_data()))
+            json_paths.append(json_path)
+
+            columnar_path = os.path.join(temp_dir, f'{day}.npz')
+            arrival_history.save_columnar(arrival_history.ArrivalHistory.from_data(history.get_data()), columnar_path)
+            columnar_paths.append(columnar_path)
+
+        print(f'{num_arrivals} arrivals over {args.days} days')
+        print(f'json: {round(sum(os.path.getsize(path) for path in json_paths) / 1e6, 1)} MB')
+        print(f'npz: {round(sum(os.path.getsize(path) for path in columnar_paths) / 1e6, 1)} MB')
+
+        def load_json():
+            for json_path in json_paths:
+                with open(json_path, 'r') as f:
+                    arrival_history.ArrivalHistory.from_data(json.loads(f.read())).get_data_frame()
+
+        def load_columnar():
+            for columnar_path in columnar_paths:
+                arrival_history.load_columnar(columnar_path).get_data_frame()
+
+        elapsed, _ = time_function(load_json, args.repeat)
+        print(f'load json + get_data_frame: {round(elapsed, 3)} sec')
+
+        elapsed, _ = time_function(load_columnar, args.repeat)
+        print(f'load npz + get_data_frame: {round(elapsed, 3)} sec')
+
+def benchmark_trip_times(args):
+    # finds trip times between all pairs of stops on a loop route (as in compute_stats.add_trip_time_stats_for_route),
+    # where each trip ID visits each stop several times
+    rng = np.random.RandomState(0)
+
+    start_time = 1570000000
+    end_time = start_time + args.hours * 3600
+
+    time_values_by_stop = [[] for i in range(args.stops)]
+    trip_values_by_stop = [[] for i in range(args.stops)]
+
+    for vehicle_index in range(args.vehicles):
+        t = start_time + rng.randint(0, 3600)
+        trip = vehicle_index * 1000
+        while t < end_time:
+            for lap in range(args.laps):
+                for stop_index in range(args.stops):
+                    t += rng.randint(60, 180)
+                    time_values_by_stop[stop_index].append(t)
+                    trip_values_by_stop[stop_index].append(trip)
+            trip += 1
+            t += rng.randint(120, 900)
+
+    sorted_stop_values = [
+        trip_times.sort_parallel(np.array(time_values), np.array(trip_values))
+        for time_values, trip_values in zip(time_values_by_stop, trip_values_by_stop)
+    ]
+
+    print(f'{sum(len(time_values) for time_values in time_values_by_stop)} arrivals for {args.vehicles} vehicles over {args.hours} hours, '
+        f'{args.stops} stops, {args.laps} laps per trip')
+
+    def find_loop_indexes(s1_trip_values, s1_time_values, s2_trip_values, s2_time_values):
+        s1_indexes = np.empty(len(s1_trip_values), dtype=np.int64)
+        s2_indexes = np.empty(len(s1_trip_values), dtype=np.int64)
+        num_indexes = trip_times.find_indexes_of_next_arrival_times_loop(
+            s1_trip_values, s1_time_values, s2_trip_values, s2_time_values, s1_indexes, s2_indexes
+        )
+        return s1_indexes[:num_indexes], s2_indexes[:num_indexes]
+
+    def find_all_pairs(find_indexes):
+        def find():
+            num_trips = 0
+            for s1_time_values, s1_trip_values in sorted_stop_values:
+                for s2_time_values, s2_trip_values in sorted_stop_values:
+                    s1_indexes, s2_indexes = find_indexes(s1_trip_values, s1_time_values, s2_trip_values, s2_time_values)
+                    num_trips += len(s1_indexes)
+            return num_trips
+        return find
+
+    implementations = [('loop', find_loop_indexes), ('numpy', trip_times.find_indexes_of_next_arrival_times_numpy)]
+    if trip_times.find_indexes_of_next_arrival_times_jit is not None:
+        # compile the numba version before timing it
+        time_values, trip_values = sorted_stop_values[0]
+        trip_times.find_indexes_of_next_arrival_times(trip_values, time_values, trip_values, time_values)
+        implementations.append(('numba', trip_times.find_indexes_of_next_arrival_times))
+
+    for name, find_indexes in implementations:
+        elapsed, num_trips = time_function(find_all_pairs(find_indexes), args.repeat)
+        print(f'find_indexes_of_next_arrival_times ({name}): {num_trips} trips for {args.stops * args.stops} stop pairs in {round(elapsed, 3)} sec')
+
+def benchmark_timetables(args):
+    # parses scheduled arrivals for all routes and unique sets of service IDs
+    # (as in gtfs.GtfsScraper.save_timetables, without saving them)
+    agency = config.get_agency(args.agency)
+    route_configs = [make_synthetic_route_config(agency.id, route_id=f'R{i}', num_stops=args.stops, seed=i) for i in range(args.routes)]
+    feed = make_synthetic_gtfs_feed(route_configs, num_trips=args.trips)
+
+    print(f'{len(feed.trips)} trips, {len(feed.stop_times)} stop times, {args.routes} routes')
+
+    with redirect_stdout(io.StringIO()):
+        scraper = gtfs.GtfsScraper(agency, feed=feed)
+
+        first_date_for_service_ids_map = {}
+        for d, service_ids in sorted(scraper.get_services_by_date().items()):
+            first_date_for_service_ids_map.setdefault(json.dumps(sorted(service_ids)), d)
+
+    def get_timetables():
+        with redirect_stdout(io.StringIO()):
+            return sum(
+                len(json.dumps(arrivals, separators=(',', ':')))
+                for route_config, date_key, service_ids, arrivals in scraper.get_timetables(route_configs, first_date_for_service_ids_map)
+            )
+
+    elapsed, num_bytes = time_function(get_timetables, args.repeat)
+    print(f'get_timetables: {len(first_date_for_service_ids_map)} date keys, {num_bytes} bytes of JSON in {round(elapsed, 3)} sec')
+
+def benchmark_stop_sequences(args):
+    agency = config.get_agency(args.agency)
+    route_config = make_synthetic_route_config(agency.id, num_stops=args.stops)
+    dir_info = route_config.get_direction_infos()[0]
+    if args.loop:
+        # on loop routes, a trip can continue around the loop any number of times,
+        # so the possible sequences can become much longer than the number of stops
+        dir_info.data['loop'] = True
+
+    dir_arrivals = make_reversing_dir_arrivals(route_config, num_reversals=args.reversals)
+
+    print(f'{len(dir_arrivals)} possible arrivals for a vehicle that reverses direction {args.reversals} times, {args.stops} stops{" in a loop" if args.loop else " per direction"}')
+
+    def get_arrivals_with_ascending_stop_index():
+        return eclipses.get_arrivals_with_ascending_stop_index(dir_arrivals, dir_info, 0)
+
+    elapsed, (arrivals, next_trip) = time_function(get_arrivals_with_ascending_stop_index, args.repeat)
+
+    print(f'get_arrivals_with_ascending_stop_index: {len(arrivals)} arrivals in {next_trip} trips in {round(elapsed, 3)} sec')
+
+    tracemalloc.start()
+    get_arrivals_with_ascending_stop_index()
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'peak traced memory: {round(peak_bytes / 1e6, 1)} MB')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark backend computations using synthetic data')
+    parser.add_argument('--agency', default='test', help='Agency ID')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each benchmark (reports the fastest)')
+
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    resample_parser = subparsers.add_parser('resample', help='eclipses.resample_buses')
+    resample_parser.add_argument('--vehicles', type=int, default=80)
+    resample_parser.add_argument('--hours', type=int, default=24)
+    resample_parser.set_defaults(func=benchmark_resample)
+
+    arrivals_parser = subparsers.add_parser('arrivals', help='eclipses.find_arrivals')
+    arrivals_parser.add_argument('--stops', type=int, default=70, help='Number of stops in each direction')
+    arrivals_parser.add_argument('--vehicles', type=int, default=80)
+    arrivals_parser.add_argument('--hours', type=int, default=24)
+    arrivals_parser.set_defaults(func=benchmark_arrivals)
+
+    arrival_history_parser = subparsers.add_parser('arrival-history', help='loading arrival histories in JSON and columnar formats')
+    arrival_history_parser.add_argument('--days', type=int, default=28)
+    arrival_history_parser.add_argument('--vehicles', type=int, default=80)
+    arrival_history_parser.set_defaults(func=benchmark_arrival_history)
+
+    trip_times_parser = subparsers.add_parser('trip-times', help='trip_times.find_indexes_of_next_arrival_times on a loop route')
+    trip_times_parser.add_argument('--stops', type=int, default=60, help='Number of stops in the loop')
+    trip_times_parser.add_argument('--vehicles', type=int, default=20)
+    trip_times_parser.add_argument('--hours', type=int, default=24)
+    trip_times_parser.add_argument('--laps', type=int, default=2, help='Number of times each trip goes around the loop')
+    trip_times_parser.set_defaults(func=benchmark_trip_times)
+
+    timetables_parser = subparsers.add_parser('timetables', help='gtfs.GtfsScraper.get_timetables')
+    timetables_parser.add_argument('--routes', type=int, default=50)
+    timetables_parser.add_argument('--stops', type=int, default=40, help='Number of stops in each direction')
+    timetables_parser.add_argument('--trips', type=int, default=100000)
+    timetables_parser.set_defaults(func=benchmark_timetables)
+
+    stop_sequences_parser = subparsers.add_parser('stop-sequences', help='eclipses.get_arrivals_with_ascending_stop_index for a vehicle that keeps reversing direction')
+    stop_sequences_parser.add_argument('--stops', type=int, default=60, help='Number of stops in each direction')
+    stop_sequences_parser.add_argument('--reversals', type=int, default=200)
+    stop_sequences_parser.add_argument('--loop', dest='loop', action='store_true', help='treat the direction as a loop')
+    stop_sequences_parser.set_defaults(loop=False)
+    stop_sequences_parser.set_defaults(func=benchmark_stop_sequences)
+
+    args = parser.parse_args()
+    args.func(args)
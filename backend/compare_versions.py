@@ -80,14 +80,11 @@ if __name__ == '__main__':
             base_trips += len(np.unique(base_df['TRIP']))
             other_trips += len(np.unique(other_df['TRIP']))
 
-            def find_other_arrival_time(row):
-                other_time = other_history.find_closest_arrival_time(row.SID, row.VID, row.TIME)
-                if other_time is not None and abs(row.TIME - other_time) > max_difference:
-                    return None
-                return other_time
+            other_times = other_history.find_closest_arrival_times(base_df['SID'].values, base_df['VID'].values, base_df['TIME'].values)
+            other_times[np.abs(base_df['TIME'].values - other_times) > max_difference] = np.nan
 
             base_df['ROUTE'] = route_id
-            base_df['other_time'] = base_df.apply(find_other_arrival_time, axis=1)
+            base_df['other_time'] = other_times
             base_df['time_diff_min'] = (base_df.TIME - base_df.other_time)/60
             base_df['abs_time_diff_min'] = np.abs(base_df.time_diff_min)
 
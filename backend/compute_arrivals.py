@@ -1,11 +1,64 @@
-from models import arrival_history, util, trynapi, eclipses, config
+from models import arrival_history, util, trynapi, eclipses, config, incremental_arrivals
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date, timedelta
 import time
+import traceback
+
+def compute_arrivals_for_route(d: date, agency_id: str, route_id: str,
+                state: trynapi.CachedState, start_time, end_time,
+                save_to_s3=True, incremental_end_time=None):
+    # If incremental_end_time is not None, `state` only contains GPS observations since the incremental state
+    # for this route was last saved (or since start_time if it was not saved), until incremental_end_time.
+
+    t1 = time.time()
+
+    route_state = state.get_for_route(route_id)
+
+    if route_state is None:
+        print(f'no state for route {route_id}')
+        return
+
+    agency = config.get_agency(agency_id)
+    route_config = agency.get_route_config(route_id)
+
+    if incremental_end_time is not None:
+        prev_state = incremental_arrivals.get_state(agency.id, route_id, d, start_time)
+        if prev_state is None:
+            prev_state = incremental_arrivals.RouteState(start_time, start_time)
+
+        print(f'{route_id}: updating arrivals with {len(route_state)} GPS observations since {prev_state.end_time}, {len(prev_state.buses)} previous GPS observations')
+
+        arrivals_df, new_state = incremental_arrivals.update_arrivals(agency, route_config, d, prev_state, route_state, incremental_end_time)
+
+        incremental_arrivals.save_state(agency.id, route_id, d, new_state)
+    else:
+        arrivals_df = eclipses.find_arrivals(agency, route_state, route_config, d)
+
+    history = arrival_history.from_data_frame(agency.id, route_id, arrivals_df, start_time, end_time)
+
+    print(f'{route_id}: {round(time.time()-t1,1)} saving arrival history')
+
+    arrival_history.save_for_date(history, d, save_to_s3)
+
+    print(f'{route_id}: {round(time.time()-t1,2)} done')
+
+def compute_arrivals_for_route_in_worker(args: tuple) -> tuple:
+    # runs in a separate process when using --jobs
+    # if computing arrivals fails, returns the exception along with the output printed before it failed
+    # (including the traceback), so that the parent process can print the output before raising the exception
+    t1 = time.time()
+
+    try:
+        output, _ = util.call_with_captured_output(compute_arrivals_for_route, *args)
+    except Exception as ex:
+        return ex.output + traceback.format_exc(), time.time() - t1, ex
+
+    return output, time.time() - t1, None
 
 def compute_arrivals_for_date_and_start_hour(d: date, start_hour: int,
                 agency: config.Agency, route_ids: list,
-                save_to_s3=True):
+                save_to_s3=True, jobs=1, incremental=False):
 
     tz = agency.tz
 
@@ -19,32 +72,64 @@ def compute_arrivals_for_date_and_start_hour(d: date, start_hour: int,
 
     t1 = time.time()
 
-    state = trynapi.get_state(agency.id, d, start_time, end_time, route_ids)
+    if incremental:
+        # only fetch GPS observations since the last time the incremental state was saved for each route.
+        # recent GPS observations may not be available from tryn-api yet, so they are left for the next update.
+        incremental_end_time = min(end_time, int(time.time()) - incremental_arrivals.MinObservationAgeSeconds)
+
+        route_ids_by_window_start_time = {}
+        for route_id in route_ids:
+            prev_state_data = incremental_arrivals.get_state_data(agency.id, route_id, d, start_time)
+            window_start_time = prev_state_data['end_time'] if prev_state_data is not None else start_time
+            if window_start_time < incremental_end_time:
+                route_ids_by_window_start_time.setdefault(window_start_time, []).append(route_id)
+            else:
+                print(f'{route_id}: no new GPS observations since {window_start_time}')
+
+        route_ids = [route_id for window_route_ids in route_ids_by_window_start_time.values() for route_id in window_route_ids]
+
+        states = {}
+        for window_start_time, window_route_ids in route_ids_by_window_start_time.items():
+            state = trynapi.get_state(agency.id, d, window_start_time, incremental_end_time, window_route_ids)
+            for route_id in window_route_ids:
+                states[route_id] = state
+    else:
+        incremental_end_time = None
+        state = trynapi.get_state(agency.id, d, start_time, end_time, route_ids)
+        states = {route_id: state for route_id in route_ids}
 
     print(f'retrieved state in {round(time.time()-t1,1)} sec')
 
-    for i, route_id in enumerate(route_ids):
-        route_state = state.get_for_route(route_id)
+    t2 = time.time()
 
-        if route_state is None:
-            print(f'no state for route {route_id}')
-            continue
+    route_times = {}
 
-        route_config = agency.get_route_config(route_id)
+    if jobs > 1:
+        # each worker process reads the cached state for its own route from the local file system
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(compute_arrivals_for_route_in_worker, [
+                (d, agency.id, route_id, states[route_id], start_time, end_time, save_to_s3, incremental_end_time)
+                for route_id in route_ids
+            ])
 
-        t1 = time.time()
-
-        arrivals_df = eclipses.find_arrivals(agency, route_state, route_config, d)
-
-        history = arrival_history.from_data_frame(agency.id, route_id, arrivals_df, start_time, end_time)
-
-        print(f'{route_id}: {round(time.time()-t1,1)} saving arrival history')
-
-        arrival_history.save_for_date(history, d, save_to_s3)
+            for route_id, (output, route_time, ex) in zip(route_ids, results):
+                print(output, end='')
+                if ex is not None:
+                    raise ex
+                route_times[route_id] = route_time
+    else:
+        for route_id in route_ids:
+            t1 = time.time()
+            compute_arrivals_for_route(d, agency.id, route_id, states[route_id], start_time, end_time, save_to_s3, incremental_end_time)
+            route_times[route_id] = time.time() - t1
 
-        print(f'{route_id}: {round(time.time()-t1,2)} done')
+    if len(route_times) > 0:
+        print(f'computed arrivals for {len(route_times)} routes in {round(time.time()-t2,1)} sec')
+        print('slowest routes:')
+        for route_id, route_time in sorted(route_times.items(), key=lambda item: item[1], reverse=True)[:10]:
+            print(f'  {route_id}: {round(route_time,1)} sec')
 
-def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3=True):
+def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3=True, jobs=1, incremental=False):
 
     all_custom_routes = []
     custom_start_hours = []
@@ -58,7 +143,9 @@ def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3
         d, start_hour=agency.default_day_start_hour,
         agency=agency,
         route_ids=[r for r in route_ids if r not in all_custom_routes],
-        save_to_s3=save_to_s3
+        save_to_s3=save_to_s3,
+        jobs=jobs,
+        incremental=incremental
     )
 
     for start_hour, custom_routes in custom_start_hours:
@@ -66,7 +153,9 @@ def compute_arrivals(d: date, agency: config.Agency, route_ids: list, save_to_s3
             d, start_hour=start_hour,
             agency=agency,
             route_ids=custom_routes,
-            save_to_s3=save_to_s3
+            save_to_s3=save_to_s3,
+            jobs=jobs,
+            incremental=incremental
         )
 
 if __name__ == '__main__':
@@ -77,6 +166,7 @@ if __name__ == '__main__':
     parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
     parser.add_argument('--end-date', help='End date (yyyy-mm-dd), inclusive')
     parser.add_argument('--s3', dest='s3', action='store_true', help='store in s3')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of routes to compute in parallel processes')
     parser.set_defaults(s3=False)
 
     args = parser.parse_args()
@@ -102,4 +192,4 @@ if __name__ == '__main__':
             route_ids = [route.id for route in agency.get_route_list()]
 
         for d in dates:
-            compute_arrivals(d, agency, route_ids, args.s3)
+            compute_arrivals(d, agency, route_ids, args.s3, jobs=args.jobs)
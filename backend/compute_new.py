@@ -4,7 +4,7 @@ import requests
 from datetime import datetime, timedelta
 import boto3
 
-from models import config, util
+from models import config, util, incremental_arrivals
 
 from compute_arrivals import compute_arrivals
 from compute_stats import compute_stats
@@ -13,6 +13,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = '')
     parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
     parser.add_argument('--agency', required=False, help='Agency ID')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of routes to compute in parallel processes')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='only process GPS observations since the last run for the current day')
+    parser.set_defaults(incremental=False)
 
     args = parser.parse_args()
 
@@ -69,10 +72,14 @@ if __name__ == '__main__':
             compute_start_time = datetime.now(tz)
 
             print(f'computing arrivals for {d}')
-            compute_arrivals(d, agency, route_ids)
+            # arrivals are always computed for the entire day once the day is complete
+            compute_arrivals(d, agency, route_ids, jobs=args.jobs, incremental=(args.incremental and d == today))
+
+            if d < today:
+                incremental_arrivals.remove_states(agency.id, d)
 
             print(f'computing stats for {d}')
-            compute_stats(d, agency, routes)
+            compute_stats(d, agency, routes, jobs=args.jobs, incremental=True)
 
             date_str = str(d)
 
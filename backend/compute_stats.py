@@ -1,12 +1,21 @@
-from models import arrival_history, trip_times, constants, config, timetables, wait_times, metrics, precomputed_stats, util, gtfs
+from models import arrival_history, trip_times, constants, config, timetables, wait_times, metrics, precomputed_stats, util, gtfs, cache
 import argparse
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 import collections
 import numpy as np
+import pandas as pd
 import time
 
 StatIds = precomputed_stats.StatIds
 
+# Included in the fingerprint of each route's inputs, so that incremental updates recompute the stats
+# for all routes after a change to how the stats are computed.
+# Increment this when changing the stats computed by compute_stats_for_route or their format.
+StatsComputationVersion = 1
+
 def filter_departures_by_interval(s1_trip_values, s1_departure_time_values, timestamp_intervals):
     #
     # Given parallel arrays of trip IDs and departure times for the entire day, returns parallel
@@ -49,6 +58,8 @@ def add_headway_and_wait_time_stats_for_route(all_stats, timestamp_intervals, ro
 
             all_time_values = stop_df['DEPARTURE_TIME'].values
 
+            median_wait_times = wait_times.get_quantile_for_intervals(all_time_values, timestamp_intervals, 0.5)
+
             for interval_index, (start_time, end_time) in enumerate(timestamp_intervals):
 
                 dir_stats = all_stats[StatIds.Combined][interval_index][route_id]['directions'][dir_id]
@@ -58,9 +69,7 @@ def add_headway_and_wait_time_stats_for_route(all_stats, timestamp_intervals, ro
                 if len(headways) > 0:
                     all_median_headways[interval_index].append(np.median(headways))
 
-                wait_time_stats = wait_times.get_stats(all_time_values, start_time, end_time)
-
-                median_wait_time = wait_time_stats.get_quantile(0.5)
+                median_wait_time = median_wait_times[interval_index]
                 if median_wait_time is not None:
                     all_median_wait_times[interval_index].append(median_wait_time)
                     all_stats[StatIds.MedianTripTimes][interval_index][route_id]['directions'][dir_id]['medianWaitTimes'][stop_id] = round(median_wait_time, 1)
@@ -136,111 +145,214 @@ def add_trip_time_stats_for_route(all_stats, timestamp_intervals, route_config,
 
     route_id = route_config.id
 
-    sid_values = df['SID'].values
-    did_values = df['DID'].values
-
     for dir_info in route_config.get_direction_infos():
         dir_id = dir_info.id
 
-        is_loop = dir_info.is_loop()
-
-        stop_ids = dir_info.get_stop_ids()
-        num_stops = len(stop_ids)
-
-        departure_trip_values_by_stop = {}
-        arrival_trip_values_by_stop = {}
-        departure_time_values_by_stop = {}
-        arrival_time_values_by_stop = {}
-
         for interval_index, _ in enumerate(timestamp_intervals):
             all_stats[StatIds.Combined][interval_index][route_id]['directions'][dir_id]['tripTimes'] = collections.defaultdict(dict)
             all_stats[StatIds.MedianTripTimes][interval_index][route_id]['directions'][dir_id]['medianTripTimes'] = collections.defaultdict(dict)
 
-        for stop_id in stop_ids:
-            stop_df = df[(sid_values == stop_id) & (did_values == dir_id)]
+        if not dir_info.is_loop():
+            trip_time_matrices = get_trip_time_matrices(df, dir_id, dir_info.get_stop_ids())
+            if trip_time_matrices is not None:
+                add_trip_time_stats_for_direction(all_stats, timestamp_intervals, route_id, dir_info, *trip_time_matrices)
+                continue
 
-            trip_values = stop_df['TRIP'].values
-            departure_time_values = stop_df['DEPARTURE_TIME'].values
-            arrival_time_values = stop_df['TIME'].values
+        # for loop routes (or if a trip stops at the same stop more than once), each trip may have multiple
+        # departures/arrivals at a stop, so find the trips between each pair of stops separately.
+        add_trip_time_stats_for_stop_pairs(all_stats, timestamp_intervals, route_id, dir_info, df)
 
-            if is_loop:
-                # for loop routes, pre-sort arrays by departure/arrival times for better performance.
-                sorted_departure_time_values, sorted_departure_trip_values = trip_times.sort_parallel(departure_time_values, trip_values)
-                sorted_arrival_time_values, sorted_arrival_trip_values = trip_times.sort_parallel(arrival_time_values, trip_values)
-            else:
-                # for non-loop routes, arrays are already sorted by trip ID.
-                sorted_departure_trip_values = trip_values
-                sorted_arrival_trip_values = trip_values
-                sorted_departure_time_values = departure_time_values
-                sorted_arrival_time_values = arrival_time_values
+def get_trip_time_matrices(df, dir_id, stop_ids):
+    #
+    # Returns a tuple (departure time matrix, arrival time matrix) for a direction of a route,
+    # with one row for each trip and one column for each stop in stop_ids, with the value np.nan if
+    # the trip did not stop at that stop.
+    #
+    # Returns None if any trip has more than one departure/arrival at the same stop.
+    #
+    dir_df = df[df['DID'].values == dir_id]
 
-            departure_trip_values_by_stop[stop_id] = sorted_departure_trip_values
-            departure_time_values_by_stop[stop_id] = sorted_departure_time_values
-            arrival_trip_values_by_stop[stop_id] = sorted_arrival_trip_values
-            arrival_time_values_by_stop[stop_id] = sorted_arrival_time_values
+    unique_stop_ids = list(dict.fromkeys(stop_ids))
+    num_unique_stops = len(unique_stop_ids)
 
-        i_end_index = num_stops if is_loop else (num_stops - 1)
+    stop_indexes = pd.Index(unique_stop_ids).get_indexer(dir_df['SID'].values)
+    is_stop = stop_indexes != -1
+    stop_indexes = stop_indexes[is_stop]
 
-        start_stop_id, end_stop_id = dir_info.get_endpoint_stop_ids()
+    unique_trip_values, trip_indexes = np.unique(dir_df['TRIP'].values[is_stop], return_inverse=True)
 
-        for i in range(0, i_end_index):
+    if len(np.unique(trip_indexes * num_unique_stops + stop_indexes)) < len(stop_indexes):
+        return None
 
-            s1 = stop_ids[i]
+    departure_time_matrix = np.full((len(unique_trip_values), num_unique_stops), np.nan)
+    departure_time_matrix[trip_indexes, stop_indexes] = dir_df['DEPARTURE_TIME'].values[is_stop]
 
-            s1_trip_values = departure_trip_values_by_stop[s1]
+    arrival_time_matrix = np.full((len(unique_trip_values), num_unique_stops), np.nan)
+    arrival_time_matrix[trip_indexes, stop_indexes] = dir_df['TIME'].values[is_stop]
 
-            if len(s1_trip_values) == 0:
-                continue
+    # stop_ids may contain the same stop more than once
+    column_indexes = [unique_stop_ids.index(stop_id) for stop_id in stop_ids]
 
-            s1_departure_time_values = departure_time_values_by_stop[s1]
+    return departure_time_matrix[:, column_indexes], arrival_time_matrix[:, column_indexes]
 
-            s1_trip_values_by_interval, s1_departure_time_values_by_interval = filter_departures_by_interval(
-                s1_trip_values,
-                s1_departure_time_values,
-                timestamp_intervals
-            )
+def add_trip_time_stats_for_direction(all_stats, timestamp_intervals, route_id, dir_info, departure_time_matrix, arrival_time_matrix):
+    #
+    # Computes trip time stats from each stop to all later stops at once, using the trip time matrices
+    # returned by get_trip_time_matrices.
+    #
+    dir_id = dir_info.id
+    stop_ids = dir_info.get_stop_ids()
+    num_stops = len(stop_ids)
+
+    start_stop_id, end_stop_id = dir_info.get_endpoint_stop_ids()
+
+    for i in range(0, num_stops - 1):
+        s1 = stop_ids[i]
+
+        s1_departure_time_values = departure_time_matrix[:, i]
+
+        # trip times in minutes from s1 to each later stop (one column per stop), or np.nan if a trip
+        # did not stop at both stops
+        trip_min = (arrival_time_matrix[:, i+1:] - s1_departure_time_values[:, np.newaxis]) / 60
+
+        for interval_index, (start_time, end_time) in enumerate(timestamp_intervals):
+            if start_time is None or end_time is None:
+                interval_trip_min = trip_min
+            else:
+                interval_trip_min = trip_min[(s1_departure_time_values >= start_time) & (s1_departure_time_values < end_time)]
 
-            j_start_index = 0 if is_loop else i + 1
+            counts = np.sum(~np.isnan(interval_trip_min), axis=0)
 
-            for j in range(j_start_index, num_stops):
-                s2 = stop_ids[j]
+            if not np.any(counts):
+                continue
 
-                for interval_index, _ in enumerate(timestamp_intervals):
-                    trip_min = trip_times.get_completed_trip_times(
-                        s1_trip_values_by_interval[interval_index],
-                        s1_departure_time_values_by_interval[interval_index],
-                        arrival_trip_values_by_stop[s2],
-                        arrival_time_values_by_stop[s2],
-                        is_loop=is_loop,
-                        assume_sorted=True
+            sorted_trip_min = np.sort(interval_trip_min, axis=0)
+
+            p10_trip_times = np.round(util.quantile_sorted_columns(sorted_trip_min, counts, 0.1), 1).tolist()
+            median_trip_times = np.round(util.quantile_sorted_columns(sorted_trip_min, counts, 0.5), 1).tolist()
+            p90_trip_times = np.round(util.quantile_sorted_columns(sorted_trip_min, counts, 0.9), 1).tolist()
+
+            for column_index, count in enumerate(counts.tolist()):
+                if count > 0:
+                    j = i + 1 + column_index
+                    add_trip_time_stats(
+                        all_stats, interval_index, route_id, dir_id,
+                        stop_ids[i], stop_ids[j],
+                        include_combined_stats=(i <= 2) or (j == (i + 1) % num_stops) or s1 == start_stop_id,
+                        p10_trip_time=p10_trip_times[column_index],
+                        median_trip_time=median_trip_times[column_index],
+                        p90_trip_time=p90_trip_times[column_index],
+                        count=count,
                     )
 
-                    if len(trip_min) > 0:
+def add_trip_time_stats_for_stop_pairs(all_stats, timestamp_intervals, route_id, dir_info, df):
 
-                        sorted_trip_min = np.sort(trip_min)
-                        median_trip_time = round(util.quantile_sorted(sorted_trip_min, 0.5), 1)
+    sid_values = df['SID'].values
+    did_values = df['DID'].values
 
-                        # save all pairs of stops in median-trip-times stat, used for the isochrone map
-                        all_stats[StatIds.MedianTripTimes][interval_index][route_id]['directions'][dir_id]['medianTripTimes'][s1][s2] = median_trip_time
+    dir_id = dir_info.id
 
-                        # only store median trip times for adjacent stops, or from the first three stops in combined stats
-                        # to reduce file size and loading time, since the frontend only needs this for displaying segments
-                        # and cumulative time along a route.
-                        if (i <= 2) or (j == (i + 1) % num_stops) or s1 == start_stop_id:
-                            all_stats[StatIds.Combined][interval_index][route_id]['directions'][dir_id]['tripTimes'][s1][s2] = [
-                                round(util.quantile_sorted(sorted_trip_min, 0.1), 1),
-                                median_trip_time,
-                                round(util.quantile_sorted(sorted_trip_min, 0.9), 1),
-                                len(trip_min)
-                            ]
+    is_loop = dir_info.is_loop()
 
-def compute_stats(d: date, agency: config.Agency, routes, scheduled=False, save_to_s3=True):
+    stop_ids = dir_info.get_stop_ids()
+    num_stops = len(stop_ids)
 
-    tz = agency.tz
-    stat_ids = precomputed_stats.AllStatIds
+    departure_trip_values_by_stop = {}
+    arrival_trip_values_by_stop = {}
+    departure_time_values_by_stop = {}
+    arrival_time_values_by_stop = {}
 
-    print(f"{d} {'(scheduled)' if scheduled else '(observed)'}")
+    for stop_id in stop_ids:
+        stop_df = df[(sid_values == stop_id) & (did_values == dir_id)]
+
+        trip_values = stop_df['TRIP'].values
+        departure_time_values = stop_df['DEPARTURE_TIME'].values
+        arrival_time_values = stop_df['TIME'].values
+
+        if is_loop:
+            # for loop routes, pre-sort arrays by departure/arrival times for better performance.
+            sorted_departure_time_values, sorted_departure_trip_values = trip_times.sort_parallel(departure_time_values, trip_values)
+            sorted_arrival_time_values, sorted_arrival_trip_values = trip_times.sort_parallel(arrival_time_values, trip_values)
+        else:
+            # for non-loop routes, arrays are already sorted by trip ID.
+            sorted_departure_trip_values = trip_values
+            sorted_arrival_trip_values = trip_values
+            sorted_departure_time_values = departure_time_values
+            sorted_arrival_time_values = arrival_time_values
 
+        departure_trip_values_by_stop[stop_id] = sorted_departure_trip_values
+        departure_time_values_by_stop[stop_id] = sorted_departure_time_values
+        arrival_trip_values_by_stop[stop_id] = sorted_arrival_trip_values
+        arrival_time_values_by_stop[stop_id] = sorted_arrival_time_values
+
+    i_end_index = num_stops if is_loop else (num_stops - 1)
+
+    start_stop_id, end_stop_id = dir_info.get_endpoint_stop_ids()
+
+    for i in range(0, i_end_index):
+
+        s1 = stop_ids[i]
+
+        s1_trip_values = departure_trip_values_by_stop[s1]
+
+        if len(s1_trip_values) == 0:
+            continue
+
+        s1_departure_time_values = departure_time_values_by_stop[s1]
+
+        s1_trip_values_by_interval, s1_departure_time_values_by_interval = filter_departures_by_interval(
+            s1_trip_values,
+            s1_departure_time_values,
+            timestamp_intervals
+        )
+
+        j_start_index = 0 if is_loop else i + 1
+
+        for j in range(j_start_index, num_stops):
+            s2 = stop_ids[j]
+
+            for interval_index, _ in enumerate(timestamp_intervals):
+                trip_min = trip_times.get_completed_trip_times(
+                    s1_trip_values_by_interval[interval_index],
+                    s1_departure_time_values_by_interval[interval_index],
+                    arrival_trip_values_by_stop[s2],
+                    arrival_time_values_by_stop[s2],
+                    is_loop=is_loop,
+                    assume_sorted=True
+                )
+
+                if len(trip_min) > 0:
+
+                    sorted_trip_min = np.sort(trip_min)
+
+                    add_trip_time_stats(
+                        all_stats, interval_index, route_id, dir_id, s1, s2,
+                        include_combined_stats=(i <= 2) or (j == (i + 1) % num_stops) or s1 == start_stop_id,
+                        p10_trip_time=round(util.quantile_sorted(sorted_trip_min, 0.1), 1),
+                        median_trip_time=round(util.quantile_sorted(sorted_trip_min, 0.5), 1),
+                        p90_trip_time=round(util.quantile_sorted(sorted_trip_min, 0.9), 1),
+                        count=len(trip_min),
+                    )
+
+def add_trip_time_stats(all_stats, interval_index, route_id, dir_id, s1, s2, include_combined_stats,
+                        p10_trip_time, median_trip_time, p90_trip_time, count):
+
+    # save all pairs of stops in median-trip-times stat, used for the isochrone map
+    all_stats[StatIds.MedianTripTimes][interval_index][route_id]['directions'][dir_id]['medianTripTimes'][s1][s2] = median_trip_time
+
+    # only store median trip times for adjacent stops, or from the first three stops in combined stats
+    # to reduce file size and loading time, since the frontend only needs this for displaying segments
+    # and cumulative time along a route.
+    if include_combined_stats:
+        all_stats[StatIds.Combined][interval_index][route_id]['directions'][dir_id]['tripTimes'][s1][s2] = [
+            p10_trip_time,
+            median_trip_time,
+            p90_trip_time,
+            count
+        ]
+
+def get_intervals(d: date, tz):
+    # Returns a tuple (list of time string intervals, list of timestamp intervals) for the stats computed each day.
     time_str_intervals = constants.DEFAULT_TIME_STR_INTERVALS.copy()
     time_str_intervals.append(('07:00','19:00'))
 
@@ -253,58 +365,190 @@ def compute_stats(d: date, agency: config.Agency, routes, scheduled=False, save_
     timestamp_intervals.append((None, None))
     time_str_intervals.append((None, None))
 
+    return time_str_intervals, timestamp_intervals
+
+def compute_stats_for_route(d: date, agency: config.Agency, route_id, scheduled=False):
+    #
+    # Returns a dict containing the stats for one route, where route_stats[stat_id][interval_index]
+    # contains the stats for that route, or None if there is no arrival history or timetable for the route.
+    #
+    print(route_id)
+
+    t1 = time.time()
+
+    stat_ids = precomputed_stats.AllStatIds
+
+    time_str_intervals, timestamp_intervals = get_intervals(d, agency.tz)
+
+    route_config = agency.get_route_config(route_id)
+
+    if not scheduled:
+        try:
+            history = arrival_history.get_by_date(agency.id, route_id, d)
+        except FileNotFoundError as ex:
+            print(ex)
+            return None
+
+        history_df = history.get_data_frame()
+
+    try:
+        timetable = timetables.get_by_date(agency.id, route_id, d)
+    except (FileNotFoundError, KeyError) as ex:
+        print(ex)
+        return None
+
+    timetable_df = timetable.get_data_frame()
+
+    # use the same nested structure as all_stats in compute_stats, so that the stat functions can be shared
     all_stats = {}
 
     for stat_id in stat_ids:
         all_stats[stat_id] = {}
 
         for interval_index, _ in enumerate(timestamp_intervals):
-            all_stats[stat_id][interval_index] = {}
+            all_stats[stat_id][interval_index] = {route_id: {'directions':{}}}
+
+            for dir_info in route_config.get_direction_infos():
+                dir_id = dir_info.id
+
+                all_stats[stat_id][interval_index][route_id]['directions'][dir_id] = collections.defaultdict(dict)
+
+    base_df = timetable_df if scheduled else history_df
+
+    add_trip_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
+    add_headway_and_wait_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
+
+    if not scheduled:
+        add_schedule_adherence_stats_for_route(all_stats, timestamp_intervals, route_config, history_df, timetable_df)
+
+    t2 = time.time()
+    print(f' {round(t2-t1, 2)} sec')
+
+    return {
+        stat_id: {
+            interval_index: all_stats[stat_id][interval_index][route_id]
+            for interval_index, _ in enumerate(timestamp_intervals)
+        }
+        for stat_id in stat_ids
+    }
+
+def compute_stats_for_route_in_worker(args: tuple) -> tuple:
+    # runs in a separate process when using --jobs
+    d, agency_id, route_id, scheduled = args
+
+    return util.call_with_captured_output(compute_stats_for_route, d, config.get_agency(agency_id), route_id, scheduled)
+
+def get_route_fingerprints(d: date, agency: config.Agency, routes, scheduled=False) -> dict:
+    #
+    # Returns a dict of route ID => fingerprint of the inputs used to compute stats for that route,
+    # which is a hash of StatsComputationVersion, the route configuration, and the contents of the locally cached
+    # arrival history and timetable files. The fingerprint is None if the input files are not cached locally
+    # (or would be refreshed from S3 by arrival_history.get_by_date).
+    #
+    try:
+        date_key = timetables.get_date_key(agency.id, d)
+    except (FileNotFoundError, KeyError) as ex:
+        date_key = None
+
+    route_fingerprints = {}
 
     for route in routes:
-        route_id = route.id
-        print(route_id)
+        route_fingerprints[route.id] = None
 
-        t1 = time.time()
+        if date_key is None:
+            continue
 
-        route_config = agency.get_route_config(route_id)
+        input_paths = [timetables.get_cache_path(agency.id, route.id, date_key)]
 
         if not scheduled:
-            try:
-                history = arrival_history.get_by_date(agency.id, route_id, d)
-            except FileNotFoundError as ex:
-                print(ex)
+            history_path = arrival_history.get_cache_path(agency.id, route.id, d)
+            if cache.get_file_version(history_path, max_age=arrival_history.MaxCacheFileAge) is None:
                 continue
+            input_paths.append(history_path)
 
-            history_df = history.get_data_frame()
-
+        fingerprint = hashlib.sha256(f'{StatsComputationVersion}\n'.encode('utf-8'))
+        fingerprint.update(json.dumps(route.data, sort_keys=True).encode('utf-8'))
         try:
-            timetable = timetables.get_by_date(agency.id, route_id, d)
-        except (FileNotFoundError, KeyError) as ex:
-            print(ex)
+            for input_path in input_paths:
+                with open(input_path, 'rb') as f:
+                    fingerprint.update(f.read())
+        except FileNotFoundError as ex:
             continue
 
-        timetable_df = timetable.get_data_frame()
+        route_fingerprints[route.id] = fingerprint.hexdigest()
 
-        for stat_id in stat_ids:
-            for interval_index, _ in enumerate(timestamp_intervals):
-                all_stats[stat_id][interval_index][route_id] = {'directions':{}}
+    return route_fingerprints
+
+def get_unchanged_route_stats(d: date, agency: config.Agency, route_fingerprints: dict, scheduled=False) -> dict:
+    #
+    # Returns a dict of route ID => stats (in the same format as compute_stats_for_route) from the previously
+    # saved stats for each route whose fingerprint is the same as when the stats were saved.
+    #
+    manifest = precomputed_stats.get_manifest(agency.id, d, scheduled)
 
-                for dir_info in route_config.get_direction_infos():
-                    dir_id = dir_info.id
+    unchanged_route_ids = [
+        route_id for route_id, fingerprint in route_fingerprints.items()
+        if fingerprint is not None and manifest.get(route_id, None) == fingerprint
+    ]
 
-                    all_stats[stat_id][interval_index][route_id]['directions'][dir_id] = collections.defaultdict(dict)
+    if len(unchanged_route_ids) == 0:
+        return {}
 
-        base_df = timetable_df if scheduled else history_df
+    time_str_intervals, timestamp_intervals = get_intervals(d, agency.tz)
 
-        add_trip_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
-        add_headway_and_wait_time_stats_for_route(all_stats, timestamp_intervals, route_config, base_df)
+    unchanged_route_stats = {route_id: {} for route_id in unchanged_route_ids}
 
-        if not scheduled:
-            add_schedule_adherence_stats_for_route(all_stats, timestamp_intervals, route_config, history_df, timetable_df)
+    for stat_id in precomputed_stats.AllStatIds:
+        for interval_index, (start_time_str, end_time_str) in enumerate(time_str_intervals):
+            try:
+                stats = precomputed_stats.get_precomputed_stats(agency.id, stat_id, d, start_time_str, end_time_str, scheduled)
+            except FileNotFoundError as ex:
+                return {}
+
+            for route_id in unchanged_route_ids:
+                if route_id in unchanged_route_stats:
+                    route_data = stats.data['routes'].get(route_id, None)
+                    if route_data is None:
+                        del unchanged_route_stats[route_id]
+                    else:
+                        unchanged_route_stats[route_id].setdefault(stat_id, {})[interval_index] = route_data
+
+    return unchanged_route_stats
+
+def save_route_stats(d: date, agency: config.Agency, routes, all_route_stats, route_fingerprints,
+                     scheduled=False, save_to_s3=True, num_unchanged_routes=0):
+    #
+    # Merges the stats returned by compute_stats_for_route for each route (parallel to routes)
+    # and saves the stats for each stat ID and interval, along with a manifest of the fingerprints
+    # of each route's inputs (computed by get_route_fingerprints, or None if not computed yet).
+    #
+    # If the stats for all routes are unchanged, the saved stats are only rewritten if
+    # a route was added or removed since they were saved.
+    #
+    if num_unchanged_routes == len(routes) and \
+            set(precomputed_stats.get_manifest(agency.id, d, scheduled).keys()) == set(route.id for route in routes):
+        print('stats unchanged for all routes')
+        return
+
+    stat_ids = precomputed_stats.AllStatIds
+
+    time_str_intervals, timestamp_intervals = get_intervals(d, agency.tz)
+
+    all_stats = {}
+
+    for stat_id in stat_ids:
+        all_stats[stat_id] = {}
 
-        t2 = time.time()
-        print(f' {round(t2-t1, 2)} sec')
+        for interval_index, _ in enumerate(timestamp_intervals):
+            all_stats[stat_id][interval_index] = {}
+
+    for route, route_stats in zip(routes, all_route_stats):
+        if route_stats is None:
+            continue
+
+        for stat_id in stat_ids:
+            for interval_index, _ in enumerate(timestamp_intervals):
+                all_stats[stat_id][interval_index][route.id] = route_stats[stat_id][interval_index]
 
     for stat_id in stat_ids:
         for interval_index, (start_time, end_time) in enumerate(timestamp_intervals):
@@ -315,21 +559,107 @@ def compute_stats(d: date, agency: config.Agency, routes, scheduled=False, save_
             }
             precomputed_stats.save_stats(agency.id, stat_id, d, start_time_str, end_time_str, scheduled=scheduled, data=data, save_to_s3=save_to_s3)
 
-def compute_stats_for_dates(dates, agency: config.Agency, scheduled=False, save_to_s3=True):
+    # input files that were downloaded while computing stats are now cached locally
+    unknown_routes = [route for route in routes if route_fingerprints.get(route.id, None) is None]
+
+    route_fingerprints = {**route_fingerprints, **get_route_fingerprints(d, agency, unknown_routes, scheduled)}
+
+    precomputed_stats.save_manifest(agency.id, d, scheduled, {
+        route.id: route_fingerprints[route.id]
+        for route, route_stats in zip(routes, all_route_stats)
+        if route_stats is not None and route_fingerprints[route.id] is not None
+    })
+
+def compute_stats(d: date, agency: config.Agency, routes, scheduled=False, save_to_s3=True, jobs=1, incremental=False):
+    #
+    # If incremental is true, stats are only recomputed for routes whose arrival history, timetable,
+    # or configuration changed since the stats were last saved, and the previous stats are reused for other routes.
+    #
+    if jobs > 1:
+        compute_stats_in_parallel([d], agency, routes, jobs, scheduled=scheduled, save_to_s3=save_to_s3, incremental=incremental)
+        return
+
+    print(f"{d} {'(scheduled)' if scheduled else '(observed)'}")
+
+    if incremental:
+        route_fingerprints = get_route_fingerprints(d, agency, routes, scheduled)
+        unchanged_route_stats = get_unchanged_route_stats(d, agency, route_fingerprints, scheduled)
+    else:
+        route_fingerprints = {}
+        unchanged_route_stats = {}
+
+    all_route_stats = []
+    for route in routes:
+        if route.id in unchanged_route_stats:
+            print(f'{route.id} unchanged')
+            all_route_stats.append(unchanged_route_stats[route.id])
+        else:
+            all_route_stats.append(compute_stats_for_route(d, agency, route.id, scheduled))
+
+    save_route_stats(d, agency, routes, all_route_stats, route_fingerprints,
+        scheduled=scheduled, save_to_s3=save_to_s3, num_unchanged_routes=len(unchanged_route_stats))
+
+def compute_stats_in_parallel(dates, agency: config.Agency, routes, jobs, scheduled=False, save_to_s3=True, incremental=False):
+    #
+    # Computes stats for each route and date in up to `jobs` separate processes.
+    #
+    # Routes for all dates are queued at once, so that workers don't sit idle while waiting for the
+    # slowest route of each date. The stats for each date are merged and saved in the parent process
+    # in the same order as compute_stats, as soon as all routes for that date are finished.
+    #
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        date_results = []
+
+        for d in dates:
+            if incremental:
+                route_fingerprints = get_route_fingerprints(d, agency, routes, scheduled)
+                unchanged_route_stats = get_unchanged_route_stats(d, agency, route_fingerprints, scheduled)
+            else:
+                route_fingerprints = {}
+                unchanged_route_stats = {}
+
+            futures = {
+                route.id: executor.submit(compute_stats_for_route_in_worker, (d, agency.id, route.id, scheduled))
+                for route in routes if route.id not in unchanged_route_stats
+            }
+
+            date_results.append((d, route_fingerprints, unchanged_route_stats, futures))
+
+        for d, route_fingerprints, unchanged_route_stats, futures in date_results:
+            print(f"{d} {'(scheduled)' if scheduled else '(observed)'}")
+
+            all_route_stats = []
+            for route in routes:
+                if route.id in unchanged_route_stats:
+                    print(f'{route.id} unchanged')
+                    all_route_stats.append(unchanged_route_stats[route.id])
+                else:
+                    output, route_stats = futures[route.id].result()
+                    print(output, end='')
+                    all_route_stats.append(route_stats)
+
+            save_route_stats(d, agency, routes, all_route_stats, route_fingerprints,
+                scheduled=scheduled, save_to_s3=save_to_s3, num_unchanged_routes=len(unchanged_route_stats))
+
+def compute_stats_for_dates(dates, agency: config.Agency, scheduled=False, save_to_s3=True, jobs=1, incremental=False):
 
     routes = agency.get_route_list()
 
     if scheduled:
         computed_date_keys = {}
+        schedule_dates = []
         for d in dates:
             date_key = timetables.get_date_key(agency.id, d)
             if date_key not in computed_date_keys:
                 computed_date_keys[date_key] = True
-                schedule_date = util.parse_date(date_key)
-                compute_stats(schedule_date, agency, routes, scheduled=True, save_to_s3=save_to_s3)
+                schedule_dates.append(util.parse_date(date_key))
+        dates = schedule_dates
+
+    if jobs > 1:
+        compute_stats_in_parallel(dates, agency, routes, jobs, scheduled=scheduled, save_to_s3=save_to_s3, incremental=incremental)
     else:
         for d in dates:
-            compute_stats(d, agency, routes, scheduled=False, save_to_s3=save_to_s3)
+            compute_stats(d, agency, routes, scheduled=scheduled, save_to_s3=save_to_s3, incremental=incremental)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Compute and cache statistics')
@@ -339,8 +669,11 @@ if __name__ == '__main__':
     parser.add_argument('--end-date', help='End date (yyyy-mm-dd), inclusive')
     parser.add_argument('--s3', dest='s3', action='store_true', help='store in s3')
     parser.add_argument('--scheduled', dest='scheduled', action='store_true', help='compute scheduled stats from timetable')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of routes to compute in parallel processes')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='only recompute stats for routes whose inputs changed since the stats were last computed')
     parser.set_defaults(s3=False)
     parser.set_defaults(scheduled=False)
+    parser.set_defaults(incremental=False)
 
     args = parser.parse_args()
 
@@ -360,4 +693,4 @@ if __name__ == '__main__':
     scheduled = args.scheduled
 
     for agency in agencies:
-        compute_stats_for_dates(dates, agency, scheduled=scheduled, save_to_s3=args.s3)
+        compute_stats_for_dates(dates, agency, scheduled=scheduled, save_to_s3=args.s3, jobs=args.jobs, incremental=args.incremental)
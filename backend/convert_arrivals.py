@@ -0,0 +1,69 @@
+from models import arrival_history, util, config
+import argparse
+import json
+import os
+import time
+from datetime import date
+
+# Converts locally cached arrival history JSON files to the columnar .npz format,
+# which arrival_history.get_by_date loads much faster than JSON.
+# (get_by_date also creates the .npz file automatically the first time it loads a JSON file.)
+
+def convert_arrivals_for_date(agency_id: str, d: date, route_ids: list, version):
+    json_dir = os.path.dirname(arrival_history.get_cache_path(agency_id, 'route', d, version))
+
+    if route_ids is None:
+        if not os.path.isdir(json_dir):
+            print(f'{d}: no arrival histories in {json_dir}')
+            return
+
+        prefix = f'arrivals_{version}_{agency_id}_{d}_'
+        route_ids = sorted([
+            filename[len(prefix):-len('.json')]
+            for filename in os.listdir(json_dir)
+            if filename.startswith(prefix) and filename.endswith('.json')
+        ])
+
+    for route_id in route_ids:
+        cache_path = arrival_history.get_cache_path(agency_id, route_id, d, version)
+        columnar_cache_path = arrival_history.get_cache_path(agency_id, route_id, d, version, format='npz')
+
+        if not os.path.exists(cache_path):
+            print(f'{d} {route_id}: {cache_path} not found')
+            continue
+
+        t1 = time.time()
+
+        with open(cache_path, 'r') as f:
+            history = arrival_history.ArrivalHistory.from_data(json.load(f))
+
+        arrival_history.save_columnar(history, columnar_cache_path)
+
+        print(f'{d} {route_id}: {round(time.time()-t1,2)} saved {columnar_cache_path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert cached arrival history JSON files to columnar format')
+    parser.add_argument('--agency', required=True, help='Agency ID')
+    parser.add_argument('--route', nargs='*', help='Route ID(s) (default: all routes with cached arrival histories)')
+    parser.add_argument('--version')
+    parser.add_argument('--date', help='Date (yyyy-mm-dd)')
+    parser.add_argument('--start-date', help='Start date (yyyy-mm-dd)')
+    parser.add_argument('--end-date', help='End date (yyyy-mm-dd), inclusive')
+
+    args = parser.parse_args()
+
+    agency = config.get_agency(args.agency)
+
+    version = args.version
+    if version is None:
+        version = arrival_history.DefaultVersion
+
+    if args.date:
+        dates = util.get_dates_in_range(args.date, args.date)
+    elif args.start_date is not None and args.end_date is not None:
+        dates = util.get_dates_in_range(args.start_date, args.end_date)
+    else:
+        raise Exception('missing date, start-date, or end-date')
+
+    for d in dates:
+        convert_arrivals_for_date(agency.id, d, args.route, version)
@@ -2,7 +2,7 @@ import os
 from flask import Flask, send_from_directory, Response
 from flask_cors import CORS
 import json
-from models import schema, config, routeconfig, arrival_history, precomputed_stats
+from models import schema, config, routeconfig, arrival_history, precomputed_stats, cache
 from flask_graphql import GraphQLView
 #import cProfile
 
@@ -43,6 +43,13 @@ def make_error_response(params, error, status):
     }
     return Response(json.dumps(data, indent=2), status=status, mimetype='application/json')
 
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    data = {
+        'caches': cache.get_all_stats(),
+    }
+    return Response(json.dumps(data, indent=2), mimetype='application/json')
+
 @app.route('/api/js_config', methods=['GET'])
 def js_config():
 
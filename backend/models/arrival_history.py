@@ -5,23 +5,93 @@ import os
 import json
 import requests
 import pandas as pd
-from . import util, config
+from . import util, config, cache
 import boto3
 from pathlib import Path
 import gzip
+import tempfile
 import numpy as np
 
 DefaultVersion = 'v4c'
 
+# Version of the columnar .npz format used for locally cached arrival histories
+# (independent of the version of the arrival history data)
+ColumnarFormatVersion = 1
+
 class ArrivalHistory:
-    def __init__(self, agency_id: str, route_id, stops_data, start_time = None, end_time = None, version = DefaultVersion):
+    def __init__(self, agency_id: str, route_id, stops_data = None, start_time = None, end_time = None, version = DefaultVersion,
+            columns = None):
         self.agency_id = agency_id
         self.route_id = route_id
         self.start_time = start_time
         self.end_time = end_time
-        self.stops_data = stops_data
         self.version = version
 
+        # An arrival history can be represented either as nested dicts (stops_data),
+        # in the same structure as the JSON files, or as parallel numpy arrays (columns).
+        # Each representation is created from the other one the first time it is needed.
+        self._stops_data = stops_data
+        self._columns = columns
+        self._index = None
+        self._closest_arrival_indexes = None
+
+    @property
+    def stops_data(self):
+        if self._stops_data is None:
+            self._stops_data = make_stops_data_from_columns(self._columns, self.version)
+        return self._stops_data
+
+    def get_columns(self) -> dict:
+        '''
+        Returns a dict of numpy arrays with one element per arrival, ordered by stop, then by direction,
+        then by arrival time (same order as stops_data):
+            vid_codes, sid_codes, did_codes (indexes into vid_values, sid_values, did_values)
+            time, departure_time, dist, trip
+        '''
+        if self._columns is None:
+            self._columns = make_columns_from_stops_data(self._stops_data, self.version)
+        return self._columns
+
+    def get_index(self) -> tuple:
+        '''
+        Returns a tuple (stop_ranges, is_sorted), where stop_ranges is a dict mapping each stop ID
+        to a list of (direction_id, start_index, end_index) tuples, where
+        start_index:end_index is the range of rows in get_columns() for that stop and direction,
+        and is_sorted is True if the times in each range are in ascending order.
+
+        The index is created the first time it is needed.
+        '''
+        if self._index is None:
+            columns = self.get_columns()
+
+            sid_codes = columns['sid_codes']
+            did_codes = columns['did_codes']
+            time_values = columns['time']
+
+            num_arrivals = len(sid_codes)
+
+            is_start_values = np.r_[True, (sid_codes[1:] != sid_codes[:-1]) | (did_codes[1:] != did_codes[:-1])][:num_arrivals]
+            start_indexes = np.nonzero(is_start_values)[0]
+            end_indexes = np.r_[start_indexes[1:], num_arrivals].astype(np.int64)
+
+            sid_values = columns['sid_values'].tolist()
+            did_values = columns['did_values'].tolist()
+
+            stop_ranges = {}
+            for start_index, end_index in zip(start_indexes.tolist(), end_indexes.tolist()):
+                s = sid_values[sid_codes[start_index]]
+                if s not in stop_ranges:
+                    stop_ranges[s] = []
+                stop_ranges[s].append((did_values[did_codes[start_index]], start_index, end_index))
+
+            # arrivals for each stop+direction should be in timestamp order, but
+            # if not, filtering by time can't use binary search
+            is_sorted = bool(np.all((np.diff(time_values) >= 0) | is_start_values[1:]))
+
+            self._index = (stop_ranges, is_sorted)
+
+        return self._index
+
     def get_data_frame(self, direction_id = None, stop_id = None, vehicle_id = None,
             start_time = None, end_time = None) -> pd.DataFrame:
         '''
@@ -33,64 +103,173 @@ class ArrivalHistory:
             end_time (unix timestamp)
 
         '''
-        stops = self.stops_data
-        data = []
+        columns = self.get_columns()
+        stop_ranges, is_sorted = self.get_index()
 
-        has_dist = has_departure_time = self.version and self.version[1] >= '3'
-        has_trip = self.version and self.version[1] >= '4'
+        # select ranges of rows for each stop+direction using the index
+        # instead of looping over each arrival
+        if stop_id is not None:
+            ranges = stop_ranges.get(stop_id, [])
+        elif direction_id is not None or (is_sorted and (start_time is not None or end_time is not None)):
+            ranges = [r for s_ranges in stop_ranges.values() for r in s_ranges]
+        else:
+            ranges = [(None, 0, len(columns['time']))]
+
+        if direction_id is not None:
+            ranges = [r for r in ranges if r[0] == direction_id]
+
+        time_values = columns['time']
+
+        if is_sorted:
+            # use binary search to find the rows within the time range
+            if start_time is not None or end_time is not None:
+                time_ranges = []
+                for did, start_index, end_index in ranges:
+                    range_time_values = time_values[start_index:end_index]
+                    if start_time is not None:
+                        start_index += np.searchsorted(range_time_values, start_time, side='left')
+                    if end_time is not None:
+                        end_index -= len(range_time_values) - np.searchsorted(range_time_values, end_time, side='left')
+                    if start_index < end_index:
+                        time_ranges.append((did, start_index, end_index))
+                ranges = time_ranges
+
+        if len(ranges) == 1:
+            # slices of numpy arrays are views, so no data needs to be copied here
+            rows = slice(ranges[0][1], ranges[0][2])
+        else:
+            rows = np.concatenate([np.arange(start_index, end_index) for did, start_index, end_index in ranges]) \
+                if len(ranges) > 0 else np.array([], dtype=np.int64)
+
+        mask = None
+
+        def add_filter(values):
+            nonlocal mask
+            mask = values if mask is None else (mask & values)
+
+        if vehicle_id is not None:
+            vid_codes = np.nonzero(columns['vid_values'] == vehicle_id)[0] if len(columns['vid_values']) > 0 else []
+            if len(vid_codes) == 0:
+                return make_empty_data_frame()
+            add_filter(columns['vid_codes'][rows] == vid_codes[0])
+
+        if not is_sorted:
+            if start_time is not None:
+                add_filter(time_values[rows] >= start_time)
+            if end_time is not None:
+                add_filter(time_values[rows] < end_time)
+
+        if mask is not None:
+            rows = (np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows)[mask]
+
+        if len(time_values[rows]) == 0:
+            return make_empty_data_frame()
+
+        return pd.DataFrame({
+            "VID": columns['vid_values'].astype(object)[columns['vid_codes'][rows]],
+            "TIME": time_values[rows],
+            "DEPARTURE_TIME": columns['departure_time'][rows],
+            "SID": columns['sid_values'].astype(object)[columns['sid_codes'][rows]],
+            "DID": columns['did_values'].astype(object)[columns['did_codes'][rows]],
+            "DIST": columns['dist'][rows],
+            "TRIP": columns['trip'][rows],
+        })
 
-        columns = ("VID", "TIME", "DEPARTURE_TIME", "SID", "DID", "DIST", "TRIP")
+    def find_closest_arrival_time(self, stop_id, vehicle_id, time):
+        closest_times = self.find_closest_arrival_times([stop_id], None if vehicle_id is None else [vehicle_id], [time])
+        return None if np.isnan(closest_times[0]) else int(closest_times[0])
 
-        def add_stop(s):
-            stop_info = stops[s]
-            for did, arrivals in stop_info['arrivals'].items():
-                if direction_id is not None and did != direction_id:
-                    continue
+    def find_closest_arrival_times(self, stop_ids, vehicle_ids, times) -> np.ndarray:
+        '''
+        Returns a float array with the closest arrival time (in any direction) at stop_ids[i]
+        for vehicle vehicle_ids[i] to times[i], or NaN if there is no arrival for that stop and vehicle.
+        If vehicle_ids is None, arrivals for any vehicle are considered.
 
-                for arrival in arrivals:
-                    v = arrival['v']
-                    if vehicle_id is not None and v != vehicle_id:
-                        continue
+        If two arrivals are equally close, the arrival that comes first in stops_data is returned.
+        '''
+        by_vehicle = vehicle_ids is not None
 
-                    timestamp = arrival['t']
+        columns = self.get_columns()
+        sorted_keys, sorted_times, sorted_rows, min_time, span = self.get_closest_arrival_index(by_vehicle)
 
-                    if start_time is not None and timestamp < start_time:
-                        continue
-                    if end_time is not None and timestamp >= end_time:
-                        break # arrivals for each stop+direction are in timestamp order, so can stop here
+        times = np.asarray(times, dtype=np.float64)
+        num_queries = len(times)
 
-                    departure_time = arrival['e'] if has_departure_time else timestamp
-                    dist = arrival['d'] if has_dist else np.nan
+        closest_times = np.full(num_queries, np.nan)
 
-                    trip = arrival['i'] if has_trip else -1
+        if len(sorted_keys) == 0 or num_queries == 0:
+            return closest_times
 
-                    data.append((v, timestamp, departure_time, s, did, dist, trip))
+        sid_codes = {sid: code for code, sid in enumerate(columns['sid_values'].tolist())}
+        query_keys = np.array([sid_codes.get(stop_id, -1) for stop_id in stop_ids], dtype=np.int64)
+        is_valid_values = query_keys >= 0
 
-        if stop_id is not None:
-            if stop_id in stops:
-                add_stop(stop_id)
-        else:
-            for s in stops:
-                add_stop(s)
+        if by_vehicle:
+            vid_codes = {vid: code for code, vid in enumerate(columns['vid_values'].tolist())}
+            query_vid_codes = np.array([vid_codes.get(vehicle_id, -1) for vehicle_id in vehicle_ids], dtype=np.int64)
+            is_valid_values &= query_vid_codes >= 0
+            query_keys = query_keys * len(vid_codes) + query_vid_codes
 
-        return pd.DataFrame(data = data, columns = columns)
+        # arrivals are sorted by key, then by time, so each key is a range of the sorted array
+        # (see get_closest_arrival_index)
+        query_offsets = np.clip(times, min_time - 1, min_time + span - 3) - min_time + 1
+        query_values = query_keys * span + query_offsets
 
-    def find_closest_arrival_time(self, stop_id, vehicle_id, time):
+        group_starts = np.searchsorted(sorted_keys, query_keys * span, side='left')
+        group_ends = np.searchsorted(sorted_keys, (query_keys + 1) * span, side='left')
+
+        # index of first arrival at or after the query time
+        after_indexes = np.searchsorted(sorted_keys, query_values, side='left')
+        has_after_values = is_valid_values & (after_indexes < group_ends)
+        has_before_values = is_valid_values & (after_indexes > group_starts)
+
+        before_indexes = np.maximum(after_indexes - 1, 0)
+        after_indexes = np.minimum(after_indexes, len(sorted_keys) - 1)
+
+        after_diffs = np.where(has_after_values, sorted_times[after_indexes] - times, np.inf)
+        before_diffs = np.where(has_before_values, times - sorted_times[before_indexes], np.inf)
+
+        # if the arrivals before and after are equally close, choose the one that appears first in stops_data
+        first_before_indexes = np.searchsorted(sorted_keys, sorted_keys[before_indexes], side='left')
+        is_before_first_values = sorted_rows[first_before_indexes] < sorted_rows[after_indexes]
+
+        use_before_values = (before_diffs < after_diffs) | ((before_diffs == after_diffs) & is_before_first_values)
+
+        closest_times = np.where(use_before_values, sorted_times[before_indexes], sorted_times[after_indexes]).astype(np.float64)
+        closest_times[~(has_after_values | has_before_values)] = np.nan
+
+        return closest_times
+
+    def get_closest_arrival_index(self, by_vehicle) -> tuple:
+        # Returns arrays of all arrivals sorted by stop (and vehicle if by_vehicle is True), then by time,
+        # then by position in stops_data. Each arrival has a composite integer key, stop_code * num_vehicles + vid_code
+        # (or just stop_code), multiplied by `span` and added to (time - min_time + 1), so that
+        # np.searchsorted can find the position of a particular time within each key.
+        if self._closest_arrival_indexes is None:
+            self._closest_arrival_indexes = {}
 
-        closest_time = None
-        closest_time_diff = None
+        if by_vehicle not in self._closest_arrival_indexes:
+            columns = self.get_columns()
+            time_values = columns['time']
 
-        if stop_id in self.stops_data:
-            for direction_id, arrivals in self.stops_data[stop_id]['arrivals'].items():
-                for arrival in arrivals:
-                    if (vehicle_id == arrival['v'] or vehicle_id is None):
-                        arrival_time = arrival['t']
-                        time_diff = abs(arrival_time - time)
-                        if (closest_time is None) or (time_diff < closest_time_diff):
-                            closest_time = arrival_time
-                            closest_time_diff = time_diff
+            if len(time_values) > 0:
+                min_time = int(np.min(time_values))
+                span = int(np.max(time_values)) - min_time + 3
+            else:
+                min_time = 0
+                span = 3
 
-        return closest_time
+            keys = columns['sid_codes'].astype(np.int64)
+            if by_vehicle:
+                keys = keys * len(columns['vid_values']) + columns['vid_codes']
+
+            sorted_rows = np.lexsort((np.arange(len(time_values)), time_values, keys))
+            sorted_times = time_values[sorted_rows]
+            sorted_keys = keys[sorted_rows] * span + (sorted_times - min_time + 1)
+
+            self._closest_arrival_indexes[by_vehicle] = (sorted_keys, sorted_times, sorted_rows, min_time, span)
+
+        return self._closest_arrival_indexes[by_vehicle]
 
     @classmethod
     def from_data(cls, data):
@@ -113,6 +292,111 @@ class ArrivalHistory:
             'stops': self.stops_data,
         }
 
+def make_empty_data_frame() -> pd.DataFrame:
+    return pd.DataFrame(data = [], columns = ("VID", "TIME", "DEPARTURE_TIME", "SID", "DID", "DIST", "TRIP"))
+
+def has_dist_and_departure_time(version) -> bool:
+    return bool(version) and version[1] >= '3'
+
+def has_trip(version) -> bool:
+    return bool(version) and version[1] >= '4'
+
+def make_columns_from_stops_data(stops_data: dict, version) -> dict:
+    has_dist = has_departure_time = has_dist_and_departure_time(version)
+    has_trip_ids = has_trip(version)
+
+    vid_list = []
+    time_list = []
+    departure_time_list = []
+    dist_list = []
+    trip_list = []
+    sid_list = []
+    did_list = []
+
+    for s, stop_info in stops_data.items():
+        for did, arrivals in stop_info['arrivals'].items():
+            num_arrivals = len(arrivals)
+            sid_list.extend([s] * num_arrivals)
+            did_list.extend([did] * num_arrivals)
+
+            for arrival in arrivals:
+                timestamp = arrival['t']
+                vid_list.append(arrival['v'])
+                time_list.append(timestamp)
+                departure_time_list.append(arrival['e'] if has_departure_time else timestamp)
+                dist_list.append(arrival['d'] if has_dist else np.nan)
+                trip_list.append(arrival['i'] if has_trip_ids else -1)
+
+    def factorize(values):
+        codes, uniques = pd.factorize(np.array(values, dtype=object))
+        return codes.astype(np.int32), np.array(uniques.tolist())
+
+    vid_codes, vid_values = factorize(vid_list)
+    sid_codes, sid_values = factorize(sid_list)
+    did_codes, did_values = factorize(did_list)
+
+    return {
+        'vid_codes': vid_codes,
+        'vid_values': vid_values,
+        'sid_codes': sid_codes,
+        'sid_values': sid_values,
+        'did_codes': did_codes,
+        'did_values': did_values,
+        'time': np.array(time_list, dtype=np.int64),
+        'departure_time': np.array(departure_time_list, dtype=np.int64),
+        'dist': np.array(dist_list) if has_dist else np.array(dist_list, dtype=np.float64),
+        'trip': np.array(trip_list, dtype=np.int64),
+    }
+
+def make_stops_data_from_columns(columns: dict, version) -> dict:
+    has_dist = has_departure_time = has_dist_and_departure_time(version)
+    has_trip_ids = has_trip(version)
+
+    sid_values = columns['sid_values'].tolist()
+    did_values = columns['did_values'].tolist()
+    vid_values = columns['vid_values'].tolist()
+
+    sid_codes = columns['sid_codes']
+    did_codes = columns['did_codes']
+
+    stops_data = {}
+
+    num_arrivals = len(sid_codes)
+    if num_arrivals == 0:
+        return stops_data
+
+    # rows for each stop+direction are consecutive
+    start_indexes = np.nonzero(np.r_[True, (sid_codes[1:] != sid_codes[:-1]) | (did_codes[1:] != did_codes[:-1])])[0]
+    end_indexes = np.r_[start_indexes[1:], num_arrivals]
+
+    vid_list = columns['vid_codes'].tolist()
+    time_list = columns['time'].tolist()
+    departure_time_list = columns['departure_time'].tolist()
+    dist_list = columns['dist'].tolist()
+    trip_list = columns['trip'].tolist()
+
+    for start_index, end_index in zip(start_indexes, end_indexes):
+        s = sid_values[sid_codes[start_index]]
+        did = did_values[did_codes[start_index]]
+
+        arrivals = []
+        for i in range(start_index, end_index):
+            arrival = {'t': time_list[i]}
+            if has_departure_time:
+                arrival['e'] = departure_time_list[i]
+            if has_dist:
+                arrival['d'] = dist_list[i]
+            arrival['v'] = vid_values[vid_list[i]]
+            if has_trip_ids:
+                arrival['i'] = trip_list[i]
+            arrivals.append(arrival)
+
+        if s not in stops_data:
+            stops_data[s] = {'arrivals': {}}
+        stops_data[s]['arrivals'][did] = arrivals
+
+    return stops_data
+
 def from_data_frame(agency_id: str, route_id, arrivals_df: pd.DataFrame, start_time, end_time) -> ArrivalHistory:
     # note: arrival_history module uses timestamps in seconds, but tryn-api uses ms
     return ArrivalHistory(agency_id, route_id, stops_data=make_stops_data(arrivals_df), start_time=start_time, end_time=end_time)
@@ -139,7 +423,8 @@ def make_stops_data(arrivals: pd.DataFrame):
             }
     return stops_data
 
-def get_cache_path(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> str:
+def get_cache_path(agency_id: str, route_id: str, d: date, version = DefaultVersion, format = 'json') -> str:
+    # format is either 'json' (same as the files on S3) or 'npz' (columnar format, only stored locally)
     if version is None:
         version = DefaultVersion
 
@@ -156,7 +441,10 @@ def get_cache_path(agency_id: str, route_id: str, d: date, version = DefaultVers
     if re.match('^[\w\-]+$', version) is None:
         raise Exception(f"Invalid version: {version}")
 
-    return os.path.join(util.get_data_dir(), f"arrivals_{version}_{agency_id}/{date_str}/arrivals_{version}_{agency_id}_{date_str}_{route_id}.json")
+    if format not in ('json', 'npz'):
+        raise Exception(f"Invalid format: {format}")
+
+    return os.path.join(util.get_data_dir(), f"arrivals_{version}_{agency_id}/{date_str}/arrivals_{version}_{agency_id}_{date_str}_{route_id}.{format}")
 
 def get_s3_path(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> str:
     if version is None:
@@ -166,17 +454,90 @@ def get_s3_path(agency_id: str, route_id: str, d: date, version = DefaultVersion
     date_path = d.strftime("%Y/%m/%d")
     return f"arrivals/{version}/{agency_id}/{date_path}/arrivals_{version}_{agency_id}_{date_str}_{route_id}.json.gz"
 
-def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> ArrivalHistory:
+def save_columnar(history: ArrivalHistory, path: str):
+    '''
+    Saves the arrival history in the columnar .npz format, which can be loaded
+    without creating Python objects for each arrival. String columns are stored as integer codes
+    into arrays of unique values, so the file can be loaded without pickle.
+    '''
+    columns = history.get_columns()
+
+    metadata = {
+        'format_version': ColumnarFormatVersion,
+        'version': history.version,
+        'agency': history.agency_id,
+        'route_id': history.route_id,
+        'start_time': history.start_time,
+        'end_time': history.end_time,
+    }
+
+    cache_dir = Path(path).parent
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents = True, exist_ok = True)
+
+    # write to a temporary file first so other processes never read a partially written file
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as f:
+        np.savez_compressed(f, metadata=np.array(json.dumps(metadata)), **columns)
+
+    os.replace(f.name, path)
+
+def load_columnar(path: str) -> ArrivalHistory:
+    with np.load(path, allow_pickle=False) as data:
+        metadata = json.loads(str(data['metadata']))
+
+        if metadata['format_version'] != ColumnarFormatVersion:
+            raise Exception(f"Unsupported columnar format version in {path}: {metadata['format_version']}")
+
+        columns = {key: data[key] for key in data.files if key != 'metadata'}
+
+    return ArrivalHistory(
+        agency_id = metadata['agency'],
+        route_id = metadata['route_id'],
+        start_time = metadata['start_time'],
+        end_time = metadata['end_time'],
+        version = metadata['version'],
+        columns = columns,
+    )
+
+# arrival histories loaded by get_by_date with use_cache=True, shared by all threads in the process
+history_cache = cache.get_cache('arrival_history', 512)
+
+# local cache files older than this are refreshed from S3 by get_by_date
+MaxCacheFileAge = 86400
+
+def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion, use_cache = False) -> ArrivalHistory:
 
     cache_path = get_cache_path(agency_id, route_id, d, version)
 
+    if use_cache:
+        # reuse a previously loaded history until the local cache file is modified or needs to be refreshed from S3
+        return history_cache.get_or_compute(
+            (agency_id, route_id, str(d), version),
+            lambda: get_by_date(agency_id, route_id, d, version),
+            get_version = lambda: cache.get_file_version(cache_path, max_age=MaxCacheFileAge)
+        )
+    columnar_cache_path = get_cache_path(agency_id, route_id, d, version, format='npz')
+
+    now = time.time()
+
+    try:
+        columnar_mtime = os.stat(columnar_cache_path).st_mtime
+    except FileNotFoundError as err:
+        columnar_mtime = None
+
     try:
         mtime = os.stat(cache_path).st_mtime
-        now = time.time()
-        if now - mtime < 86400:
+        if now - mtime < MaxCacheFileAge:
+            # use the columnar file if it was created from the current JSON file
+            if columnar_mtime is not None and columnar_mtime >= mtime:
+                return load_columnar(columnar_cache_path)
+
             with open(cache_path, "r") as f:
                 text = f.read()
-                return ArrivalHistory.from_data(json.loads(text))
+                history = ArrivalHistory.from_data(json.loads(text))
+
+            save_columnar(history, columnar_cache_path)
+            return history
     except FileNotFoundError as err:
         pass
 
@@ -202,7 +563,11 @@ def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion
     with open(cache_path, "w") as f:
         f.write(r.text)
 
-    return ArrivalHistory.from_data(data)
+    history = ArrivalHistory.from_data(data)
+
+    save_columnar(history, columnar_cache_path)
+
+    return history
 
 def save_for_date(history: ArrivalHistory, d: date, s3=False):
     data_str = json.dumps(history.get_data())
@@ -220,6 +585,8 @@ def save_for_date(history: ArrivalHistory, d: date, s3=False):
     with open(cache_path, "w") as f:
         f.write(data_str)
 
+    save_columnar(history, get_cache_path(agency_id, route_id, d, version, format='npz'))
+
     if s3:
         s3 = boto3.resource('s3')
         s3_path = get_s3_path(agency_id, route_id, d, version)
@@ -0,0 +1,233 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import pandas as pd
+
+# Process-wide in-memory caches with least-recently-used eviction.
+#
+# Each cache has a maximum size in bytes (estimated by get_size), which can be
+# configured via environment variables named {NAME}_CACHE_MB, e.g.
+# ARRIVAL_HISTORY_CACHE_MB=1024. A limit of 0 disables the cache.
+#
+# Caches are thread-safe so they can be shared by all requests handled by
+# a long-running Flask worker.
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+class LRUCache:
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key => (value, size, expires_at, version)
+        self.pending = {} # key => Future for values currently being computed by get_or_compute
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.shared_loads = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None, version=None):
+        # If version is not None, only returns the value if it was stored with the same version
+        # (e.g. the modification time of the file the value was loaded from).
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, size, expires_at, entry_version = entry
+                if (expires_at is None or expires_at > time.time()) and (version is None or version == entry_version):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None, size=None, version=None):
+        # ttl is the maximum number of seconds to keep the value, or None to keep it until it is evicted
+        if size is None:
+            size = get_size(value)
+
+        expires_at = time.time() + ttl if ttl is not None else None
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = (value, size, expires_at, version)
+            self.num_bytes += size
+
+            while self.num_bytes > self.max_bytes:
+                evicted_key = next(iter(self.entries))
+                self._remove(evicted_key)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, ttl=None, get_version=None):
+        # Returns the cached value for key, or calls compute() and caches the result.
+        #
+        # If get_version is not None, it is called to get the current version of the value (e.g. a file modification time),
+        # and the cached value is only used if it has the same version. get_version may return None
+        # if the current version is unknown, in which case the value is always recomputed.
+        #
+        # If another thread is already computing the value for the same key, waits for that thread
+        # to finish and uses the same value (or raises the same exception), instead of computing it twice.
+        while True:
+            version = get_version() if get_version is not None else None
+
+            with self.lock:
+                if get_version is None or version is not None:
+                    value = self.get(key, _missing, version=version)
+                    if value is not _missing:
+                        return value
+
+                future = self.pending.get(key)
+                if future is None:
+                    future = self.pending[key] = Future()
+                    break
+
+            # wait for the other thread to finish computing the value
+            with self.lock:
+                self.shared_loads += 1
+
+            value = future.result()
+
+            if get_version is None:
+                return value
+
+            # check the version again, since the value may have changed since the other thread loaded it
+
+        try:
+            value = compute()
+            if get_version is not None and version is None:
+                version = get_version()
+            self.set(key, value, ttl=ttl, version=version)
+            future.set_result(value)
+            return value
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def _remove(self, key):
+        value, size, expires_at, version = self.entries.pop(key)
+        self.num_bytes -= size
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'name': self.name,
+                'entries': len(self.entries),
+                'bytes': self.num_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'shared_loads': self.shared_loads,
+            }
+
+_missing = object()
+
+def get_cache(name, default_max_mb) -> LRUCache:
+    # Returns the process-wide cache with the given name, creating it if necessary.
+    with _caches_lock:
+        if name not in _caches:
+            max_mb = float(os.environ.get(f'{name.upper()}_CACHE_MB', default_max_mb))
+            _caches[name] = LRUCache(name, int(max_mb * 1024 * 1024))
+        return _caches[name]
+
+def get_file_version(path, max_age=None):
+    # Returns the modification time of a file, for use as the version of a value loaded from that file,
+    # or None if the file does not exist or was modified more than max_age seconds ago.
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if max_age is not None and time.time() - mtime_ns / 1e9 >= max_age:
+        return None
+
+    return mtime_ns
+
+def get_all_stats() -> list:
+    with _caches_lock:
+        caches = list(_caches.values())
+    return [c.get_stats() for c in caches]
+
+def clear_all():
+    with _caches_lock:
+        caches = list(_caches.values())
+    for c in caches:
+        c.clear()
+
+# number of items of large lists/dicts to measure when estimating their size
+_size_sample_count = 50
+
+def get_size(value) -> int:
+    # Returns the approximate number of bytes used by value, including the objects it references.
+    # Large lists and dicts are estimated from a sample of their items.
+    return _get_size(value, set())
+
+def _get_size(value, seen) -> int:
+    value_id = id(value)
+    if value_id in seen:
+        return 0
+    seen.add(value_id)
+
+    if isinstance(value, np.ndarray):
+        size = value.nbytes
+        if value.dtype == object:
+            size += _get_items_size(value.ravel(), seen)
+        return size
+
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+
+    size = sys.getsizeof(value)
+
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return size
+
+    if isinstance(value, dict):
+        return size + _get_items_size(value.keys(), seen) + _get_items_size(value.values(), seen)
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + _get_items_size(value, seen)
+
+    if hasattr(value, '__dict__'):
+        return size + _get_size(vars(value), seen)
+
+    return size
+
+def _get_items_size(items, seen) -> int:
+    num_items = len(items)
+    if num_items <= _size_sample_count:
+        return sum(_get_size(item, seen) for item in items)
+
+    sample_size = 0
+    for i, item in enumerate(items):
+        if i == _size_sample_count:
+            break
+        sample_size += _get_size(item, seen)
+
+    return int(sample_size * num_items / _size_sample_count)
@@ -5,116 +5,136 @@ import numpy as np
 from . import routeconfig, util, config
 
 
-def resample_bus(bus: pd.DataFrame) -> pd.DataFrame:
+def resample_buses(route_state: pd.DataFrame) -> pd.DataFrame:
+    # Resamples the GPS observations for all vehicles in route_state at once.
+    #
+    # Returns a data frame with columns VID, DID, LAT, LON, TIME, OBS_GROUP,
+    # with rows ordered by VID, then by the original order of the observations for each vehicle,
+    # with a separator row after the last observation of each vehicle and before
+    # the first observation after each long gap.
+    #
+    # This avoids looping over each vehicle (and each observation) in Python by computing
+    # the number of rows generated by each observation, then expanding the observations
+    # with np.repeat and computing the positions of interpolated rows using cumsum.
 
-    time_diffs = np.diff(bus['TIME'].values, prepend=0)
+    # order rows by vehicle ID (same order as groupby('VID')), keeping the original order of each vehicle's rows
+    vid_codes, _ = pd.factorize(route_state['VID'].values, sort=True)
+    sort_order = np.argsort(vid_codes, kind='mergesort')
+    sort_order = sort_order[vid_codes[sort_order] >= 0]
 
-    # remove duplicates (positions are observed every 15 seconds, but usually only update every minute or so)
-    bus = bus[time_diffs > 2]
+    vid_codes = vid_codes[sort_order]
+    vid_values = route_state['VID'].values[sort_order]
+    time_values = route_state['TIME'].values[sort_order]
 
-    new_rows = []
+    is_first_values = np.diff(vid_codes, prepend=-1) != 0
 
-    def make_separator_row(vid):
-        # adding a separator row at the end of each vehicle's observations allows simplifying
-        # get_possible_arrivals_for_stop() (and making it slightly faster).
-        # this row will always be filtered out by find_arrivals
-        # so the row index will always have a gap in it even if two vehicles
-        # adjacent in the buses frame both happen to be near the same stop
-        return (
-            vid,
-            '',
-            0,
-            0,
-            0,
-            0,
-            # 0 # uncomment for debugging
-        )
+    time_diffs = np.diff(time_values, prepend=0)
+    time_diffs[is_first_values] = time_values[is_first_values]
 
-    if not bus.empty:
-        # faster to use numpy arrays instead of pandas series
-        time_values = bus['TIME'].values
-        lat_values = bus['LAT'].values
-        lon_values = bus['LON'].values
-
-        target_dist = 25
-
-        prev_time_values = np.r_[np.nan, time_values[:-1]]
-        prev_lat_values = np.r_[np.nan, lat_values[:-1]]
-        prev_lon_values = np.r_[np.nan, lon_values[:-1]]
-
-        dt_values = time_values - prev_time_values
-        lat_diff_values = lat_values - prev_lat_values
-        lon_diff_values = lon_values - prev_lon_values
-
-        moved_dist_values = util.haver_distance(prev_lat_values, prev_lon_values, lat_values, lon_values)
-        num_samples_values = np.floor(moved_dist_values / target_dist) # may be 0
-        num_samples_values[0] = 0
-
-        # interpolate lat/lng/time values between Nextbus observations so that the distance moved between rows
-        # is reasonably small (allowing a smaller radius around stop and more precise arrival times),
-        # but not too small to create an unnecessarily large number of rows (slower to calculate)
-
-        # looping by index over all of these arrays is more verbose than adding these columns to
-        # the bus dataframe and looping using itertuples(), but this is much faster!
-        vid = bus['VID'].values[0]
-        did_values = bus['DID'].values
-
-        # obs_group is a counter associated with each resampled GPS observation
-        # that lets us group consecutive GPS observations for a particular vehicle.
-        # If a vehicle is missing GPS observations for a certain amount of time,
-        # we increment the obs_group counter.
-        obs_group = 1
-
-        for i in range(0, len(time_values)):
-            did_i = did_values[i]
-            num_samples_i = int(num_samples_values[i])
-            dt_i = dt_values[i]
-
-            if num_samples_i > 1 and num_samples_i < 100 and dt_i < 180:
-                prev_lat_i = prev_lat_values[i]
-                prev_lon_i = prev_lon_values[i]
-                prev_time_i = prev_time_values[i]
-                lon_diff_i = lon_diff_values[i]
-                lat_diff_i = lat_diff_values[i]
-                for j in range(1, num_samples_i):
-                    frac = j / num_samples_i
-                    new_rows.append((
-                        vid,
-                        did_i,
-                        prev_lat_i + lat_diff_i * frac,
-                        prev_lon_i + lon_diff_i * frac,
-                        prev_time_i + dt_i * frac,
-                        obs_group,
-                        # 1 # uncomment for debugging
-                    ))
-            elif dt_i > 1800:
-                # if a vehicle does not report any GPS observations for more than 30 minutes,
-                # increment the "observation group" counter and add a separator row
-                # so that the algorithm will consider observations before and after the gap
-                # as belonging to separate trips.
-
-                obs_group += 1
-                new_rows.append(make_separator_row(vid))
-
-            new_rows.append((
-                vid,
-                did_i,
-                lat_values[i],
-                lon_values[i],
-                time_values[i],
-                obs_group,
-                # 0 # uncomment for debugging
-            ))
-
-        new_rows.append(make_separator_row(vid))
-
-    resampled_bus = pd.DataFrame(new_rows, columns=[
-        'VID','DID','LAT','LON','TIME','OBS_GROUP'
-        # 'INTERP' # whether a sample was interpolated isn't needed by algorithm, but useful for debugging
-    ])
-    resampled_bus['TIME'] = resampled_bus['TIME'].astype(np.int64)
-
-    return resampled_bus
+    # remove duplicates (positions are observed every 15 seconds, but usually only update every minute or so)
+    keep_values = time_diffs > 2
+    sort_order = sort_order[keep_values]
+
+    # faster to use numpy arrays instead of pandas series
+    vid_codes = vid_codes[keep_values]
+    vid_values = vid_values[keep_values]
+    time_values = time_values[keep_values]
+    did_values = route_state['DID'].values[sort_order]
+    lat_values = route_state['LAT'].values[sort_order]
+    lon_values = route_state['LON'].values[sort_order]
+
+    num_rows = len(time_values)
+
+    is_first_values = np.diff(vid_codes, prepend=-1) != 0
+    is_last_values = np.diff(vid_codes, append=-1) != 0
+
+    target_dist = 25
+
+    def get_prev_values(values):
+        prev_values = np.r_[np.nan, values[:-1]]
+        prev_values[is_first_values] = np.nan
+        return prev_values
+
+    prev_time_values = get_prev_values(time_values)
+    prev_lat_values = get_prev_values(lat_values)
+    prev_lon_values = get_prev_values(lon_values)
+
+    dt_values = time_values - prev_time_values
+    lat_diff_values = lat_values - prev_lat_values
+    lon_diff_values = lon_values - prev_lon_values
+
+    moved_dist_values = util.haver_distance(prev_lat_values, prev_lon_values, lat_values, lon_values)
+    num_samples_values = np.floor(moved_dist_values / target_dist) # may be 0
+    num_samples_values[is_first_values] = 0
+
+    # interpolate lat/lng/time values between Nextbus observations so that the distance moved between rows
+    # is reasonably small (allowing a smaller radius around stop and more precise arrival times),
+    # but not too small to create an unnecessarily large number of rows (slower to calculate)
+    is_interpolated_values = (num_samples_values > 1) & (num_samples_values < 100) & (dt_values < 180)
+
+    # if a vehicle does not report any GPS observations for more than 30 minutes,
+    # increment the "observation group" counter and add a separator row
+    # so that the algorithm will consider observations before and after the gap
+    # as belonging to separate trips.
+    is_gap_values = ~is_interpolated_values & (dt_values > 1800)
+
+    # obs_group is a counter associated with each resampled GPS observation
+    # that lets us group consecutive GPS observations for a particular vehicle.
+    # If a vehicle is missing GPS observations for a certain amount of time,
+    # we increment the obs_group counter.
+    gap_counts = np.cumsum(is_gap_values)
+    first_gap_counts = np.maximum.accumulate(np.where(is_first_values, gap_counts - is_gap_values, 0))
+    obs_group_values = 1 + gap_counts - first_gap_counts
+
+    num_interpolated_values = np.where(is_interpolated_values, num_samples_values - 1, 0).astype(np.int64)
+
+    # adding a separator row at the end of each vehicle's observations allows simplifying
+    # get_nadirs() (and making it slightly faster).
+    # separator rows will always be filtered out by find_arrivals
+    # so the row index will always have a gap in it even if two vehicles
+    # adjacent in the buses frame both happen to be near the same stop
+    num_new_rows_values = num_interpolated_values + is_gap_values + 1 + is_last_values
+    start_indexes = np.cumsum(num_new_rows_values) - num_new_rows_values
+    num_resampled_rows = int(np.sum(num_new_rows_values))
+
+    # separator rows have an empty DID and 0 for all other values besides VID
+    resampled_did_values = np.full(num_resampled_rows, '', dtype=object)
+    resampled_lat_values = np.zeros(num_resampled_rows)
+    resampled_lon_values = np.zeros(num_resampled_rows)
+    resampled_time_values = np.zeros(num_resampled_rows)
+    resampled_obs_group_values = np.zeros(num_resampled_rows, dtype=np.int64)
+
+    # original observations come after any interpolated rows or separator row
+    obs_indexes = start_indexes + num_interpolated_values + is_gap_values
+    resampled_did_values[obs_indexes] = did_values
+    resampled_lat_values[obs_indexes] = lat_values
+    resampled_lon_values[obs_indexes] = lon_values
+    resampled_time_values[obs_indexes] = time_values
+    resampled_obs_group_values[obs_indexes] = obs_group_values
+
+    # interpolated rows j = 1 .. num_samples-1 come before each original observation
+    interp_row_indexes = np.repeat(np.arange(num_rows), num_interpolated_values)
+    interp_j_values = np.arange(len(interp_row_indexes)) + 1 - np.repeat(
+        np.cumsum(num_interpolated_values) - num_interpolated_values,
+        num_interpolated_values
+    )
+    interp_frac_values = interp_j_values / num_samples_values[interp_row_indexes]
+    interp_indexes = start_indexes[interp_row_indexes] + interp_j_values - 1
+
+    resampled_did_values[interp_indexes] = did_values[interp_row_indexes]
+    resampled_lat_values[interp_indexes] = prev_lat_values[interp_row_indexes] + lat_diff_values[interp_row_indexes] * interp_frac_values
+    resampled_lon_values[interp_indexes] = prev_lon_values[interp_row_indexes] + lon_diff_values[interp_row_indexes] * interp_frac_values
+    resampled_time_values[interp_indexes] = prev_time_values[interp_row_indexes] + dt_values[interp_row_indexes] * interp_frac_values
+    resampled_obs_group_values[interp_indexes] = obs_group_values[interp_row_indexes]
+
+    return pd.DataFrame({
+        'VID': np.repeat(vid_values, num_new_rows_values),
+        'DID': resampled_did_values,
+        'LAT': resampled_lat_values,
+        'LON': resampled_lon_values,
+        'TIME': resampled_time_values.astype(np.int64),
+        'OBS_GROUP': resampled_obs_group_values,
+    })
 
 def get_invalid_direction_times(agency: config.Agency, route_config: routeconfig.RouteConfig, direction_id: str):
     route_id = route_config.id
@@ -128,6 +148,88 @@ def get_invalid_direction_times(agency: config.Agency, route_config: routeconfig
                 ))
     return invalid_times
 
+class StopDistances:
+    # Sparse table of distances from resampled GPS observations to nearby stops.
+    #
+    # Instead of computing the distance from every observation to every stop,
+    # observations are indexed in a grid with cells a little larger than max_radius,
+    # so each stop only needs distances to observations in the 3x3 grid cells around it.
+    #
+    # get_nearby_rows(stop_id) returns the positions of the rows in buses (in ascending order)
+    # within max_radius meters of the stop, along with the distances (in meters) to the stop.
+    # Nearby rows are computed the first time each stop is requested.
+
+    def __init__(self, buses: pd.DataFrame, route_config: routeconfig.RouteConfig, max_radius):
+        self.route_config = route_config
+        self.max_radius = max_radius
+        self.lat_values = buses['LAT'].values
+        self.lon_values = buses['LON'].values
+
+        self.nearby_rows = {}
+
+        # the haversine distance between two points is at least eradius * (latitude difference in radians),
+        # and at least eradius * cos(latitude) * (longitude difference in radians), so
+        # with some margin for rounding, points within max_radius are always in adjacent grid cells.
+        eradius = 6371000
+        max_abs_lat = np.max(np.abs(self.lat_values)) if len(self.lat_values) > 0 else 0
+        self.cell_lat = np.rad2deg(max_radius / eradius) * 1.1
+        self.cell_lon = self.cell_lat / np.cos(np.deg2rad(min(max_abs_lat + 1, 89)))
+
+        is_valid_values = np.isfinite(self.lat_values) & np.isfinite(self.lon_values)
+        valid_rows = np.nonzero(is_valid_values)[0]
+
+        cell_values = self.get_cell_keys(self.lat_values[valid_rows], self.lon_values[valid_rows])
+        sort_order = np.argsort(cell_values, kind='mergesort')
+
+        self.sorted_cell_values = cell_values[sort_order]
+        self.sorted_rows = valid_rows[sort_order]
+
+    def get_cells(self, lat_values, lon_values):
+        return (
+            np.floor(lat_values / self.cell_lat).astype(np.int64),
+            np.floor(lon_values / self.cell_lon).astype(np.int64),
+        )
+
+    def get_cell_keys(self, lat_values, lon_values, lat_offset=0, lon_offset=0):
+        lat_cells, lon_cells = self.get_cells(lat_values, lon_values)
+        return ((lat_cells + lat_offset) << 32) + (lon_cells + lon_offset + (1 << 31))
+
+    def get_nearby_rows(self, stop_id) -> tuple:
+        if stop_id in self.nearby_rows:
+            return self.nearby_rows[stop_id]
+
+        stop_info = self.route_config.get_stop_info(stop_id)
+        stop_lat = np.array([stop_info.lat])
+        stop_lon = np.array([stop_info.lon])
+
+        # for each row of 3 adjacent grid cells, the keys are consecutive in the sorted array
+        row_ranges = []
+        for lat_offset in [-1, 0, 1]:
+            start_key = self.get_cell_keys(stop_lat, stop_lon, lat_offset, -1)[0]
+            end_key = self.get_cell_keys(stop_lat, stop_lon, lat_offset, 1)[0]
+            start_index = np.searchsorted(self.sorted_cell_values, start_key, side='left')
+            end_index = np.searchsorted(self.sorted_cell_values, end_key, side='right')
+            row_ranges.append(self.sorted_rows[start_index:end_index])
+
+        row_values = np.sort(np.concatenate(row_ranges))
+
+        distance_values = self.get_distances(stop_id, row_values)
+
+        is_near_values = distance_values < self.max_radius
+        nearby_rows = (row_values[is_near_values], distance_values[is_near_values])
+
+        self.nearby_rows[stop_id] = nearby_rows
+        return nearby_rows
+
+    def get_distances(self, stop_id, row_values):
+        # calculate distances fast with haversine function
+        stop_info = self.route_config.get_stop_info(stop_id)
+        return util.haver_distance(stop_info.lat, stop_info.lon, self.lat_values[row_values], self.lon_values[row_values])
+
+    def get_distances_to_points(self, lat_values, lon_values, row_values):
+        # calculates the distance from each point (lat_values[i], lon_values[i]) to the row row_values[i]
+        return util.haver_distance(lat_values, lon_values, self.lat_values[row_values], self.lon_values[row_values])
+
 def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config: routeconfig.RouteConfig, d: date) -> pd.DataFrame:
 
     tz = agency.tz
@@ -143,38 +245,26 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
 
     print(f'{route_id}: {round(time.time() - t0, 1)} resampling {len(route_state["TIME"].values)} GPS observations')
 
-    buses = pd.concat([
-        resample_bus(bus)
-        for vid, bus in route_state.groupby(route_state['VID'])
-    ], ignore_index=True)
+    buses = resample_buses(route_state)
 
     def remove_bus_separators():
         return buses[buses['TIME'] != 0]
 
     buses = remove_bus_separators()
 
-    print(f'{route_id}: {round(time.time() - t0, 1)} computing distances from {len(buses["TIME"].values)} resampled GPS observations to stops')
+    print(f'{route_id}: {round(time.time() - t0, 1)} indexing {len(buses["TIME"].values)} resampled GPS observations near stops')
 
     # datetime not normally needed for computation, but useful for debugging
     #buses['DATE_TIME'] = buses.TIME.apply(lambda t: datetime.fromtimestamp(t, tz))
 
     possible_arrivals_arr = []
 
-    # add distance from each observation to each valid stop along this route
-    # in a column named DIST_{stop_id} ... assumes there are not too many stops
-    # that we run out of memory
-    def compute_distances_to_all_stops():
-        lat_values = buses['LAT'].values
-        lon_values = buses['LON'].values
+    # only compute distances from each observation to stops within max_radius meters,
+    # stored sparsely instead of adding a DIST_{stop_id} column to buses for every stop
+    # (which uses a lot of memory for long routes)
+    max_radius = 200
 
-        for stop_id in route_config.get_stop_ids():
-            stop_info = route_config.get_stop_info(stop_id)
-            stop_direction_ids = route_config.get_directions_for_stop(stop_id)
-            if len(stop_direction_ids) > 0:
-                # calculate distances fast with haversine function
-                buses[f'DIST_{stop_id}'] = util.haver_distance(stop_info.lat, stop_info.lon, lat_values, lon_values)
-
-    compute_distances_to_all_stops()
+    stop_distances = StopDistances(buses, route_config, max_radius)
 
     print(f'{route_id}: {round(time.time() - t0, 1)} computing possible arrivals')
 
@@ -184,60 +274,25 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
 
         # exclude times of day when bus is not making stops in this direction
         # (e.g. commuter express routes that only serve one direction in the morning/afternoon)
-        valid_buses = buses
+        valid_values = None
         for start_time_str, end_time_str in get_invalid_direction_times(agency, route_config, direction_id):
+            if valid_values is None:
+                valid_values = np.full(len(buses), True)
             if start_time_str is not None:
                 invalid_start_timestamp = util.get_localized_datetime(d, start_time_str, tz).timestamp()
                 print(f"excluding buses after {invalid_start_timestamp} ({start_time_str}) for direction {direction_id}")
-                valid_buses = valid_buses[valid_buses['TIME'] < invalid_start_timestamp]
+                valid_values &= buses['TIME'].values < invalid_start_timestamp
             if end_time_str is not None:
                 invalid_end_timestamp = util.get_localized_datetime(d, end_time_str, tz).timestamp()
                 print(f"excluding buses before {invalid_end_timestamp} ({end_time_str}) for direction {direction_id}")
-                valid_buses = valid_buses[valid_buses['TIME'] >= invalid_end_timestamp]
-
-        dir_stops = dir_info.get_stop_ids()
-        num_dir_stops = len(dir_stops)
-        is_loop = dir_info.is_loop()
+                valid_values &= buses['TIME'].values >= invalid_end_timestamp
 
-        for stop_index, stop_id in enumerate(dir_stops):
-            stop_info = route_config.get_stop_info(stop_id)
-
-            is_terminal = False
-            radius = 200
-            adjacent_stop_ids = []
-
-            is_terminal = (stop_index == 0) or (stop_index == num_dir_stops - 1)
-
-            if is_loop:
-                adjacent_stop_ids.append(dir_stops[(stop_index + num_dir_stops - 1) % num_dir_stops])
-                adjacent_stop_ids.append(dir_stops[(stop_index + 1) % num_dir_stops])
-            else:
-                if stop_index > 0:
-                    adjacent_stop_ids.append(dir_stops[stop_index - 1])
-                if stop_index < num_dir_stops - 1:
-                    adjacent_stop_ids.append(dir_stops[stop_index + 1])
-
-            for adjacent_stop_id in adjacent_stop_ids:
-                adjacent_stop_info = route_config.get_stop_info(adjacent_stop_id)
-
-                # set radius to be no larger than the distance to the previous/next stop.
-                # this helps avoid odd results near the terminals of certain routes
-                distance_to_adjacent_stop = util.haver_distance(stop_info.lat, stop_info.lon, adjacent_stop_info.lat, adjacent_stop_info.lon)
-                radius = min(radius, round(distance_to_adjacent_stop))
-
-            #dirs_text = [f'{d}[{i}]' for d, i in zip(stop_direction_ids, stop_indexes)]
-            #print(f"{route_id}: {round(time.time() - t0, 1)} computing arrivals at stop {stop_id} {','.join(dirs_text)}  radius {radius} m  {'(terminal)' if is_terminal else ''}")
-
-            possible_arrivals = get_possible_arrivals_for_stop(valid_buses, stop_id,
-                direction_id=direction_id,
-                stop_index=stop_index,
-                adjacent_stop_ids=adjacent_stop_ids,
-                radius=radius,
-                is_terminal=is_terminal,
-                use_reported_direction=False
-            )
+        possible_arrivals = get_possible_arrivals_for_direction(buses, stop_distances, dir_info,
+            max_radius=max_radius,
+            valid_values=valid_values
+        )
 
-            possible_arrivals_arr.append(possible_arrivals)
+        possible_arrivals_arr.append(possible_arrivals)
 
     def concat_possible_arrivals():
         return pd.concat(possible_arrivals_arr, ignore_index=True)
@@ -257,13 +312,14 @@ def find_arrivals(agency: config.Agency, route_state: pd.DataFrame, route_config
 
     return arrivals
 
-def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_id: str,
+def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_distances: StopDistances, stop_id: str,
     direction_id=None,            # if use_reported_direction is False, the DID field will have this value
     use_reported_direction=False, # if use_reported_direction is True, the DID field will have the reported value from the buses frame
     stop_index=-1,                # STOP_INDEX field will be set to this value
     adjacent_stop_ids=[],
-    radius=200,
-    is_terminal=False
+    radius=200,                   # must not be larger than stop_distances.max_radius
+    is_terminal=False,
+    valid_values=None             # optional boolean array, only rows in buses where valid_values is True are considered
 ) -> pd.DataFrame:
 
     # the "possible" arrivals include times when the bus passes stops in the opposite direction,
@@ -283,19 +339,104 @@ def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_id: str,
     #   10% of SF muni stops are less than ~115m apart
     #   10% of SF muni stops are more than ~420m apart
 
-    dist_column = f'DIST_{stop_id}'
+    # row_values contains positions of rows in buses (in ascending order)
+    row_values, all_distance_values = stop_distances.get_nearby_rows(stop_id)
 
     def filter_by_radius_to_stop():
-        return buses[buses[dist_column] < radius] # meters
+        is_near_values = all_distance_values < radius # meters
+        if valid_values is not None:
+            is_near_values &= valid_values[row_values]
+        return row_values[is_near_values], all_distance_values[is_near_values]
 
-    eclipses = filter_by_radius_to_stop()
+    row_values, all_distance_values = filter_by_radius_to_stop()
 
     def filter_by_adjacent_stop_distance(adjacent_stop_id):
-        return eclipses[eclipses[dist_column] <= eclipses[f'DIST_{adjacent_stop_id}']]
+        is_closer_values = all_distance_values <= stop_distances.get_distances(adjacent_stop_id, row_values)
+        return row_values[is_closer_values], all_distance_values[is_closer_values]
 
     # require bus to be closer to this stop than to previous or next stop
     for adjacent_stop_id in adjacent_stop_ids:
-        eclipses = filter_by_adjacent_stop_distance(adjacent_stop_id)
+        row_values, all_distance_values = filter_by_adjacent_stop_distance(adjacent_stop_id)
+
+    return get_nadirs(buses, row_values, all_distance_values, np.zeros(len(row_values), dtype=np.int64),
+        stop_ids=[stop_id],
+        stop_indexes=[stop_index],
+        is_terminal_values=[is_terminal],
+        direction_id=direction_id,
+        use_reported_direction=use_reported_direction
+    )
+
+def get_possible_arrivals_for_direction(buses: pd.DataFrame, stop_distances: StopDistances, dir_info: routeconfig.DirectionInfo,
+    max_radius=200,               # must not be larger than stop_distances.max_radius
+    valid_values=None             # optional boolean array, only rows in buses where valid_values is True are considered
+) -> pd.DataFrame:
+    # Returns the possible arrivals at all stops in a direction, in the same order as calling
+    # get_possible_arrivals_for_stop for each stop in the direction
+    # (with the radius and adjacent stops for each stop from dir_info.get_stop_arrays()).
+    #
+    # Instead of filtering the nearby rows for one stop at a time, the nearby rows for all stops
+    # are concatenated so that the filters and nadirs are computed for all stops at once.
+
+    stop_arrays = dir_info.get_stop_arrays()
+    stop_ids = stop_arrays.stop_ids
+    num_stops = len(stop_ids)
+
+    if num_stops == 0:
+        return make_arrivals_frame([])
+
+    nearby_rows = [stop_distances.get_nearby_rows(stop_id) for stop_id in stop_ids]
+
+    # row_values contains positions of rows in buses (in ascending order for each stop),
+    # stop_position_values contains the index of the stop in the direction for each row
+    row_values = np.concatenate([stop_row_values for stop_row_values, _ in nearby_rows])
+    all_distance_values = np.concatenate([stop_distance_values for _, stop_distance_values in nearby_rows])
+    stop_position_values = np.repeat(np.arange(num_stops), [len(stop_row_values) for stop_row_values, _ in nearby_rows])
+
+    def filter_rows(keep_values):
+        return row_values[keep_values], all_distance_values[keep_values], stop_position_values[keep_values]
+
+    # the radius around each stop is no larger than the distance to the previous/next stop
+    is_near_values = all_distance_values < stop_arrays.get_radius_values(max_radius)[stop_position_values]
+    if valid_values is not None:
+        is_near_values &= valid_values[row_values]
+
+    row_values, all_distance_values, stop_position_values = filter_rows(is_near_values)
+
+    # require bus to be closer to this stop than to previous or next stop
+    for adjacent_index_values in [stop_arrays.prev_index_values, stop_arrays.next_index_values]:
+        row_adjacent_index_values = adjacent_index_values[stop_position_values]
+        has_adjacent_values = row_adjacent_index_values >= 0
+
+        is_closer_values = np.full(len(row_values), True)
+        is_closer_values[has_adjacent_values] = all_distance_values[has_adjacent_values] <= stop_distances.get_distances_to_points(
+            stop_arrays.lat_values[row_adjacent_index_values[has_adjacent_values]],
+            stop_arrays.lon_values[row_adjacent_index_values[has_adjacent_values]],
+            row_values[has_adjacent_values]
+        )
+
+        row_values, all_distance_values, stop_position_values = filter_rows(is_closer_values)
+
+    return get_nadirs(buses, row_values, all_distance_values, stop_position_values,
+        stop_ids=stop_ids,
+        stop_indexes=np.arange(num_stops),
+        is_terminal_values=stop_arrays.is_terminal_values,
+        direction_id=dir_info.id
+    )
+
+def get_nadirs(buses: pd.DataFrame, row_values, all_distance_values, stop_position_values,
+    stop_ids,                     # stop_ids[stop_position_values[i]] is the stop near row i
+    stop_indexes,                 # STOP_INDEX field for each stop in stop_ids
+    is_terminal_values,           # whether each stop in stop_ids is a terminal
+    direction_id=None,
+    use_reported_direction=False
+) -> pd.DataFrame:
+
+    # Finds the closest approach of a bus to a stop (the "nadir") each time it passes near the stop (an "eclipse"),
+    # returning a data frame with one possible arrival per eclipse.
+    #
+    # row_values contains the positions of rows in buses near each stop, and all_distance_values contains
+    # the distance from each row to the stop. Rows must be grouped by stop (via stop_position_values),
+    # and in ascending order for each stop.
 
     # allow grouping rows by each time a bus leaves vicinity of stop.
     # if any rows were dropped by the filters above,
@@ -304,109 +445,143 @@ def get_possible_arrivals_for_stop(buses: pd.DataFrame, stop_id: str,
     # and have consecutive index values. there must also be a row
     # that is always filtered out between each bus
 
-    row_index_values = eclipses.index.values
+    row_index_values = buses.index.values[row_values]
 
     num_rows = len(row_index_values)
     if num_rows == 0:
         return make_arrivals_frame([])
 
-    eclipse_start_values = np.diff(row_index_values, prepend=-999999) > 1
+    eclipse_start_values = (np.diff(row_index_values, prepend=-999999) > 1) | (np.diff(stop_position_values, prepend=-1) != 0)
     eclipse_start_indexes = np.nonzero(eclipse_start_values)[0]
-    eclipse_end_indexes = np.r_[eclipse_start_indexes[1:], num_rows]
 
-    all_distance_values = eclipses[dist_column].values
-    all_time_values = eclipses['TIME'].values
-    all_vid_values = eclipses['VID'].values
-    all_obs_group_values = eclipses['OBS_GROUP'].values
+    # index of the eclipse containing each row
+    eclipse_values = np.cumsum(eclipse_start_values) - 1
 
-    if use_reported_direction:
-        all_did_values = eclipses['DID'].values
+    eclipse_row_values = row_values[eclipse_start_indexes]
+    eclipse_stop_position_values = stop_position_values[eclipse_start_indexes]
 
-    def calc_nadir(eclipse_start_index, eclipse_end_index) -> tuple:
-        # this is called in the inner loop so it needs to be very fast
-        # or computing arrival times will take much longer!
+    min_dist_values = np.minimum.reduceat(all_distance_values, eclipse_start_indexes)
 
-        distance_values = all_distance_values[eclipse_start_index:eclipse_end_index]
+    # consider the bus to be "at" the stop whenever it is within some distance
+    # of its closest approach to the stop (within 200m).
+    # use larger fudge factor at a terminal where a bus might wait for a long time
+    # somewhere slightly before the stop, then start moving again toward the stop when it is
+    # ready to go in the opposite direction. without the fudge factor, the arrival time would
+    # be calculated after the long wait.
+    max_at_stop_dist_values = np.where(
+        np.asarray(is_terminal_values)[eclipse_stop_position_values],
+        min_dist_values + 75,
+        min_dist_values + 25
+    )
 
-        min_dist = np.min(distance_values)
+    is_at_stop_values = all_distance_values <= max_at_stop_dist_values[eclipse_values]
 
-        # consider the bus to be "at" the stop whenever it is within some distance
-        # of its closest approach to the stop (within 200m).
-        # use larger fudge factor at a terminal where a bus might wait for a long time
-        # somewhere slightly before the stop, then start moving again toward the stop when it is
-        # ready to go in the opposite direction. without the fudge factor, the arrival time would
-        # be calculated after the long wait.
+    # the first row where the bus is considered 'at' the stop is the arrival time,
+    # and the last row is the departure time
+    index_values = np.arange(num_rows)
+    arrival_indexes = np.minimum.reduceat(np.where(is_at_stop_values, index_values, num_rows), eclipse_start_indexes)
+    departure_indexes = np.maximum.reduceat(np.where(is_at_stop_values, index_values, -1), eclipse_start_indexes)
 
-        # at_stop_indexes is an array of indexes into distance_values
-        # where the bus is considered 'at' the stop.
-        # element 0 is the index of the arrival time
-        # element -1 is the index of the departure time
-        at_stop_indexes = np.nonzero(
-            distance_values <= ((min_dist + 75) if is_terminal else (min_dist + 25))
-        )[0]
+    time_values = buses['TIME'].values
 
-        time_values = all_time_values[eclipse_start_index:eclipse_end_index]
+    num_eclipses = len(eclipse_start_indexes)
 
-        return (
-            all_vid_values[eclipse_start_index],
-            time_values[at_stop_indexes[0]], # arrival time
-            time_values[at_stop_indexes[-1]], # departure time
-            min_dist,
-            stop_id,
-            all_did_values[eclipse_start_index] if use_reported_direction else direction_id,
-            stop_index,
-            all_obs_group_values[eclipse_start_index],
-            -1
-        )
+    return pd.DataFrame({
+        'VID': buses['VID'].values[eclipse_row_values],
+        'TIME': time_values[row_values[arrival_indexes]],
+        'DEPARTURE_TIME': time_values[row_values[departure_indexes]],
+        'DIST': min_dist_values,
+        'SID': np.array(stop_ids, dtype=object)[eclipse_stop_position_values],
+        'DID': buses['DID'].values[eclipse_row_values] if use_reported_direction else np.full(num_eclipses, direction_id, dtype=object),
+        'STOP_INDEX': np.asarray(stop_indexes, dtype=np.int64)[eclipse_stop_position_values],
+        'OBS_GROUP': buses['OBS_GROUP'].values[eclipse_row_values],
+        'TRIP': np.full(num_eclipses, -1, dtype=np.int64),
+    }, columns=ArrivalsColumns)
 
-    return make_arrivals_frame([
-        calc_nadir(eclipse_start_index, eclipse_end_index)
-        for eclipse_start_index, eclipse_end_index in zip(eclipse_start_indexes, eclipse_end_indexes)
-    ])
+ArrivalsColumns = [
+    'VID','TIME','DEPARTURE_TIME','DIST',
+    'SID','DID','STOP_INDEX','OBS_GROUP','TRIP'
+]
 
 def make_arrivals_frame(rows: list) -> pd.DataFrame:
-    return pd.DataFrame(rows, columns=[
-        'VID','TIME','DEPARTURE_TIME','DIST',
-        'SID','DID','STOP_INDEX','OBS_GROUP','TRIP'
-    ])
-
-def clean_arrivals(possible_arrivals: pd.DataFrame, buses: pd.DataFrame, route_config: routeconfig.RouteConfig) -> tuple:
-    def make_buses_map():
-        return {vid: bus for vid, bus in buses.groupby('VID')}
-        '''
-        vid_values = buses['VID'].values
-        prev_vid_values = np.hstack(('', vid_values[:-1]))
-        start_values = vid_values != prev_vid_values
-        start_indexes = np.nonzero(start_values)[0]
-        end_indexes = np.r_[start_indexes[1:], len(vid_values)]
+    return pd.DataFrame(rows, columns=ArrivalsColumns)
+
+def get_group_bounds(key_values_list: list) -> tuple:
+    # Given a list of arrays of the same length where rows with the same keys are adjacent,
+    # returns a tuple (start indexes, end indexes) of each group of rows with the same keys.
+    num_rows = len(key_values_list[0])
+    if num_rows == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    start_values = np.full(num_rows, False)
+    start_values[0] = True
+    for key_values in key_values_list:
+        start_values[1:] |= key_values[1:] != key_values[:-1]
+
+    start_indexes = np.nonzero(start_values)[0]
+    end_indexes = np.r_[start_indexes[1:], num_rows]
+
+    return start_indexes, end_indexes
+
+def clean_arrivals(possible_arrivals: pd.DataFrame, buses: pd.DataFrame, route_config: routeconfig.RouteConfig) -> pd.DataFrame:
+    # Groups the possible arrivals by vehicle, direction, and observation group, and
+    # returns a data frame with the arrivals in each group that form trips with ascending stop indexes
+    # (plus missing arrivals found in small gaps between stops), sorted by arrival time.
+    #
+    # To avoid the overhead of creating lots of small data frames, the rows in each group are found
+    # by sorting arrays of the group keys, and the result is created with a single data frame at the end.
+
+    def get_bus_rows_map():
+        # returns a map of vehicle ID => array of row indexes in the buses data frame for that vehicle, in the original order
+        vid_codes, vids = pd.factorize(buses['VID'].values)
+        bus_order = np.argsort(vid_codes, kind='mergesort')
+        start_indexes, end_indexes = get_group_bounds([vid_codes[bus_order]])
 
         return {
-            vid_values[start_index]: buses.iloc[start_index:end_index]
+            vids[vid_codes[bus_order[start_index]]]: bus_order[start_index:end_index]
                 for start_index, end_index in zip(start_indexes, end_indexes)
         }
-        '''
 
-    buses_map = make_buses_map()
+    bus_rows_map = get_bus_rows_map()
+
+    num_possible_arrivals = len(possible_arrivals)
+
+    # sort the possible arrivals by time, then by vehicle, direction, and observation group
+    # (stable, so the possible arrivals in each group are still sorted by time)
+    time_order = np.argsort(possible_arrivals['TIME'].values, kind='quicksort')
+
+    vid_codes = pd.factorize(possible_arrivals['VID'].values[time_order], sort=True)[0]
+    did_codes = pd.factorize(possible_arrivals['DID'].values[time_order], sort=True)[0]
+    obs_group_values = possible_arrivals['OBS_GROUP'].values[time_order]
 
-    possible_arrivals = possible_arrivals.sort_values('TIME')
+    group_order = np.lexsort((obs_group_values, did_codes, vid_codes))
+    vid_codes = vid_codes[group_order]
+    did_codes = did_codes[group_order]
+    obs_group_values = obs_group_values[group_order]
+
+    possible_row_values = time_order[group_order]
+
+    vid_values = possible_arrivals['VID'].values[possible_row_values]
+    did_values = possible_arrivals['DID'].values[possible_row_values]
+    stop_index_values = possible_arrivals['STOP_INDEX'].values[possible_row_values]
+    time_values = possible_arrivals['TIME'].values[possible_row_values]
+    departure_time_values = possible_arrivals['DEPARTURE_TIME'].values[possible_row_values]
+    dist_values = possible_arrivals['DIST'].values[possible_row_values]
 
     start_trip = 0
 
-    '''
-    arrival_time_diffs = []
-    trip_times = []
-    '''
+    # row indexes of the arrivals in the data frame containing the possible arrivals followed by gap_arrivals
+    row_values_arr = []
+    trip_values_arr = []
+    gap_arrivals = []
 
-    def get_arrivals_for_vehicle_direction(
-        dir_arrivals: pd.DataFrame,
-        vehicle_id: str,
-        direction_id: str,
-        obs_group: int,
-        bus: pd.DataFrame,
-        route_config: routeconfig.RouteConfig
-    ) -> pd.DataFrame:
+    for start_index, end_index in zip(*get_group_bounds([vid_codes, did_codes, obs_group_values])):
+        if end_index - start_index < 2:
+            continue
 
-        nonlocal start_trip
+        vehicle_id = vid_values[start_index]
+        direction_id = did_values[start_index]
+        obs_group = obs_group_values[start_index]
 
         debug = False #vehicle_id == 'S005' and direction_id == '0' # and obs_group == 1
 
@@ -415,58 +590,135 @@ def clean_arrivals(possible_arrivals: pd.DataFrame, buses: pd.DataFrame, route_c
 
         dir_info = route_config.get_direction_info(direction_id)
 
-        dir_arrivals, start_trip = get_arrivals_with_ascending_stop_index(dir_arrivals, dir_info, start_trip, debug=debug)
-        dir_arrivals = add_missing_arrivals_for_vehicle_direction(dir_arrivals, vehicle_id, direction_id, bus, route_config)
+        row_indexes, trip_ids, start_trip = get_ascending_stop_index_rows(
+            stop_index_values[start_index:end_index],
+            time_values[start_index:end_index],
+            departure_time_values[start_index:end_index],
+            dist_values[start_index:end_index],
+            dir_info,
+            start_trip,
+            debug=debug
+        )
 
-        return dir_arrivals
+        row_indexes = np.array(row_indexes, dtype=np.int64) + start_index
+        trip_values = np.array(trip_ids, dtype=np.int64)
+        row_values = possible_row_values[row_indexes]
+
+        missing_arrivals = get_missing_arrivals_for_vehicle_direction(
+            stop_index_values[row_indexes],
+            time_values[row_indexes],
+            departure_time_values[row_indexes],
+            direction_id,
+            buses,
+            bus_rows_map[vehicle_id],
+            route_config
+        )
 
-    arrivals = pd.concat([
-        get_arrivals_for_vehicle_direction(dir_arrivals, vehicle_id, direction_id, obs_group, buses_map[vehicle_id], route_config)
-            for (vehicle_id, direction_id, obs_group), dir_arrivals in possible_arrivals.groupby(['VID', 'DID', 'OBS_GROUP'])
-    ])
+        if len(missing_arrivals) > 0:
+            missing_indexes = [i for i, gap_arrival in missing_arrivals]
+            gap_row_values = num_possible_arrivals + len(gap_arrivals) + np.arange(len(missing_arrivals))
 
-    '''
-    if len(arrival_time_diffs) > 0:
-        arrival_time_diffs = np.concatenate(arrival_time_diffs)
-        diff_quantiles = np.quantile(arrival_time_diffs, [0.5, 0.9, 1])
+            row_values = np.insert(row_values, missing_indexes, gap_row_values)
+            trip_values = np.insert(trip_values, missing_indexes, trip_values[missing_indexes])
 
-        print(f' arrival time diffs median={diff_quantiles[0]} 90%={diff_quantiles[1]} max={diff_quantiles[2]}')
+            gap_arrivals.extend(gap_arrival for i, gap_arrival in missing_arrivals)
 
-        trip_times = np.concatenate(trip_times)
-        diff_quantiles = np.quantile(trip_times, [0.5, 0.9, 1])
+        row_values_arr.append(row_values)
+        trip_values_arr.append(trip_values)
 
-        print(f' adjacent stop times median={diff_quantiles[0]} 90%={diff_quantiles[1]} max={diff_quantiles[2]}')
-    '''
+    if len(row_values_arr) == 0:
+        return make_arrivals_frame([])
+
+    if len(gap_arrivals) > 0:
+        all_arrivals = pd.concat([possible_arrivals] + gap_arrivals, sort=False)
+    else:
+        all_arrivals = possible_arrivals
+
+    row_values = np.concatenate(row_values_arr)
+    trip_values = np.concatenate(trip_values_arr)
+
+    # stable sort, so arrivals at the same time are ordered by vehicle, direction, and trip
+    arrival_order = np.argsort(all_arrivals['TIME'].values[row_values], kind='mergesort')
+
+    arrivals = all_arrivals.iloc[row_values[arrival_order]].copy()
+    arrivals['TRIP'] = trip_values[arrival_order]
+
+    return arrivals
+
+class StopSequenceNodes:
+    # storage for the rows in StopSequence objects created by one call of get_arrivals_with_ascending_stop_index.
+    #
+    # each node contains a row index and stop index, and the index of the previous node in the same sequence (or -1).
+    # since nodes are never modified after they are added, sequences can share nodes with the sequences they
+    # were copied from, so copying a sequence doesn't need to copy all of its rows.
 
-    return arrivals.sort_values('TIME')
+    def __init__(self):
+        self.row_indexes = []
+        self.stop_indexes = []
+        self.prev_nodes = []
+
+    def add(self, row_index, stop_index, prev_node) -> int:
+        self.row_indexes.append(row_index)
+        self.stop_indexes.append(stop_index)
+        self.prev_nodes.append(prev_node)
+        return len(self.prev_nodes) - 1
+
+    def get_values(self, last_node, values) -> list:
+        # returns values[node] for each node in the sequence ending with last_node, from first to last
+        result = []
+        prev_nodes = self.prev_nodes
+        node = last_node
+        while node >= 0:
+            result.append(values[node])
+            node = prev_nodes[node]
+        result.reverse()
+        return result
 
 class StopSequence:
     # helper used by get_arrivals_with_ascending_stop_index,
     # representing a possible subset of the rows in the dir_arrivals data frame
     # associated with one "trip".
 
-    def __init__(self):
+    def __init__(self, nodes: StopSequenceNodes):
+        self.nodes = nodes
+        self.last_node = -1
+        self.length = 0
+        self.last_row_index = None
         self.last_stop_index = None
         self.last_departure_time = None
         self.num_loops = 0
-        self.stop_indexes = []
-        self.row_indexes = []
 
     def append(self, row_index, stop_index, departure_time):
         if self.last_stop_index is not None and stop_index < self.last_stop_index:
             self.num_loops += 1
 
+        self.last_node = self.nodes.add(row_index, stop_index, self.last_node)
+        self.length += 1
+        self.last_row_index = row_index
         self.last_stop_index = stop_index
         self.last_departure_time = departure_time
-        self.stop_indexes.append(stop_index)
-        self.row_indexes.append(row_index)
+
+    def replace_last(self, row_index, departure_time):
+        # replaces the last row with another row at the same stop.
+        # the last node may be shared with other sequences, so this adds a new node instead of modifying it
+        nodes = self.nodes
+        self.last_node = nodes.add(row_index, nodes.stop_indexes[self.last_node], nodes.prev_nodes[self.last_node])
+        self.last_row_index = row_index
+        self.last_departure_time = departure_time
+
+    def get_row_indexes(self) -> list:
+        return self.nodes.get_values(self.last_node, self.nodes.row_indexes)
+
+    def get_stop_indexes(self) -> list:
+        return self.nodes.get_values(self.last_node, self.nodes.stop_indexes)
 
     def copy(self):
-        other = StopSequence()
+        other = StopSequence(self.nodes)
+        other.last_node = self.last_node
+        other.length = self.length
+        other.last_row_index = self.last_row_index
         other.last_stop_index = self.last_stop_index
         other.last_departure_time = self.last_departure_time
-        other.stop_indexes = self.stop_indexes.copy()
-        other.row_indexes = self.row_indexes.copy()
         other.num_loops = self.num_loops
         return other
 
@@ -475,7 +727,7 @@ def get_arrivals_with_ascending_stop_index(
     dir_info: routeconfig.DirectionInfo,
     start_trip: int,
     debug=False
-) -> pd.DataFrame:
+) -> tuple:
     # Given a data frame containing all "possible" arrivals
     # for one vehicle in one direction (sorted by arrival time),
     # returns a subset of rows in that data frame,
@@ -485,6 +737,50 @@ def get_arrivals_with_ascending_stop_index(
     # The 'TRIP' column in the returned data frame is set to the unique trip ID, starting
     # at `start_trip`.
     #
+    # Returns a tuple (data frame of arrivals, next unused trip ID).
+
+    if len(dir_arrivals) < 2:
+        return make_arrivals_frame([]), start_trip
+
+    if debug:
+        with pd.option_context("display.max_rows", None):
+            print(dir_arrivals)
+
+    row_indexes, trip_ids, next_trip = get_ascending_stop_index_rows(
+        dir_arrivals['STOP_INDEX'].values,
+        dir_arrivals['TIME'].values,
+        dir_arrivals['DEPARTURE_TIME'].values,
+        dir_arrivals['DIST'].values,
+        dir_info,
+        start_trip,
+        debug=debug
+    )
+
+    ascending_dir_arrivals = dir_arrivals.iloc[row_indexes].copy()
+
+    ascending_dir_arrivals['TRIP'] = trip_ids
+
+    if debug:
+        with pd.option_context("display.max_rows", None):
+            print(ascending_dir_arrivals)
+
+    return ascending_dir_arrivals, next_trip
+
+def get_ascending_stop_index_rows(
+    stop_index_values: np.ndarray,
+    arrival_time_values: np.ndarray,
+    departure_time_values: np.ndarray,
+    dist_values: np.ndarray,
+    dir_info: routeconfig.DirectionInfo,
+    start_trip: int,
+    debug=False
+) -> tuple:
+    # Given arrays with the STOP_INDEX, TIME, DEPARTURE_TIME, and DIST values of all "possible" arrivals
+    # for one vehicle in one direction (sorted by arrival time), finds the subset of rows
+    # used by get_arrivals_with_ascending_stop_index.
+    #
+    # Returns a tuple (list of row indexes, list of trip IDs for each row, next unused trip ID).
+    #
     # For routes with 2 directions, the given data frame of possible arrivals contains
     # arrivals for stops in both directions. However, the stop_index values will typically be decreasing
     # over time for stops that are not in the direction that the vehicle is actually traveling.
@@ -509,22 +805,13 @@ def get_arrivals_with_ascending_stop_index(
     # After it finds the end of a trip, it resets the possible sequences and continues processing
     # possible arrivals where the previous sequence ended.
 
-    stop_index_values = dir_arrivals['STOP_INDEX'].values
+    # the loop below accesses one row at a time, which is much faster with lists than numpy arrays
+    stop_index_values = stop_index_values.tolist()
+    arrival_time_values = arrival_time_values.tolist()
+    departure_time_values = departure_time_values.tolist()
+    dist_values = dist_values.tolist()
 
     num_arrivals = len(stop_index_values)
-    if num_arrivals < 2:
-        return make_arrivals_frame([]), start_trip
-
-    arrival_time_values = dir_arrivals['TIME'].values
-    departure_time_values = dir_arrivals['DEPARTURE_TIME'].values
-    dist_values = dir_arrivals['DIST'].values
-
-    if debug:
-        #dir_arrivals = dir_arrivals.copy()
-        #dir_arrivals['ROW_INDEX'] = np.arange(0, num_arrivals)
-
-        with pd.option_context("display.max_rows", None):
-            print(dir_arrivals)
 
     next_sequence_key = None
     possible_sequences = None
@@ -535,7 +822,7 @@ def get_arrivals_with_ascending_stop_index(
         nonlocal possible_sequences, next_sequence_key
 
         possible_sequences = {
-            0: StopSequence()
+            0: StopSequence(StopSequenceNodes())
         }
         next_sequence_key = 1
 
@@ -545,7 +832,7 @@ def get_arrivals_with_ascending_stop_index(
 
     def print_sequences():
         for sequence_key, sequence in possible_sequences.items():
-            print(f'{sequence_key}: {sequence.stop_indexes} {sequence.row_indexes}{f" ({sequence.num_loops} loops)" if is_loop else ""}')
+            print(f'{sequence_key}: {sequence.get_stop_indexes()} {sequence.get_row_indexes()}{f" ({sequence.num_loops} loops)" if is_loop else ""}')
         print('-')
 
     all_row_indexes = []
@@ -568,29 +855,29 @@ def get_arrivals_with_ascending_stop_index(
         longest_sequence = None
         for sequence in possible_sequences.values():
             if longest_sequence is None:
-                if len(sequence.row_indexes) > 0:
+                if sequence.length > 0:
                     longest_sequence = sequence
             else:
-                len_diff = len(sequence.row_indexes) - len(longest_sequence.row_indexes)
+                len_diff = sequence.length - longest_sequence.length
 
                 # if multiple possible sequences have the same number of stops, choose the one that finishes first
-                if len_diff > 0 or (len_diff == 0 and sequence.row_indexes[-1] < longest_sequence.row_indexes[-1]):
+                if len_diff > 0 or (len_diff == 0 and sequence.last_row_index < longest_sequence.last_row_index):
                     longest_sequence = sequence
 
         num_non_ascending_stop_indexes = 0
 
         if longest_sequence is not None:
 
-            if len(longest_sequence.row_indexes) >= min_trip_length:
+            if longest_sequence.length >= min_trip_length:
 
-                trip_row_indexes = longest_sequence.row_indexes
+                trip_row_indexes = longest_sequence.get_row_indexes()
 
                 trip_len = len(trip_row_indexes)
 
                 if debug:
                     print(f'trip {next_trip}:')
-                    print(f'{longest_sequence.stop_indexes}')
-                    print(f'{longest_sequence.row_indexes}')
+                    print(f'{longest_sequence.get_stop_indexes()}')
+                    print(f'{trip_row_indexes}')
                     print('---')
 
                 all_row_indexes.extend(trip_row_indexes)
@@ -603,7 +890,7 @@ def get_arrivals_with_ascending_stop_index(
             # loop may have continued a few rows past the end of the longest sequence.
             # in this case we back up the loop so it doesn't skip any rows
             # (row_index will be incremented once after this)
-            row_index = longest_sequence.row_indexes[-1]
+            row_index = longest_sequence.last_row_index
 
             reset_possible_sequences()
 
@@ -662,10 +949,8 @@ def get_arrivals_with_ascending_stop_index(
                 elif index_diff == 0:
                     # If there are two consecutive arrivals for the same vehicle at the same stop,
                     # use the arrival with the smaller distance.
-                    last_row_index = sequence.row_indexes[-1]
-                    if dist_values[row_index] < dist_values[last_row_index]:
-                        sequence.row_indexes[-1] = row_index
-                        sequence.last_departure_time = departure_time
+                    if dist_values[row_index] < dist_values[sequence.last_row_index]:
+                        sequence.replace_last(row_index, departure_time)
                         updated_sequences = True
                         if debug:
                             print(f"stop_index = {stop_index} dist[{row_index}] = {dist_values[row_index]}")
@@ -717,7 +1002,7 @@ def get_arrivals_with_ascending_stop_index(
 
                 longest_sequence_len = 0
                 for sequence in possible_sequences.values():
-                    sequence_len = len(sequence.row_indexes)
+                    sequence_len = sequence.length
                     if sequence_len > longest_sequence_len:
                         longest_sequence_len = sequence_len
 
@@ -751,13 +1036,14 @@ def get_arrivals_with_ascending_stop_index(
                 # The sequence [] is kept because we might see 0,1,2,3,4,5 in the future.
 
                 smallest_last_index_keys_by_length = {}
+                smallest_total_stops_by_length = {}
 
                 # as a heuristic to avoid losing long but incomplete sequences (e.g. missing stop index 0),
                 # avoid creating new sequences that are much shorter than the best sequence
                 min_sequence_len = max(0, longest_sequence_len - 3)
 
                 for sequence_key, sequence in possible_sequences.items():
-                    sequence_len = len(sequence.row_indexes)
+                    sequence_len = sequence.length
 
                     if sequence_len < min_sequence_len:
                         continue
@@ -770,22 +1056,17 @@ def get_arrivals_with_ascending_stop_index(
                     if sequence_len == 0:
                         smallest_last_index_keys_by_length[sequence_len] = sequence_key
                     else:
+                        # For loop routes, different sequences may contain a different number of loops.
+                        # In this case, the one with the smallest last_stop_index for a particular length
+                        # isn't necessarily the best one, since it may contain more loops than another sequence.
+                        # To handle this case, add the total number of stops in each loop for each sequence.
+                        total_stops = num_stops * sequence.num_loops + last_stop_index
+
                         for seq_len in range(min_sequence_len, sequence_len+1):
-                            if seq_len not in smallest_last_index_keys_by_length:
+                            if seq_len not in smallest_last_index_keys_by_length \
+                                    or total_stops < smallest_total_stops_by_length[seq_len]:
                                 smallest_last_index_keys_by_length[seq_len] = sequence_key
-                            else:
-                                smallest_last_index_key = smallest_last_index_keys_by_length[seq_len]
-                                best_sequence = possible_sequences[smallest_last_index_key]
-
-                                # For loop routes, different sequences may contain a different number of loops.
-                                # In this case, the one with the smallest last_stop_index for a particular length
-                                # isn't necessarily the best one, since it may contain more loops than another sequence.
-                                # To handle this case, add the total number of stops in each loop for each sequence.
-                                total_stops = num_stops * sequence.num_loops + last_stop_index
-                                best_total_stops = num_stops * best_sequence.num_loops + best_sequence.last_stop_index
-
-                                if total_stops < best_total_stops:
-                                    smallest_last_index_keys_by_length[seq_len] = sequence_key
+                                smallest_total_stops_by_length[seq_len] = total_stops
 
                 unneded_sequence_keys = set(possible_sequences.keys()) - set(smallest_last_index_keys_by_length.values())
 
@@ -819,36 +1100,33 @@ def get_arrivals_with_ascending_stop_index(
 
     finish_trip()
 
-    ascending_dir_arrivals = dir_arrivals.iloc[all_row_indexes].copy()
-
-    ascending_dir_arrivals['TRIP'] = trip_ids
-
-    if debug:
-        with pd.option_context("display.max_rows", None):
-            print(ascending_dir_arrivals)
+    return all_row_indexes, trip_ids, next_trip
 
-    return ascending_dir_arrivals, next_trip
-
-def add_missing_arrivals_for_vehicle_direction(
-    dir_arrivals: pd.DataFrame,
-    vehicle_id: str,
+def get_missing_arrivals_for_vehicle_direction(
+    stop_index_values: np.ndarray,
+    time_values: np.ndarray,
+    departure_time_values: np.ndarray,
     direction_id: str,
-    bus: pd.DataFrame,
+    buses: pd.DataFrame,
+    bus_row_values: np.ndarray,
     route_config: routeconfig.RouteConfig
-) -> pd.DataFrame:
+) -> list:
 
     # If there is a small gap in STOP_INDEX, try looking for the missing stops
     # between the last departure time and the next arrival time. Maybe the radius
     # was too small or we never saw it closer to that stop than the prev/next stop.
-
-    stop_index = dir_arrivals['STOP_INDEX']
-
-    stop_index_values = stop_index.values
+    #
+    # The arrays contain the arrivals for one vehicle in one direction (in the order returned by
+    # get_ascending_stop_index_rows), and bus_row_values contains the row indexes of the buses data frame
+    # for the same vehicle.
+    #
+    # Returns a list of tuples (row index, data frame with one arrival) for each missing arrival,
+    # where the missing arrival belongs before that row index.
 
     num_arrivals = len(stop_index_values)
 
     if num_arrivals < 1:
-        return make_arrivals_frame([])
+        return []
 
     prev_stop_index_values = np.r_[999999, stop_index_values[:-1]]
 
@@ -857,11 +1135,10 @@ def add_missing_arrivals_for_vehicle_direction(
     gaps_values = stop_index_diff_values > 1
 
     if not np.any(gaps_values):
-        return dir_arrivals
+        return []
 
     # only fix gaps of 1 or 2 stops, with less than a few minutes gap
-    prev_departure_time_values = np.r_[0, dir_arrivals['DEPARTURE_TIME'].values[:-1]]
-    time_values = dir_arrivals['TIME'].values
+    prev_departure_time_values = np.r_[0, departure_time_values[:-1]]
 
     gap_time_values = time_values - prev_departure_time_values
 
@@ -877,23 +1154,16 @@ def add_missing_arrivals_for_vehicle_direction(
     )
 
     if not np.any(fixable_gaps_values):
-        return dir_arrivals
+        return []
 
     dir_info = route_config.get_direction_info(direction_id)
     dir_stops = dir_info.get_stop_ids()
 
-    all_arrivals = [dir_arrivals]
-
-    row_index_after_prev_gap_arrival = 0
-    num_gap_arrivals = 0
-    new_row_indexes = []
+    missing_arrivals = []
 
     fixable_gap_indexes = np.nonzero(fixable_gaps_values)[0]
 
-    all_time_values = bus['TIME'].values
-    num_all_time_values = len(all_time_values)
-
-    trip_values = dir_arrivals['TRIP'].values
+    all_time_values = buses['TIME'].values[bus_row_values]
 
     for i in fixable_gap_indexes:
         next_arrival_time = time_values[i]
@@ -901,16 +1171,18 @@ def add_missing_arrivals_for_vehicle_direction(
 
         # get observations for this bus in times where we would expect to see it at the missing stops
         def find_gap_bus():
-            return bus[np.logical_and(
+            return buses.iloc[bus_row_values[np.logical_and(
                 (all_time_values < next_arrival_time),
                 (all_time_values > prev_departure_time)
-            )]
+            )]]
 
         gap_bus = find_gap_bus()
 
         if gap_bus.empty:
             continue
 
+        gap_stop_distances = StopDistances(gap_bus, route_config, max_radius=300)
+
         prev_stop_index = prev_stop_index_values[i]
         next_stop_index = stop_index_values[i]
 
@@ -921,7 +1193,7 @@ def add_missing_arrivals_for_vehicle_direction(
 
             # detect possible arrival with larger radius without requiring it to be closer to this stop than prev/next stop
             def find_gap_arrival():
-                return get_possible_arrivals_for_stop(gap_bus, gap_stop_id,
+                return get_possible_arrivals_for_stop(gap_bus, gap_stop_distances, gap_stop_id,
                     direction_id=direction_id,
                     stop_index=gap_stop_index,
                     radius=300
@@ -948,17 +1220,6 @@ def add_missing_arrivals_for_vehicle_direction(
 
             prev_gap_arrival_time = gap_arrival_times[0]
 
-            gap_arrival['TRIP'] = trip_values[i]
-
-            all_arrivals.append(gap_arrival)
-            new_row_indexes.extend(range(row_index_after_prev_gap_arrival, i))
-            new_row_indexes.append(num_arrivals + num_gap_arrivals)
-            row_index_after_prev_gap_arrival = i
-            num_gap_arrivals += 1
-
-    if len(all_arrivals) == 1:
-        return dir_arrivals
-
-    new_row_indexes.extend(range(row_index_after_prev_gap_arrival, num_arrivals))
+            missing_arrivals.append((i, gap_arrival))
 
-    return pd.concat(all_arrivals, sort=False).iloc[new_row_indexes]
+    return missing_arrivals
@@ -1,6 +1,10 @@
 import shapely
 import partridge as ptg
 import numpy as np
+import pandas as pd
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
 from pathlib import Path
 import requests
 import json
@@ -107,18 +111,43 @@ def contains_excluded_stop(shape_stop_ids, excluded_stop_ids):
             pass
     return False
 
+# GtfsScraper used by worker processes in GtfsScraper.save_routes when jobs > 1.
+# When worker processes are forked, they share the scraper (and its loaded GTFS feed) from the parent process.
+route_data_scraper = None
+
+def init_route_data_worker(agency_id):
+    # If worker processes are not forked (e.g. on Windows), each worker loads the GTFS feed once.
+    global route_data_scraper
+    if route_data_scraper is None:
+        route_data_scraper = GtfsScraper(config.get_agency(agency_id))
+
+def get_route_data_in_worker(route) -> tuple:
+    # runs in a separate process when using --jobs.
+    # returns the output and any errors added while getting the route data to the parent process
+    scraper = route_data_scraper
+    num_errors = len(scraper.errors)
+
+    output, route_data = util.call_with_captured_output(scraper.get_route_data, route)
+
+    return output, route_data, scraper.errors[num_errors:]
+
 class GtfsScraper:
-    def __init__(self, agency: config.Agency):
+    def __init__(self, agency: config.Agency, feed=None):
+        # feed is normally loaded from the agency's GTFS feed, but can be any object with
+        # the same data frame attributes as a partridge feed (e.g. for benchmarks)
         self.agency = agency
         self.agency_id = agency_id = agency.id
-        gtfs_cache_dir = f'{util.get_data_dir()}/gtfs-{agency_id}'
 
-        download_gtfs_data(agency, gtfs_cache_dir)
+        if feed is None:
+            gtfs_cache_dir = f'{util.get_data_dir()}/gtfs-{agency_id}'
+
+            download_gtfs_data(agency, gtfs_cache_dir)
 
-        self.feed = ptg.load_geo_feed(gtfs_cache_dir, {})
+            feed = ptg.load_geo_feed(gtfs_cache_dir, {})
+
+        self.feed = feed
 
         self.errors = []
-        self.stop_times_by_trip = None
         self.stops_df = None
         self.trips_df = None
         self.routes_df = None
@@ -127,26 +156,34 @@ class GtfsScraper:
         self.gtfs_stop_ids_map = None
         self.stops_map = None
 
-    def get_stop_row(self, stop_id):
-        # allows looking up row from stops.txt via OpenTransit stop ID
+    def get_stops_map(self):
         if self.stops_map is None:
             stop_id_gtfs_field = self.agency.stop_id_gtfs_field
             self.stops_map = {getattr(stop, stop_id_gtfs_field): stop for stop in self.get_gtfs_stops().itertuples()}
 
-        stop_row = self.stops_map.get(stop_id, None)
+        return self.stops_map
+
+    def get_stop_row(self, stop_id):
+        # allows looking up row from stops.txt via OpenTransit stop ID
+        stops_map = self.get_stops_map()
+
+        stop_row = stops_map.get(stop_id, None)
 
         if stop_row is None:
             stop_id, trip_occurrence = stop_id.split("-")
-            return self.stops_map[stop_id]
+            return stops_map[stop_id]
         else:
             return stop_row
 
-    def get_stop_row_by_gtfs_stop_id(self, gtfs_stop_id):
-        # allows looking up row from stops.txt via GTFS stop_id
+    def get_gtfs_stop_ids_map(self):
         if self.gtfs_stop_ids_map is None:
             self.gtfs_stop_ids_map = {stop.stop_id: stop for stop in self.get_gtfs_stops().itertuples()}
 
-        return self.gtfs_stop_ids_map[gtfs_stop_id]
+        return self.gtfs_stop_ids_map
+
+    def get_stop_row_by_gtfs_stop_id(self, gtfs_stop_id):
+        # allows looking up row from stops.txt via GTFS stop_id
+        return self.get_gtfs_stop_ids_map()[gtfs_stop_id]
 
     def get_gtfs_stops(self):
         if self.stops_df is None:
@@ -293,82 +330,38 @@ class GtfsScraper:
             print("No new dates in GTFS feed, skipping")
             return False
 
-        trips_df = self.get_gtfs_trips()
-
-        gtfs_route_id_map = {}
-
         route_configs = routeconfig.get_route_list(self.agency_id) # todo: use route config from parsing this GTFS file (will eventually be needed to process old GTFS feeds)
-        for route_config in route_configs:
-            gtfs_route_id_map[route_config.gtfs_route_id] = route_config
 
-        for gtfs_route_id, route_trips in trips_df.groupby('route_id'):
-            if gtfs_route_id not in gtfs_route_id_map:
-                continue
-
-            route_config = gtfs_route_id_map[gtfs_route_id]
-
-            arrivals_by_service_id = {}
-            trip_ids_map = {}
-
-            for service_id, service_route_trips in route_trips.groupby('service_id'):
-                arrivals_by_service_id[service_id] = self.get_scheduled_arrivals_by_service_id(service_id, route_config, service_route_trips, trip_ids_map)
-
-            for service_ids_json, d in first_date_for_service_ids_map.items():
-                service_ids = json.loads(service_ids_json)
-
-                # merge scheduled arrivals for all service_ids that are in service on the same date
-                merged_arrivals = {}
-
-                for service_id in service_ids:
-                    if service_id not in arrivals_by_service_id:
-                        continue
-
-                    service_id_arrivals = arrivals_by_service_id[service_id]
-
-                    for dir_id, direction_arrivals in service_id_arrivals.items():
-                        if dir_id not in merged_arrivals:
-                            merged_arrivals[dir_id] = {}
-
-                        direction_merged_arrivals = merged_arrivals[dir_id]
-
-                        for stop_id, stop_arrivals in direction_arrivals.items():
-
-                            if stop_id not in direction_merged_arrivals:
-                                direction_merged_arrivals[stop_id] = []
-
-                            direction_merged_arrivals[stop_id] = sorted(direction_merged_arrivals[stop_id] + stop_arrivals, key=lambda arr: arr['t'])
-
-                date_key = str(d)
-
-                cache_path = timetables.get_cache_path(agency_id, route_config.id, date_key)
-                Path(cache_path).parent.mkdir(parents = True, exist_ok = True)
-
-                data_str = json.dumps({
-                    'version': timetables.DefaultVersion,
-                    'agency': agency_id,
-                    'route_id': route_config.id,
-                    'date_key' : date_key,
-                    'timezone_id': self.agency.timezone_id,
-                    'service_ids': service_ids,
-                    'arrivals': merged_arrivals,
-                }, separators=(',', ':'))
-
-                with open(cache_path, "w") as f:
-                    f.write(data_str)
-
-                if save_to_s3:
-                    s3_path = timetables.get_s3_path(agency_id, route_config.id, date_key)
-                    s3 = boto3.resource('s3')
-                    s3_bucket = config.s3_bucket
-                    print(f'saving to s3://{s3_bucket}/{s3_path}')
-                    object = s3.Object(s3_bucket, s3_path)
-                    object.put(
-                        Body=gzip.compress(bytes(data_str, 'utf-8')),
-                        CacheControl='max-age=86400',
-                        ContentType='application/json',
-                        ContentEncoding='gzip',
-                        ACL='public-read'
-                    )
+        for route_config, date_key, service_ids, merged_arrivals in self.get_timetables(route_configs, first_date_for_service_ids_map):
+            cache_path = timetables.get_cache_path(agency_id, route_config.id, date_key)
+            Path(cache_path).parent.mkdir(parents = True, exist_ok = True)
+
+            data_str = json.dumps({
+                'version': timetables.DefaultVersion,
+                'agency': agency_id,
+                'route_id': route_config.id,
+                'date_key' : date_key,
+                'timezone_id': self.agency.timezone_id,
+                'service_ids': service_ids,
+                'arrivals': merged_arrivals,
+            }, separators=(',', ':'))
+
+            with open(cache_path, "w") as f:
+                f.write(data_str)
+
+            if save_to_s3:
+                s3_path = timetables.get_s3_path(agency_id, route_config.id, date_key)
+                s3 = boto3.resource('s3')
+                s3_bucket = config.s3_bucket
+                print(f'saving to s3://{s3_bucket}/{s3_path}')
+                object = s3.Object(s3_bucket, s3_path)
+                object.put(
+                    Body=gzip.compress(bytes(data_str, 'utf-8')),
+                    CacheControl='max-age=86400',
+                    ContentType='application/json',
+                    ContentEncoding='gzip',
+                    ACL='public-read'
+                )
 
         # save date keys last, so that if an error occurs while saving timetables,
         # the timetables will be saved again even with skip_existing=True
@@ -419,82 +412,237 @@ class GtfsScraper:
 
         return possible_id
 
-    def get_scheduled_arrivals_by_service_id(self, service_id, route_config, service_route_trips, trip_ids_map):
+    def get_timetables(self, route_configs, first_date_for_service_ids_map):
+        # Generates a tuple (route_config, date_key, service_ids, arrivals) for each route and each unique set of service_ids,
+        # where arrivals is a dict { direction_id => { stop_id => [{ 't': arrival_time, 'i': trip_int, 'e': departure_time }] } }
+        # containing the scheduled arrivals for all service_ids in service on the same date, sorted by arrival time.
 
-        # returns dict { direction_id => { stop_id => { 't': arrival_time, 'i': trip_int, 'e': departure_time } } }
-        # where arrival_time and departure_time are the number of seconds after midnight,
-        # and trip_int is a unique integer for each trip (instead of storing GTFS trip ID strings directly)
+        gtfs_route_id_map = {}
+        for route_config in route_configs:
+            gtfs_route_id_map[route_config.gtfs_route_id] = route_config
 
-        agency = self.agency
-        agency_id = agency.id
+        stop_times_df = self.get_scheduled_stop_times()
 
-        route_id = route_config.id
+        route_id_values = stop_times_df['route_id'].values
+        route_start_indexes = np.flatnonzero(np.r_[True, route_id_values[1:] != route_id_values[:-1]])
+        route_end_indexes = np.r_[route_start_indexes[1:], len(route_id_values)]
 
-        next_trip_int = 1
-        if len(trip_ids_map) > 0:
-            next_trip_int = max(trip_ids_map.values()) + 1
+        for start_index, end_index in zip(route_start_indexes, route_end_indexes):
+            gtfs_route_id = route_id_values[start_index]
+            if gtfs_route_id not in gtfs_route_id_map:
+                continue
 
-        print(f'service={service_id} route={route_id} #trips={len(service_route_trips)}')
+            route_config = gtfs_route_id_map[gtfs_route_id]
 
-        arrivals_by_direction = {}
+            arrivals_by_service_id = self.get_scheduled_arrivals_by_service_id(route_config, stop_times_df.iloc[start_index:end_index])
 
-        gtfs_direction_id_map = {}
-        for dir_info in route_config.get_direction_infos():
-            gtfs_direction_id_map[dir_info.gtfs_direction_id] = dir_info
-            arrivals_by_direction[dir_info.id] = {}
+            sort_key = lambda arr: arr['t']
 
-        for route_trip in service_route_trips.itertuples():
-            trip_id = route_trip.trip_id
-            trip_stop_times = self.get_stop_times_for_trip(trip_id)
+            for service_ids_json, d in first_date_for_service_ids_map.items():
+                service_ids = json.loads(service_ids_json)
 
-            if trip_id not in trip_ids_map:
-                trip_ids_map[trip_id] = next_trip_int
-                next_trip_int += 1
+                # merge scheduled arrivals for all service_ids that are in service on the same date.
+                # the arrivals for each service_id are already sorted, which makes sorting the combined list fast
+                # (arrivals at the same time stay in the order of service_ids, since sorted is stable)
+                stop_arrivals_lists = {}
 
-            trip_int = trip_ids_map[trip_id]
+                for service_id in service_ids:
+                    if service_id not in arrivals_by_service_id:
+                        continue
 
-            gtfs_direction_id = route_trip.direction_id
+                    for dir_id, direction_arrivals in arrivals_by_service_id[service_id].items():
+                        direction_arrivals_lists = stop_arrivals_lists.setdefault(dir_id, {})
+                        for stop_id, stop_arrivals in direction_arrivals.items():
+                            direction_arrivals_lists.setdefault(stop_id, []).append(stop_arrivals)
+
+                merged_arrivals = {
+                    dir_id: {
+                        stop_id: arrivals_lists[0] if len(arrivals_lists) == 1 else sorted(itertools.chain.from_iterable(arrivals_lists), key=sort_key)
+                        for stop_id, arrivals_lists in direction_arrivals_lists.items()
+                    }
+                    for dir_id, direction_arrivals_lists in stop_arrivals_lists.items()
+                }
 
-            stop_ids = self.normalize_gtfs_stop_ids(trip_stop_times['stop_id'].values)
+                yield route_config, str(d), service_ids, merged_arrivals
 
-            if route_id in agency.custom_directions:
-                custom_directions_arr = agency.custom_directions[route_id]
-                custom_direction_id = self.get_custom_direction_id(custom_directions_arr, gtfs_direction_id, stop_ids)
-                if custom_direction_id is None:
-                    print(f"Unknown custom direction ID for trip {trip_id} ({gtfs_direction_id}, {stop_ids})")
-                    continue
+    def get_scheduled_stop_times(self):
+        # Joins stop_times.txt with trips.txt, returning a data frame with one row per stop time and columns
+        # route_id, service_id, trip_id, direction_id (GTFS direction ID), trip_int, stop_id (OpenTransit stop ID),
+        # arrival_time, and departure_time (number of seconds after midnight).
+        #
+        # Rows are ordered by route_id and service_id, then by the order of trips in trips.txt,
+        # then by the order of stop times for each trip in stop_times.txt.
+        #
+        # trip_int is a unique integer for each trip within a route (instead of storing GTFS trip ID strings directly)
 
-                print(f"Custom direction for route {route_id} trip {trip_id} = {custom_direction_id}")
-                dir_info = route_config.get_direction_info(custom_direction_id)
-            else:
-                dir_info = gtfs_direction_id_map[gtfs_direction_id]
+        trips_df = self.get_gtfs_trips()
+
+        route_codes, _ = pd.factorize(trips_df['route_id'].values, sort=True)
+        service_codes, _ = pd.factorize(trips_df['service_id'].values, sort=True)
+        trip_order = np.lexsort((service_codes, route_codes))
+
+        sorted_trips_df = pd.DataFrame({
+            'route_id': trips_df['route_id'].values[trip_order],
+            'service_id': trips_df['service_id'].values[trip_order],
+            'trip_id': trips_df['trip_id'].values[trip_order],
+            'direction_id': trips_df['direction_id'].values[trip_order],
+        })
+        trip_int_values = sorted_trips_df.groupby('route_id', sort=False).cumcount().values + 1
+
+        all_stop_times = self.get_gtfs_stop_times()
+
+        # index of each stop time's trip in sorted_trips_df (stable sort keeps the order of stop times for each trip)
+        trip_index_values = pd.Index(sorted_trips_df['trip_id'].values).get_indexer(all_stop_times['trip_id'].values)
+        stop_time_order = np.argsort(trip_index_values, kind='stable')
+        stop_time_order = stop_time_order[trip_index_values[stop_time_order] >= 0]
+        trip_index_values = trip_index_values[stop_time_order]
+
+        gtfs_stop_id_values = all_stop_times['stop_id'].values[stop_time_order]
+
+        return pd.DataFrame({
+            'route_id': sorted_trips_df['route_id'].values[trip_index_values],
+            'service_id': sorted_trips_df['service_id'].values[trip_index_values],
+            'trip_id': sorted_trips_df['trip_id'].values[trip_index_values],
+            'direction_id': sorted_trips_df['direction_id'].values[trip_index_values],
+            'trip_int': trip_int_values[trip_index_values],
+            'stop_id': self.normalize_trip_gtfs_stop_ids(trip_index_values, gtfs_stop_id_values),
+            'arrival_time': all_stop_times['arrival_time'].values[stop_time_order],
+            'departure_time': all_stop_times['departure_time'].values[stop_time_order],
+        })
+
+    def get_scheduled_arrivals_by_service_id(self, route_config, route_stop_times_df):
+
+        # returns dict { service_id => { direction_id => { stop_id => [{ 't': arrival_time, 'i': trip_int, 'e': departure_time }] } } }
+        # where arrival_time and departure_time are the number of seconds after midnight,
+        # and trip_int is a unique integer for each trip (instead of storing GTFS trip ID strings directly).
+        # The arrivals at each stop are sorted by arrival time.
+        #
+        # route_stop_times_df contains the rows from get_scheduled_stop_times for this route.
+
+        route_id = route_config.id
+
+        dir_infos = route_config.get_direction_infos()
+        dir_ids = [dir_info.id for dir_info in dir_infos]
+
+        service_id_values = route_stop_times_df['service_id'].values
+        trip_int_values = route_stop_times_df['trip_int'].values
+        stop_id_values = route_stop_times_df['stop_id'].values
+
+        # each service_id has an entry for all directions, even if no trips are assigned to them
+        service_ids = sorted(set(service_id_values))
+        arrivals_by_service_id = {service_id: {dir_id: {} for dir_id in dir_ids} for service_id in service_ids}
+
+        for service_id in service_ids:
+            num_trips = len(np.unique(trip_int_values[service_id_values == service_id]))
+            print(f'service={service_id} route={route_id} #trips={num_trips}')
+
+        dir_index_values = self.get_direction_indexes(route_config, route_stop_times_df)
 
-            direction_arrivals = arrivals_by_direction[dir_info.id]
+        is_assigned = dir_index_values >= 0
+        service_id_values = service_id_values[is_assigned]
+        trip_int_values = trip_int_values[is_assigned]
+        stop_id_values = stop_id_values[is_assigned]
+        dir_index_values = dir_index_values[is_assigned]
 
-            arrival_time_values = trip_stop_times['arrival_time'].values
-            departure_time_values = trip_stop_times['departure_time'].values
+        arrival_time_values = route_stop_times_df['arrival_time'].values[is_assigned]
+        departure_time_values = route_stop_times_df['departure_time'].values[is_assigned]
 
-            for i in range(len(trip_stop_times)):
-                stop_id = stop_ids[i]
+        if np.isnan(arrival_time_values).any() or np.isnan(departure_time_values).any():
+            raise Exception(f"Missing arrival or departure times for route {route_id}")
 
-                arrival_time = int(arrival_time_values[i])
-                departure_time = int(departure_time_values[i])
+        arrival_time_values = arrival_time_values.astype(np.int64)
+        departure_time_values = departure_time_values.astype(np.int64)
 
-                arrival_data = {'t': arrival_time, 'i': trip_int}
-                if departure_time != arrival_time:
-                    arrival_data['e'] = departure_time
+        arrivals = np.empty(len(arrival_time_values), dtype=object)
+        arrivals[:] = [
+            {'t': arrival_time, 'i': trip_int} if departure_time == arrival_time else {'t': arrival_time, 'i': trip_int, 'e': departure_time}
+            for arrival_time, trip_int, departure_time in zip(arrival_time_values.tolist(), trip_int_values.tolist(), departure_time_values.tolist())
+        ]
+
+        # group arrivals by service_id, direction and stop, in the order that each stop first appears in each direction
+        service_index_values = np.searchsorted(service_ids, service_id_values)
+        stop_codes, _ = pd.factorize(stop_id_values)
+        group_codes, _ = pd.factorize((service_index_values * len(dir_ids) + dir_index_values) * (len(stop_id_values) + 1) + stop_codes)
+
+        # arrivals for loop directions are kept in trip order for clean_loop_schedule, and sorted afterward
+        is_loop_dir = np.array([dir_info.is_loop() for dir_info in dir_infos])
+        sort_time_values = np.where(is_loop_dir[dir_index_values], 0, arrival_time_values)
+
+        order = np.lexsort((sort_time_values, group_codes))
+        group_start_indexes = np.flatnonzero(np.r_[True, np.diff(group_codes[order]) != 0])
+        group_end_indexes = np.r_[group_start_indexes[1:], len(order)]
 
-                if stop_id not in direction_arrivals:
-                    direction_arrivals[stop_id] = []
+        for start_index, end_index in zip(group_start_indexes, group_end_indexes):
+            row = order[start_index]
+            direction_arrivals = arrivals_by_service_id[service_id_values[row]][dir_ids[dir_index_values[row]]]
+            direction_arrivals[stop_id_values[row]] = arrivals[order[start_index:end_index]].tolist()
 
-                direction_arrivals[stop_id].append(arrival_data)
+        sort_key = lambda arr: arr['t']
 
-        for dir_info in route_config.get_direction_infos():
+        for dir_info in dir_infos:
             if dir_info.is_loop():
-                direction_arrivals = arrivals_by_direction[dir_info.id]
-                self.clean_loop_schedule(dir_info, direction_arrivals)
+                for service_id in service_ids:
+                    direction_arrivals = arrivals_by_service_id[service_id][dir_info.id]
+                    self.clean_loop_schedule(dir_info, direction_arrivals)
+                    for stop_id, stop_arrivals in direction_arrivals.items():
+                        direction_arrivals[stop_id] = sorted(stop_arrivals, key=sort_key)
+
+        return arrivals_by_service_id
+
+    def get_direction_indexes(self, route_config, route_stop_times_df):
+        # Returns an array containing the index of the direction in route_config.get_direction_infos()
+        # for each row in route_stop_times_df, or -1 if the trip was not assigned to any direction.
+
+        agency = self.agency
+        route_id = route_config.id
+
+        dir_infos = route_config.get_direction_infos()
+        dir_indexes_map = {dir_info.id: i for i, dir_info in enumerate(dir_infos)}
+
+        gtfs_direction_id_values = route_stop_times_df['direction_id'].values
+
+        if route_id not in agency.custom_directions:
+            gtfs_direction_id_map = {dir_info.gtfs_direction_id: i for i, dir_info in enumerate(dir_infos)}
+            dir_index_values = pd.Series(gtfs_direction_id_values).map(gtfs_direction_id_map)
+            if dir_index_values.isnull().any():
+                raise KeyError(gtfs_direction_id_values[dir_index_values.isnull().values][0])
+            return dir_index_values.values.astype(int)
+
+        # trips with the same GTFS direction and the same stops always have the same custom direction,
+        # so the custom direction only needs to be determined once for each unique sequence of stops
+        custom_directions_arr = agency.custom_directions[route_id]
 
-        return arrivals_by_direction
+        trip_id_values = route_stop_times_df['trip_id'].values
+        trip_int_values = route_stop_times_df['trip_int'].values
+        stop_id_values = route_stop_times_df['stop_id'].values
+
+        trip_start_indexes = np.flatnonzero(np.r_[True, trip_int_values[1:] != trip_int_values[:-1]])
+        trip_end_indexes = np.r_[trip_start_indexes[1:], len(trip_int_values)]
+
+        dir_index_values = np.empty(len(trip_int_values), dtype=int)
+        custom_direction_ids_map = {}
+
+        for start_index, end_index in zip(trip_start_indexes, trip_end_indexes):
+            trip_id = trip_id_values[start_index]
+            gtfs_direction_id = gtfs_direction_id_values[start_index]
+            stop_ids = stop_id_values[start_index:end_index].tolist()
+
+            key = (gtfs_direction_id, tuple(stop_ids))
+            if key not in custom_direction_ids_map:
+                custom_direction_id = self.get_custom_direction_id(custom_directions_arr, gtfs_direction_id, stop_ids)
+                if custom_direction_id is not None:
+                    print(f"Custom direction for route {route_id} trip {trip_id} = {custom_direction_id}")
+                custom_direction_ids_map[key] = custom_direction_id
+            else:
+                custom_direction_id = custom_direction_ids_map[key]
+
+            if custom_direction_id is None:
+                print(f"Unknown custom direction ID for trip {trip_id} ({gtfs_direction_id}, {stop_ids})")
+                dir_index_values[start_index:end_index] = -1
+            else:
+                dir_index_values[start_index:end_index] = dir_indexes_map[custom_direction_id]
+
+        return dir_index_values
 
     def clean_loop_schedule(self, dir_info, direction_arrivals):
         # For loop routes, the GTFS feed contains separate stop times for the end of one loop
@@ -587,12 +735,6 @@ class GtfsScraper:
                 if orig_trip_int is not None:
                     stop_arrival['i'] = orig_trip_int
 
-    def get_stop_times_for_trip(self, trip_id):
-        if self.stop_times_by_trip is None:
-            all_stop_times = self.get_gtfs_stop_times()
-            self.stop_times_by_trip = {trip_id: stop_times for trip_id, stop_times in all_stop_times.groupby('trip_id')}
-        return self.stop_times_by_trip[trip_id]
-
     def normalize_gtfs_stop_id(self, gtfs_stop_id, trip_occurrence=1):
         # get OpenTransit stop ID for GTFS stop_id (may be the same)
         stop_id_gtfs_field = self.agency.stop_id_gtfs_field
@@ -633,6 +775,32 @@ class GtfsScraper:
 
         return stop_ids
 
+    def normalize_trip_gtfs_stop_ids(self, trip_index_values, gtfs_stop_id_values):
+        # Returns an array of OpenTransit stop IDs given arrays of GTFS stop IDs for any number of trips,
+        # where trip_index_values contains a different value for each trip.
+        # Equivalent to calling normalize_gtfs_stop_ids for the stop IDs of each trip.
+
+        stop_id_gtfs_field = self.agency.stop_id_gtfs_field
+        if stop_id_gtfs_field != 'stop_id':
+            stops_df = self.get_gtfs_stops()
+            base_stop_ids_map = dict(zip(stops_df['stop_id'].values, stops_df[stop_id_gtfs_field].values))
+            stop_id_values = np.array([base_stop_ids_map[gtfs_stop_id] for gtfs_stop_id in gtfs_stop_id_values], dtype=object)
+        else:
+            stop_id_values = np.array(gtfs_stop_id_values, dtype=object)
+
+        trip_occurrence_values = pd.DataFrame({
+            'trip': trip_index_values,
+            'stop_id': gtfs_stop_id_values,
+        }).groupby(['trip', 'stop_id'], sort=False).cumcount().values + 1
+
+        is_repeated = trip_occurrence_values > 1
+        stop_id_values[is_repeated] = [
+            f'{base_stop_id}-{trip_occurrence}'
+            for base_stop_id, trip_occurrence in zip(stop_id_values[is_repeated], trip_occurrence_values[is_repeated])
+        ]
+
+        return stop_id_values
+
     def get_unique_shapes(self, direction_trips_df):
         # Finds the unique shapes associated with a GTFS route/direction, merging shapes that contain common subsequences of stops.
         # These unique shapes may represent multiple branches of a route.
@@ -1058,7 +1226,7 @@ class GtfsScraper:
             return route_data['title']
         return sorted(routes_data, key=get_sort_key)
 
-    def save_routes(self, save_to_s3, d):
+    def save_routes(self, save_to_s3, d, jobs=1):
         agency = self.agency
         agency_id = agency.id
         routes_df = self.get_gtfs_routes()
@@ -1070,12 +1238,49 @@ class GtfsScraper:
             ))
             return
 
-        routes_data = [
-            self.get_route_data(route)
-            for route in routes_df.itertuples()
-        ]
+        if jobs > 1:
+            routes_data = self.get_routes_data_in_parallel(routes_df, jobs)
+        else:
+            routes_data = [
+                self.get_route_data(route)
+                for route in routes_df.itertuples()
+            ]
+
         routes_data = self.sort_routes(routes_data)
 
         routes = [routeconfig.RouteConfig(agency_id, route_data) for route_data in routes_data]
 
         routeconfig.save_routes(agency_id, routes, save_to_s3=save_to_s3)
+
+    def get_routes_data_in_parallel(self, routes_df, jobs):
+        # Gets the data for each route in up to `jobs` worker processes,
+        # returning a list in the same order as routes_df.
+
+        global route_data_scraper
+
+        # load the GTFS data used by get_route_data before forking the worker processes,
+        # so that each worker process doesn't need to load it again
+        self.get_gtfs_trips()
+        self.get_gtfs_stops()
+        self.get_gtfs_stop_times()
+        self.get_gtfs_shapes()
+        self.get_stops_map()
+        self.get_gtfs_stop_ids_map()
+
+        # itertuples returns namedtuples of a class that can't be pickled,
+        # so each route is sent to the worker processes with the same attributes in a SimpleNamespace
+        routes = [SimpleNamespace(**route._asdict()) for route in routes_df.itertuples()]
+
+        routes_data = []
+
+        route_data_scraper = self
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_route_data_worker, initargs=(self.agency_id,)) as executor:
+                for output, route_data, errors in executor.map(get_route_data_in_worker, routes):
+                    print(output, end='')
+                    routes_data.append(route_data)
+                    self.errors += errors
+        finally:
+            route_data_scraper = None
+
+        return routes_data
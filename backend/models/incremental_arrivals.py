@@ -0,0 +1,264 @@
+from . import eclipses, util, config, routeconfig
+from datetime import date
+from pathlib import Path
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Keeps track of the arrivals computed so far for the current day, so that compute_arrivals.py
+# (when called from compute_new.py --incremental) only needs to fetch and process GPS observations
+# since the last time it ran, instead of all GPS observations since the start of the day.
+#
+# For each route, the incremental state contains:
+#  - the time of the last GPS observation that was processed (end_time)
+#  - "committed" arrivals for trips that are finished, which will not be computed again
+#  - for each vehicle and direction, the time of its last committed departure (committed_until)
+#  - recent GPS observations for each vehicle after its last committed trip (the "tail"), which are
+#    processed again along with the new GPS observations the next time the arrivals are updated.
+#    This allows trips that were still in progress to be extended with new arrivals.
+#
+# The arrivals from an incremental update are not necessarily identical to computing arrivals for
+# the entire day at once, since trips are only split where the GPS observations were split.
+# compute_new.py computes arrivals for the entire day again once the day is complete.
+
+DefaultVersion = 'v1'
+
+# GPS observations from this many seconds before the last committed departure are kept in the tail,
+# so that resample_buses and the eclipse detection see the same observations around the start of the tail
+TailMarginSeconds = 600
+
+# for vehicles without any trips in progress, GPS observations older than this are not kept in the tail
+MaxIdleTailSeconds = 3600
+
+# GPS observations more recent than this may not be available from tryn-api yet,
+# so incremental updates only fetch GPS observations until this many seconds ago
+MinObservationAgeSeconds = 300
+
+# trips for vehicles that have not reported a GPS observation for this long are considered finished
+InactiveVehicleSeconds = 1800
+
+class RouteState:
+    def __init__(self, start_time, end_time, next_trip=0, committed_until=None, arrivals=None, buses=None):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.next_trip = next_trip
+        self.committed_until = committed_until if committed_until is not None else {}
+        self.arrivals = arrivals if arrivals is not None else eclipses.make_arrivals_frame([])
+        self.buses = buses if buses is not None else make_buses_frame()
+
+def make_buses_frame() -> pd.DataFrame:
+    return pd.DataFrame({
+        'VID': pd.Series([], dtype=str),
+        'LAT': pd.Series([], dtype=float),
+        'LON': pd.Series([], dtype=float),
+        'DID': pd.Series([], dtype=str),
+        'TIME': pd.Series([], dtype=float),
+    })
+
+def update_arrivals(agency: config.Agency, route_config: routeconfig.RouteConfig, d: date,
+                    state: RouteState, new_buses: pd.DataFrame, end_time) -> tuple:
+    #
+    # Finds arrivals from the GPS observations in new_buses (between state.end_time and end_time)
+    # together with the GPS observations in the tail of the previous state.
+    #
+    # Returns a tuple (data frame of all arrivals for the day so far, new RouteState).
+    #
+    if new_buses is None:
+        new_buses = make_buses_frame()
+
+    buses = pd.concat([
+        state.buses,
+        new_buses.reindex(['VID', 'LAT', 'LON', 'DID', 'TIME'], axis='columns')
+    ], ignore_index=True).sort_values('TIME', axis=0, kind='mergesort')
+
+    arrivals = eclipses.find_arrivals(agency, buses, route_config, d)
+
+    # remove arrivals that were already committed for each vehicle and direction
+    arrivals = arrivals[arrivals['TIME'].values > get_committed_until_values(arrivals, state.committed_until)].copy()
+
+    arrivals['TRIP'] = arrivals['TRIP'].values + state.next_trip
+
+    all_arrivals = pd.concat([state.arrivals, arrivals], ignore_index=True, sort=False)
+
+    committed_until = {vehicle_id: dict(dir_times) for vehicle_id, dir_times in state.committed_until.items()}
+    committed_arrivals = [state.arrivals]
+
+    last_time_by_vehicle = buses.groupby('VID')['TIME'].max().to_dict()
+
+    for vehicle_id, vehicle_arrivals in arrivals.groupby('VID'):
+        trip_values = vehicle_arrivals['TRIP'].values
+        trip_start_times = vehicle_arrivals.groupby(trip_values)['TIME'].min()
+
+        if last_time_by_vehicle[vehicle_id] < end_time - InactiveVehicleSeconds:
+            # all trips are finished
+            committed_trips = trip_start_times.index
+        else:
+            # the vehicle's last trip may still be in progress. earlier trips are finished, even if they
+            # overlap the start of the last trip (e.g. near a terminal shared by both directions)
+            committed_trips = trip_start_times.index[trip_start_times < trip_start_times.max()]
+
+        if len(committed_trips) > 0:
+            vehicle_committed_arrivals = vehicle_arrivals[np.isin(trip_values, committed_trips)]
+            committed_arrivals.append(vehicle_committed_arrivals)
+
+            dir_times = committed_until.setdefault(vehicle_id, {})
+            for dir_id, dir_end_time in vehicle_committed_arrivals.groupby('DID')['DEPARTURE_TIME'].max().items():
+                dir_times[dir_id] = max(dir_times.get(dir_id, -np.inf), dir_end_time)
+
+    committed_arrivals = pd.concat(committed_arrivals, ignore_index=True, sort=False)
+
+    next_trip = state.next_trip
+    if not all_arrivals.empty:
+        next_trip = max(next_trip, int(all_arrivals['TRIP'].max()) + 1)
+
+    # keep GPS observations after the last committed departure for each vehicle, which will be processed again
+    # the next time the arrivals are updated
+    vehicle_arrival_start_times = arrivals[
+        arrivals['TIME'].values > get_committed_until_values(arrivals, committed_until)
+    ].groupby('VID')['TIME'].min()
+
+    tail_start_times = {}
+    for vehicle_id, last_time in last_time_by_vehicle.items():
+        if vehicle_id in vehicle_arrival_start_times.index:
+            tail_start_time = vehicle_arrival_start_times[vehicle_id]
+        else:
+            tail_start_time = end_time - MaxIdleTailSeconds
+
+        if vehicle_id in committed_until:
+            last_committed_time = max(committed_until[vehicle_id].values())
+            tail_start_time = min(tail_start_time, max(last_committed_time, end_time - MaxIdleTailSeconds))
+
+        tail_start_times[vehicle_id] = tail_start_time - TailMarginSeconds
+
+    tail_buses = buses[buses['TIME'].values >= buses['VID'].map(tail_start_times).values]
+
+    new_state = RouteState(
+        start_time=state.start_time,
+        end_time=end_time,
+        next_trip=next_trip,
+        committed_until=committed_until,
+        arrivals=committed_arrivals,
+        buses=tail_buses,
+    )
+
+    return all_arrivals, new_state
+
+def get_committed_until_values(arrivals: pd.DataFrame, committed_until: dict) -> np.ndarray:
+    # Returns the time of the last committed departure for the vehicle and direction of each arrival
+    # (or -inf if no trips have been committed yet)
+    return np.array([
+        committed_until.get(vehicle_id, {}).get(dir_id, -np.inf)
+        for vehicle_id, dir_id in zip(arrivals['VID'].values, arrivals['DID'].values)
+    ], dtype=float)
+
+def get_cache_dir(agency_id: str, d: date, start_time, version = DefaultVersion) -> str:
+    date_str = str(d)
+
+    if re.match('^[\w\-]+$', agency_id) is None:
+        raise Exception(f"Invalid agency id: {agency_id}")
+
+    if re.match('^[\w\-]+$', date_str) is None:
+        raise Exception(f"Invalid date: {date_str}")
+
+    if re.match('^[\w\-]+$', version) is None:
+        raise Exception(f"Invalid version: {version}")
+
+    return os.path.join(util.get_data_dir(), f"incremental-arrivals_{version}_{agency_id}/{date_str}_{int(start_time)}")
+
+def get_cache_path(agency_id: str, route_id: str, d: date, start_time, version = DefaultVersion) -> str:
+    if re.match('^[\w\-]+$', route_id) is None:
+        raise Exception(f"Invalid route id: {route_id}")
+
+    return os.path.join(get_cache_dir(agency_id, d, start_time, version), f"{route_id}.json")
+
+def get_state_data(agency_id: str, route_id: str, d: date, start_time, version = DefaultVersion) -> dict:
+    # Returns the saved JSON data for the incremental state of a route (without loading the data frames),
+    # or None if it has not been saved for this date and start time.
+    try:
+        with open(get_cache_path(agency_id, route_id, d, start_time, version), "r") as f:
+            return json.loads(f.read())
+    except FileNotFoundError as err:
+        return None
+
+def get_state(agency_id: str, route_id: str, d: date, start_time, version = DefaultVersion) -> RouteState:
+    # Returns the incremental state for a route, or None if it has not been saved for this date and start time.
+    cache_path = get_cache_path(agency_id, route_id, d, start_time, version)
+
+    data = get_state_data(agency_id, route_id, d, start_time, version)
+    if data is None:
+        return None
+
+    cache_dir = Path(cache_path).parent
+
+    arrivals = pd.read_csv(
+        cache_dir / data['arrivals_path'],
+        dtype={'VID': str, 'SID': str, 'DID': str},
+        float_precision='round_trip',
+    )
+
+    buses = pd.read_csv(
+        cache_dir / data['buses_path'],
+        dtype={'VID': str, 'DID': str},
+        float_precision='round_trip',
+    )
+
+    return RouteState(
+        start_time=data['start_time'],
+        end_time=data['end_time'],
+        next_trip=data['next_trip'],
+        committed_until=data['committed_until'],
+        arrivals=arrivals,
+        buses=buses,
+    )
+
+def save_state(agency_id: str, route_id: str, d: date, state: RouteState, version = DefaultVersion):
+    cache_path = get_cache_path(agency_id, route_id, d, state.start_time, version)
+
+    cache_dir = Path(cache_path).parent
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents = True, exist_ok = True)
+
+    # the data frames are saved to new files before replacing the JSON file that refers to them,
+    # so that the state is still consistent if this process is interrupted
+    arrivals_path = f"{route_id}_{int(state.end_time)}_arrivals.csv"
+    buses_path = f"{route_id}_{int(state.end_time)}_buses.csv"
+
+    state.arrivals.to_csv(cache_dir / arrivals_path, index=False)
+    state.buses.to_csv(cache_dir / buses_path, index=False)
+
+    data_str = json.dumps({
+        'version': version,
+        'start_time': state.start_time,
+        'end_time': state.end_time,
+        'next_trip': state.next_trip,
+        'committed_until': {
+            vehicle_id: {dir_id: float(t) for dir_id, t in dir_times.items()}
+            for vehicle_id, dir_times in state.committed_until.items()
+        },
+        'arrivals_path': arrivals_path,
+        'buses_path': buses_path,
+    })
+
+    temp_cache_path = f"{cache_path}.tmp"
+    with open(temp_cache_path, "w") as f:
+        f.write(data_str)
+    os.replace(temp_cache_path, cache_path)
+
+    # only remove data files for this route (other route IDs may also start with "{route_id}_")
+    data_file_re = re.compile(rf"^{re.escape(route_id)}_\d+_(arrivals|buses)\.csv$")
+    for path in cache_dir.glob(f"{route_id}_*.csv"):
+        if data_file_re.match(path.name) and path.name not in (arrivals_path, buses_path):
+            path.unlink()
+
+def remove_states(agency_id: str, d: date, version = DefaultVersion):
+    # Removes the incremental state for all routes on a date, after the arrivals for the entire day have been computed
+    parent_dir = Path(get_cache_dir(agency_id, d, 0, version)).parent
+    if not parent_dir.exists():
+        return
+
+    for cache_dir in parent_dir.glob(f"{str(d)}_*"):
+        for path in cache_dir.iterdir():
+            path.unlink()
+        cache_dir.rmdir()
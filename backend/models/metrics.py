@@ -1,8 +1,9 @@
 import pytz
 import sys
 import time
-from datetime import date
-from . import wait_times, util, arrival_history, trip_times, constants, timetables, routeconfig, config, precomputed_stats
+import weakref
+from datetime import date, datetime, timedelta
+from . import wait_times, util, arrival_history, trip_times, constants, timetables, routeconfig, config, precomputed_stats, cache
 
 import pandas as pd
 import numpy as np
@@ -16,6 +17,20 @@ class Range:
         self.end_time_str = end_time_str        # if None, no end time filter
         self.tz = tz
 
+# Process-wide caches shared by all RouteMetrics and AgencyMetrics instances,
+# so that repeated requests in the same API server process can reuse data frames
+# and metrics without recomputing them. (Arrival histories, timetables, and precomputed stats
+# are cached by their own modules until the files they were loaded from are modified.)
+# The maximum size of each cache can be configured via environment variables, see cache.py.
+data_frame_cache = cache.get_cache('data_frame', 256)
+route_metrics_cache = cache.get_cache('route_metrics', 128)
+missing_stats_cache = cache.get_cache('missing_stats', 1)
+
+# Arrival histories and precomputed stats for recent dates may still be updated
+# by compute_new.py, so metrics for those dates (and missing stats for any date)
+# are only cached for this many seconds.
+RecentDateCacheTTL = 120
+
 # RouteMetrics allows computing various metrics for a particular route,
 # such as headways, wait times, and trip times,
 # including over various date and time ranges.
@@ -29,24 +44,13 @@ class RouteMetrics:
         self.agency_metrics = agency_metrics
         self.agency_id = agency_metrics.agency_id
         self.route_id = route_id
-        self.arrival_histories = {}
-        self.data_frames = {}
-        self.timetables = {}
-        self.wait_time_stats = {}
-        self.trip_times = {}
-        self.schedule_adherence = {}
-        self.headways = {}
-        self.counts = {}
-        self.headway_schedule_deltas = {}
 
-    def get_arrival_history(self, d):
-        if d in self.arrival_histories:
-            return self.arrival_histories[d]
-
-        print(f'loading arrival history for route {self.route_id} on {d}', file=sys.stderr)
+    def _get_cache_key(self, kind, key):
+        return (self.agency_id, self.route_id, kind, key)
 
+    def get_arrival_history(self, d):
         try:
-            self.arrival_histories[d] = history = arrival_history.get_by_date(self.agency_id, self.route_id, d)
+            history = arrival_history.get_by_date(self.agency_id, self.route_id, d, use_cache=True)
         except FileNotFoundError as ex:
             print(f'Arrival history not found for route {self.route_id} on {d}', file=sys.stderr)
             history = arrival_history.ArrivalHistory(self.agency_id, self.route_id, {});
@@ -55,32 +59,48 @@ class RouteMetrics:
     def get_history_data_frame(self, d, direction_id=None, stop_id=None):
         key = f'history_{str(d)}_{stop_id}_{direction_id}'
 
-        if key in self.data_frames:
-            return self.data_frames[key]
-
         history = self.get_arrival_history(d)
 
-        print(f'loading data frame {key} for route {self.route_id}', file=sys.stderr)
-
-        df = history.get_data_frame(stop_id=stop_id, direction_id=direction_id)
-        self.data_frames[key] = df
-        return df
+        return self._get_data_frame(key, history, d,
+            lambda: history.get_data_frame(stop_id=stop_id, direction_id=direction_id))
 
     def get_timetable(self, d):
-        if d not in self.timetables.keys():
-            self.timetables[d] = timetables.get_by_date(self.agency_id, self.route_id, d)
-
-        return self.timetables[d]
+        return timetables.get_by_date(self.agency_id, self.route_id, d, use_cache=True)
 
     def get_timetable_data_frame(self, d, direction_id=None, stop_id=None):
+        timetable_key = f'timetable_{str(d)}_{stop_id}_{direction_id}'
+
         timetable = self.get_timetable(d)
 
-        timetable_key = f'timetable_{str(d)}_{stop_id}_{direction_id}'
+        return self._get_data_frame(timetable_key, timetable, d,
+            lambda: timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id))
+
+    def _get_data_frame(self, key, source, d, get_data_frame):
+        # data frames are cached with a weak reference to the arrival history or timetable they were created from
+        # as the version, so they are recreated if the arrival history or timetable has been reloaded.
+        # (weak references are equal only if they refer to the same live object, and don't keep the arrival history
+        # or timetable in memory after it is evicted from its own cache.)
+        cache_key = self._get_cache_key('data_frame', key)
+        version = weakref.ref(source)
 
-        if timetable_key not in self.data_frames:
-            self.data_frames[timetable_key] = timetable.get_data_frame(stop_id=stop_id, direction_id=direction_id)
+        df = data_frame_cache.get(cache_key, version=version)
+        if df is not None:
+            return df
+
+        print(f'loading data frame {key} for route {self.route_id}', file=sys.stderr)
+
+        df = get_data_frame()
+        data_frame_cache.set(cache_key, df, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
+        return df
 
-        return self.data_frames[timetable_key]
+    def _get_source_version(self, d, history=False, timetable=False):
+        # metrics computed from data frames are cached with weak references to the arrival history and/or timetable
+        # for date d as the version, like the data frames themselves, so they are recomputed after the arrival history
+        # or timetable has been reloaded (e.g. after it was recomputed for a past date).
+        return (
+            weakref.ref(self.get_arrival_history(d)) if history else None,
+            weakref.ref(self.get_timetable(d)) if timetable else None,
+        )
 
     def get_wait_time_stats(self, direction_id, stop_id, rng: Range, scheduled=False):
         wait_stats_arr = []
@@ -90,7 +110,11 @@ class RouteMetrics:
         for d in rng.dates:
             key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}'
 
-            if key not in self.wait_time_stats:
+            cache_key = self._get_cache_key('wait_time_stats', key)
+            version = self._get_source_version(d, history=not scheduled, timetable=scheduled)
+            wait_stats = route_metrics_cache.get(cache_key, version=version)
+
+            if wait_stats is None:
                 #print(f'_get_wait_time_stats {key}', file=sys.stderr)
 
                 start_time = util.get_timestamp_or_none(d, rng.start_time_str, rng.tz)
@@ -102,9 +126,9 @@ class RouteMetrics:
 
                 wait_stats = wait_times.get_stats(departure_time_values, start_time, end_time)
 
-                self.wait_time_stats[key] = wait_stats
+                route_metrics_cache.set(cache_key, wait_stats, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
 
-            wait_stats_arr.append(self.wait_time_stats[key])
+            wait_stats_arr.append(wait_stats)
 
         if len(wait_stats_arr) == 1:
             return wait_stats_arr[0]
@@ -121,7 +145,11 @@ class RouteMetrics:
 
         for d in rng.dates:
             key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}-{time_field}'
-            if key not in self.counts:
+            cache_key = self._get_cache_key('count', key)
+            version = self._get_source_version(d, history=not scheduled, timetable=scheduled)
+            date_count = route_metrics_cache.get(cache_key, version=version)
+
+            if date_count is None:
                 #print(f'_get_count {key}', file=sys.stderr)
 
                 df = get_data_frame(d, direction_id=direction_id, stop_id=stop_id)
@@ -135,9 +163,11 @@ class RouteMetrics:
                 if end_time is not None:
                     df = df[df[time_field] < end_time]
 
-                self.counts[key] = len(df)
+                date_count = len(df)
 
-            count += self.counts[key]
+                route_metrics_cache.set(cache_key, date_count, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
+
+            count += date_count
 
         return count
 
@@ -151,7 +181,11 @@ class RouteMetrics:
 
         for d in rng.dates:
             key = f'{direction_id}-{stop_id}-{early_sec}-{late_sec}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{time_field}'
-            if key not in self.schedule_adherence:
+            cache_key = self._get_cache_key('schedule_adherence', key)
+            version = self._get_source_version(d, history=True, timetable=True)
+            comparison_df = route_metrics_cache.get(cache_key, version=version)
+
+            if comparison_df is None:
                 #print(f'_get_schedule_adherence {key}', file=sys.stderr)
 
                 stop_timetable = self.get_timetable_data_frame(d, direction_id=direction_id, stop_id=stop_id)
@@ -180,9 +214,9 @@ class RouteMetrics:
                 if end_time is not None:
                     comparison_df = comparison_df[comparison_df[time_field] < end_time]
 
-                self.schedule_adherence[key] = comparison_df
+                route_metrics_cache.set(cache_key, comparison_df, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
 
-            compared_timetable_arr.append(self.schedule_adherence[key])
+            compared_timetable_arr.append(comparison_df)
 
         if len(compared_timetable_arr) == 1:
             return compared_timetable_arr[0]
@@ -199,7 +233,11 @@ class RouteMetrics:
 
         for d in rng.dates:
             key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}'
-            if key not in self.headway_schedule_deltas:
+            cache_key = self._get_cache_key('headway_schedule_deltas', key)
+            version = self._get_source_version(d, history=True, timetable=True)
+            headway_deltas = route_metrics_cache.get(cache_key, version=version)
+
+            if headway_deltas is None:
                 timetable_df = self.get_timetable_data_frame(d, direction_id=direction_id, stop_id=stop_id)
                 history_df = self.get_history_data_frame(d, direction_id=direction_id, stop_id=stop_id)
 
@@ -229,9 +267,11 @@ class RouteMetrics:
                 if end_time is not None:
                     comparison_df = comparison_df[comparison_df['DEPARTURE_TIME'] < end_time]
 
-                self.headway_schedule_deltas[key] = comparison_df['headway'].values - comparison_df['closest_scheduled_headway'].values
+                headway_deltas = comparison_df['headway'].values - comparison_df['closest_scheduled_headway'].values
+
+                route_metrics_cache.set(cache_key, headway_deltas, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
 
-            headway_delta_arr.append(self.headway_schedule_deltas[key])
+            headway_delta_arr.append(headway_deltas)
 
         if len(headway_delta_arr) == 1:
             return headway_delta_arr[0]
@@ -264,7 +304,11 @@ class RouteMetrics:
         for d in rng.dates:
             key = f'{direction_id}-{start_stop_id}-{end_stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}'
 
-            if key not in self.trip_times:
+            cache_key = self._get_cache_key('trip_times', key)
+            version = self._get_source_version(d, history=not scheduled, timetable=scheduled)
+            completed_trips = route_metrics_cache.get(cache_key, version=version)
+
+            if completed_trips is None:
                 #print(f'_get_trip_time_stats {key}', file=sys.stderr)
 
                 s1_df = get_data_frame(d, stop_id=start_stop_id, direction_id=direction_id)
@@ -279,7 +323,7 @@ class RouteMetrics:
                 if end_time is not None:
                     s1_df = s1_df[s1_df['DEPARTURE_TIME'] < end_time]
 
-                self.trip_times[key] = trip_times.get_completed_trip_times(
+                completed_trips = trip_times.get_completed_trip_times(
                     s1_df['TRIP'].values,
                     s1_df['DEPARTURE_TIME'].values,
                     s2_df['TRIP'].values,
@@ -287,7 +331,9 @@ class RouteMetrics:
                     is_loop = is_loop
                 )
 
-            completed_trips_arr.append(self.trip_times[key])
+                route_metrics_cache.set(cache_key, completed_trips, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
+
+            completed_trips_arr.append(completed_trips)
 
         if len(completed_trips_arr) == 1:
             return completed_trips_arr[0]
@@ -304,7 +350,11 @@ class RouteMetrics:
         for d in rng.dates:
             key = f'{direction_id}-{stop_id}-{d}-{rng.start_time_str}-{rng.end_time_str}-{rng.tz}-{scheduled}'
 
-            if key not in self.headways:
+            cache_key = self._get_cache_key('headways', key)
+            version = self._get_source_version(d, history=not scheduled, timetable=scheduled)
+            headway_min = route_metrics_cache.get(cache_key, version=version)
+
+            if headway_min is None:
                 #print(f'_get_headways {key}', file=sys.stderr)
                 df = get_data_frame(d, direction_id=direction_id, stop_id=stop_id)
 
@@ -313,9 +363,11 @@ class RouteMetrics:
 
                 departure_time_values = np.sort(df['DEPARTURE_TIME'].values)
 
-                self.headways[key] = compute_headway_minutes(departure_time_values, start_time, end_time)
+                headway_min = compute_headway_minutes(departure_time_values, start_time, end_time)
+
+                route_metrics_cache.set(cache_key, headway_min, ttl=self.agency_metrics.get_cache_ttl(d), version=version)
 
-            headway_min_arr.append(self.headways[key])
+            headway_min_arr.append(headway_min)
 
         if len(headway_min_arr) == 1:
             return headway_min_arr[0]
@@ -626,14 +678,13 @@ class AgencyMetrics:
     def __init__(self, agency_id):
         self.agency_id = agency_id
         self.agency = config.get_agency(agency_id)
-        self.precomputed_stats = {}
         self.route_metrics = {}
         self.date_keys = None
         self.route_configs = None
 
     def get_date_keys(self):
         if self.date_keys is None:
-            self.date_keys = timetables.get_date_keys(self.agency_id)
+            self.date_keys = timetables.get_date_keys(self.agency_id, use_cache=True)
         return self.date_keys
 
     def get_route_metrics(self, route_id):
@@ -662,18 +713,28 @@ class AgencyMetrics:
         else:
             stats_date = d
 
-        key = f'{stat_id}-{stats_date}-{start_time_str}-{end_time_str}-{scheduled}'
-        if key not in self.precomputed_stats:
-            try:
-                self.precomputed_stats[key] = precomputed_stats.get_precomputed_stats(
-                    self.agency_id, stat_id, stats_date,
-                    start_time_str = start_time_str, end_time_str = end_time_str,
-                    scheduled=scheduled
-                )
-            except FileNotFoundError as e:
-                self.precomputed_stats[key] = None
+        key = (self.agency_id, f'{stat_id}-{stats_date}-{start_time_str}-{end_time_str}-{scheduled}')
+
+        if missing_stats_cache.get(key) is not None:
+            return None
+
+        try:
+            return precomputed_stats.get_precomputed_stats(
+                self.agency_id, stat_id, stats_date,
+                start_time_str = start_time_str, end_time_str = end_time_str,
+                scheduled=scheduled,
+                use_cache=True
+            )
+        except FileNotFoundError as e:
+            missing_stats_cache.set(key, True, ttl=RecentDateCacheTTL)
+            return None
 
-        return self.precomputed_stats[key]
+    def get_cache_ttl(self, d: date):
+        # Returns the number of seconds that data for date d may be cached, or None if it may be cached indefinitely.
+        today = datetime.now(self.agency.tz).date()
+        if d >= today - timedelta(days=1):
+            return RecentDateCacheTTL
+        return None
 
     def get_route_ids(self):
         return self.get_route_configs().keys()
@@ -1,4 +1,4 @@
-from . import util, config
+from . import util, config, cache
 from datetime import date
 import sys
 import re
@@ -87,9 +87,20 @@ class PrecomputedStats:
     def get_on_time_rate(self, route_id, direction_id):
         return self.get_direction_stat_value(route_id, direction_id, 'onTimeRate')
 
-def get_precomputed_stats(agency_id, stat_id: str, d: date, start_time_str = None, end_time_str = None, scheduled = False, version = DefaultVersion) -> PrecomputedStats:
+# stats loaded by get_precomputed_stats with use_cache=True, shared by all threads in the process
+stats_cache = cache.get_cache('precomputed_stats', 256)
+
+def get_precomputed_stats(agency_id, stat_id: str, d: date, start_time_str = None, end_time_str = None, scheduled = False, version = DefaultVersion, use_cache = False) -> PrecomputedStats:
     cache_path = get_cache_path(agency_id, stat_id, d, start_time_str, end_time_str, scheduled, version)
 
+    if use_cache:
+        # reuse previously loaded stats until the local cache file is modified
+        return stats_cache.get_or_compute(
+            (agency_id, stat_id, str(d), start_time_str, end_time_str, scheduled, version),
+            lambda: get_precomputed_stats(agency_id, stat_id, d, start_time_str, end_time_str, scheduled, version),
+            get_version = lambda: cache.get_file_version(cache_path)
+        )
+
     try:
         with open(cache_path, "r") as f:
             text = f.read()
@@ -156,6 +167,34 @@ def get_cache_path(agency_id: str, stat_id: str, d: date, start_time_str, end_ti
     prefix = "scheduled-stats" if scheduled else "observed-stats"
     return f'{util.get_data_dir()}/{prefix}_{version}_{agency_id}/{date_str}/{prefix}_{version}_{agency_id}_{stat_id}_{date_str}{time_range_path}.json'
 
+def get_manifest_path(agency_id: str, d: date, scheduled=False, version = DefaultVersion) -> str:
+    # The manifest is stored in the same local directory as the stats for each date, and contains a fingerprint
+    # of the inputs used to compute the stats for each route (see compute_stats.py)
+    return get_cache_path(agency_id, 'manifest', d, None, None, scheduled, version)
+
+def get_manifest(agency_id: str, d: date, scheduled=False, version = DefaultVersion) -> dict:
+    # Returns a dict of route ID => fingerprint, or an empty dict if the manifest has not been saved.
+    try:
+        with open(get_manifest_path(agency_id, d, scheduled, version), "r") as f:
+            return json.loads(f.read())['routes']
+    except FileNotFoundError as err:
+        return {}
+
+def save_manifest(agency_id: str, d: date, scheduled, route_fingerprints: dict, version = DefaultVersion):
+    data_str = json.dumps({
+        'version': version,
+        'routes': route_fingerprints,
+    })
+
+    manifest_path = get_manifest_path(agency_id, d, scheduled, version)
+
+    cache_dir = Path(manifest_path).parent
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents = True, exist_ok = True)
+
+    with open(manifest_path, "w") as f:
+        f.write(data_str)
+
 def save_stats(agency_id, stat_id, d, start_time_str, end_time_str, scheduled, data, save_to_s3=False):
     data_str = json.dumps({
         'version': DefaultVersion,
@@ -1,5 +1,6 @@
 import re, os, time, requests, json, boto3, gzip
-from . import util, config
+import numpy as np
+from . import util, config, cache
 
 DefaultVersion = 'v3a'
 
@@ -21,6 +22,8 @@ class DirectionInfo:
         self.gtfs_direction_id = data['gtfs_direction_id']
         self.gtfs_shape_id = data['gtfs_shape_id']
         self.stop_geometry = data['stop_geometry']
+        self.stop_indexes = None
+        self.stop_arrays = None
 
     def is_loop(self):
         return self.data.get('loop', False)
@@ -28,6 +31,22 @@ class DirectionInfo:
     def get_stop_ids(self):
         return self.data['stops']
 
+    def get_stop_index(self, stop_id):
+        # Returns the index of the first occurrence of stop_id in get_stop_ids(), or None if the stop is not in this direction
+        if self.stop_indexes is None:
+            stop_indexes = {}
+            for index, s in enumerate(self.get_stop_ids()):
+                stop_indexes.setdefault(s, index)
+            self.stop_indexes = stop_indexes
+
+        return self.stop_indexes.get(stop_id, None)
+
+    def get_stop_arrays(self):
+        if self.stop_arrays is None:
+            self.stop_arrays = StopArrays(self)
+
+        return self.stop_arrays
+
     def get_stop_geometry(self, stop_id):
         return self.stop_geometry.get(stop_id, None)
 
@@ -55,6 +74,69 @@ class DirectionInfo:
 
         return (first_stop_id, last_stop_id)
 
+class StopArrays:
+    # NumPy arrays describing the stops in a direction, indexed by the position of each stop in the direction
+    # (the same as the stop_index used when detecting arrivals).
+    #
+    # These are computed once per direction so that arrival detection doesn't need to look up each stop
+    # and compute the distances between adjacent stops every time it processes GPS observations for the route.
+
+    def __init__(self, dir_info: DirectionInfo):
+        route = dir_info.route
+        stop_ids = dir_info.get_stop_ids()
+        num_stops = len(stop_ids)
+
+        stop_infos = [route.get_stop_info(stop_id) for stop_id in stop_ids]
+
+        index_values = np.arange(num_stops)
+
+        self.stop_ids = stop_ids
+        self.lat_values = np.array([stop_info.lat for stop_info in stop_infos], dtype=float)
+        self.lon_values = np.array([stop_info.lon for stop_info in stop_infos], dtype=float)
+
+        self.is_terminal_values = (index_values == 0) | (index_values == num_stops - 1)
+
+        # indexes of the previous and next stops (or -1 if there is no previous/next stop),
+        # where the first and last stops of a loop are adjacent to each other
+        if dir_info.is_loop():
+            self.prev_index_values = (index_values + num_stops - 1) % num_stops
+            self.next_index_values = (index_values + 1) % num_stops
+        else:
+            self.prev_index_values = index_values - 1
+            self.next_index_values = np.where(index_values < num_stops - 1, index_values + 1, -1)
+
+        # distances in meters to the previous and next stops (or NaN if there is no previous/next stop)
+        self.prev_distance_values = self.get_distances_to_stops(self.prev_index_values)
+        self.next_distance_values = self.get_distances_to_stops(self.next_index_values)
+
+        self.radius_values = {}
+
+    def get_distances_to_stops(self, other_index_values):
+        has_other_values = other_index_values >= 0
+        distance_values = np.full(len(other_index_values), np.nan)
+        distance_values[has_other_values] = util.haver_distance(
+            self.lat_values[has_other_values],
+            self.lon_values[has_other_values],
+            self.lat_values[other_index_values[has_other_values]],
+            self.lon_values[other_index_values[has_other_values]],
+        )
+        return distance_values
+
+    def get_radius_values(self, max_radius):
+        # Returns the radius in meters around each stop, which is no larger than
+        # the rounded distance to the previous or next stop.
+        if max_radius not in self.radius_values:
+            radius_values = np.full(len(self.stop_ids), max_radius, dtype=float)
+            for distance_values in (self.prev_distance_values, self.next_distance_values):
+                has_distance_values = np.isfinite(distance_values)
+                radius_values[has_distance_values] = np.minimum(
+                    radius_values[has_distance_values],
+                    np.round(distance_values[has_distance_values])
+                )
+            self.radius_values[max_radius] = radius_values
+
+        return self.radius_values[max_radius]
+
 class RouteConfig:
     def __init__(self, agency_id, data):
         self.agency_id = agency_id
@@ -66,8 +148,10 @@ class RouteConfig:
         self.sort_order = data['sort_order']
         self.gtfs_route_id = data['gtfs_route_id']
 
-        self.dir_infos = {}
+        self.dir_infos = None
+        self.dir_infos_map = None
         self.stop_infos = {}
+        self.stop_directions = None
 
     def get_direction_ids(self):
         return [direction['id'] for direction in self.data['directions']]
@@ -97,29 +181,33 @@ class RouteConfig:
         return None
 
     def get_direction_infos(self):
-        return [DirectionInfo(self, direction) for direction in self.data['directions']]
+        if self.dir_infos is None:
+            self.dir_infos = [DirectionInfo(self, direction) for direction in self.data['directions']]
 
-    def get_direction_info(self, direction_id):
-        if direction_id in self.dir_infos:
-            return self.dir_infos[direction_id]
+        return list(self.dir_infos)
 
-        for direction in self.data['directions']:
-            if direction['id'] == direction_id:
-                dir_info = DirectionInfo(self, direction)
-                self.dir_infos[direction_id] = dir_info
-                return dir_info
+    def get_direction_info(self, direction_id):
+        if self.dir_infos_map is None:
+            dir_infos_map = {}
+            for dir_info in self.get_direction_infos():
+                dir_infos_map.setdefault(dir_info.id, dir_info)
+            self.dir_infos_map = dir_infos_map
 
-        return None
+        return self.dir_infos_map.get(direction_id, None)
 
     def get_directions_for_stop(self, stop_id):
         # Most stops appear in one direction for a particular route,
         # but some stops may not appear in any direction,
         # and some stops may appear in multiple directions.
-        return [
-            direction['id']
-            for direction in self.data['directions']
-            for s in direction['stops'] if s == stop_id
-        ]
+        # (A direction ID is repeated for each time the stop appears in that direction.)
+        if self.stop_directions is None:
+            stop_directions = {}
+            for direction in self.data['directions']:
+                for s in direction['stops']:
+                    stop_directions.setdefault(s, []).append(direction['id'])
+            self.stop_directions = stop_directions
+
+        return list(self.stop_directions.get(stop_id, []))
 
 def get_cache_path(agency_id, version=DefaultVersion):
     return f'{util.get_data_dir()}/routes_{version}_{agency_id}.json'
@@ -127,7 +215,42 @@ def get_cache_path(agency_id, version=DefaultVersion):
 def get_s3_path(agency_id, version=DefaultVersion):
     return f'routes/{version}/routes_{version}_{agency_id}.json.gz'
 
+# parsed route lists shared by all callers in the process
+route_list_cache = cache.get_cache('route_list', 128)
+
+# local cache files older than this are refreshed from S3 by get_route_list
+MaxCacheFileAge = 86400
+
 def get_route_list(agency_id, version=DefaultVersion):
+    routes, routes_map = get_cached_route_list(agency_id, version)
+    return list(routes)
+
+def get_route_config(agency_id, route_id, version=DefaultVersion):
+    routes, routes_map = get_cached_route_list(agency_id, version)
+    return routes_map.get(route_id, None)
+
+def get_cached_route_list(agency_id, version=DefaultVersion):
+    # Returns a tuple (list of RouteConfig, dict of route ID => RouteConfig),
+    # which is reused until the local cache file is modified or needs to be refreshed from S3.
+    if re.match('^[\w\-]+$', agency_id) is None:
+        raise Exception(f"Invalid agency id: {agency_id}")
+
+    cache_path = get_cache_path(agency_id, version)
+
+    def load():
+        routes = load_route_list(agency_id, version)
+        routes_map = {}
+        for route in routes:
+            routes_map.setdefault(route.id, route)
+        return routes, routes_map
+
+    return route_list_cache.get_or_compute(
+        (agency_id, version),
+        load,
+        get_version = lambda: cache.get_file_version(cache_path, max_age=MaxCacheFileAge)
+    )
+
+def load_route_list(agency_id, version=DefaultVersion):
     if re.match('^[\w\-]+$', agency_id) is None:
         raise Exception(f"Invalid agency id: {agency_id}")
 
@@ -139,7 +262,7 @@ def get_route_list(agency_id, version=DefaultVersion):
     try:
         mtime = os.stat(cache_path).st_mtime
         now = time.time()
-        if now - mtime < 86400:
+        if now - mtime < MaxCacheFileAge:
             with open(cache_path, mode='r', encoding='utf-8') as f:
                 data_str = f.read()
                 try:
@@ -173,12 +296,6 @@ def get_route_list(agency_id, version=DefaultVersion):
 
     return route_list_from_data(data)
 
-def get_route_config(agency_id, route_id, version=DefaultVersion):
-    for route in get_route_list(agency_id, version):
-        if route.id == route_id:
-            return route
-    return None
-
 def save_routes(agency_id, routes, save_to_s3=False):
     data_str = json.dumps({
         'version': DefaultVersion,
@@ -7,7 +7,7 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 
-from . import config, util, metrics
+from . import config, util, metrics, cache
 
 DefaultVersion = 'v1'
 
@@ -71,8 +71,25 @@ class Timetable:
 
         return pd.DataFrame(data = data, columns = columns)
 
-def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion) -> Timetable:
-    date_key = get_date_key(agency_id, d, version)
+# timetables and date keys loaded with use_cache=True, shared by all threads in the process
+timetable_cache = cache.get_cache('timetable', 128)
+
+def get_by_date(agency_id: str, route_id: str, d: date, version = DefaultVersion, use_cache = False) -> Timetable:
+    date_key = get_date_key(agency_id, d, version, use_cache=use_cache)
+
+    if use_cache:
+        # reuse a previously loaded timetable until the local cache file is modified
+        cache_path = get_cache_path(agency_id, route_id, date_key, version)
+
+        def get_version():
+            mtime = cache.get_file_version(cache_path)
+            return (date_key, mtime) if mtime is not None else None
+
+        return timetable_cache.get_or_compute(
+            (agency_id, route_id, str(d), version),
+            lambda: get_by_date(agency_id, route_id, d, version),
+            get_version = get_version
+        )
     data = get_data_by_date_key(agency_id, route_id, date_key, version)
 
     timezone_id = data['timezone_id']
@@ -306,8 +323,8 @@ def get_cache_path(agency_id, route_id, date_key, version = DefaultVersion):
 def get_s3_path(agency_id, route_id, date_key, version=DefaultVersion):
     return f'timetables/{version}/{agency_id}/{date_key}/timetables_{version}_{agency_id}_{date_key}_{route_id}.json.gz'
 
-def get_date_key(agency_id, d: date, version = DefaultVersion):
-    date_keys = get_date_keys(agency_id, version)
+def get_date_key(agency_id, d: date, version = DefaultVersion, use_cache = False):
+    date_keys = get_date_keys(agency_id, version, use_cache=use_cache)
     date_key = date_keys.get(str(d), None)
     if date_key is not None:
         return date_key
@@ -336,9 +353,16 @@ def get_date_key(agency_id, d: date, version = DefaultVersion):
     ))
     return date_key
 
-def get_date_keys(agency_id, version = DefaultVersion):
+def get_date_keys(agency_id, version = DefaultVersion, use_cache = False):
     cache_path = get_date_keys_cache_path(agency_id, version)
 
+    if use_cache:
+        return timetable_cache.get_or_compute(
+            (agency_id, 'date_keys', version),
+            lambda: get_date_keys(agency_id, version),
+            get_version = lambda: cache.get_file_version(cache_path)
+        )
+
     try:
         with open(cache_path, "r") as f:
             data = json.loads(f.read())
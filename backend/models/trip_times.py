@@ -1,6 +1,11 @@
 import numpy as np
 import sortednp as snp
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 def get_completed_trip_times(
     s1_trip_values, s1_departure_time_values,
     s2_trip_values, s2_arrival_time_values,
@@ -47,15 +52,47 @@ def find_indexes_of_next_arrival_times(
     sorted_s2_trip_values, sorted_s2_arrival_time_values
 ):
     # Given two pairs of parallel arrays for each stop with trip IDs and departure/arrival times,
-    # already sorted by departure/arrival time, returns parallel lists of indexes into these pairs of arrays:
+    # already sorted by departure/arrival time, returns parallel arrays of indexes into these pairs of arrays:
     # each pair of indexes corresponds to a departure time (from the first stop)
     # and the *next* arrival time (at the second stop) after that departure time.
+    #
+    # Uses a compiled version of the loop in find_indexes_of_next_arrival_times_loop if numba is installed,
+    # otherwise find_indexes_of_next_arrival_times_numpy. All versions return the same pairs of indexes.
+
+    if find_indexes_of_next_arrival_times_jit is not None and \
+            is_numeric(sorted_s1_trip_values) and is_numeric(sorted_s1_departure_time_values) and \
+            is_numeric(sorted_s2_trip_values) and is_numeric(sorted_s2_arrival_time_values):
+
+        s1_len = len(sorted_s1_trip_values)
+        sorted_s1_indexes = np.empty(s1_len, dtype=np.int64)
+        sorted_s2_indexes = np.empty(s1_len, dtype=np.int64)
+
+        num_indexes = find_indexes_of_next_arrival_times_jit(
+            sorted_s1_trip_values, sorted_s1_departure_time_values,
+            sorted_s2_trip_values, sorted_s2_arrival_time_values,
+            sorted_s1_indexes, sorted_s2_indexes
+        )
+        return sorted_s1_indexes[:num_indexes], sorted_s2_indexes[:num_indexes]
+
+    return find_indexes_of_next_arrival_times_numpy(
+        sorted_s1_trip_values, sorted_s1_departure_time_values,
+        sorted_s2_trip_values, sorted_s2_arrival_time_values
+    )
+
+def find_indexes_of_next_arrival_times_loop(
+    sorted_s1_trip_values, sorted_s1_departure_time_values,
+    sorted_s2_trip_values, sorted_s2_arrival_time_values,
+    sorted_s1_indexes, sorted_s2_indexes
+):
+    # Pure-Python implementation of find_indexes_of_next_arrival_times, which is compiled with numba if it is installed.
+    #
+    # Writes the pairs of indexes to the sorted_s1_indexes and sorted_s2_indexes arrays
+    # (which should have the same length as sorted_s1_trip_values) and returns the number of pairs.
 
     s1_len = len(sorted_s1_trip_values)
     s2_len = len(sorted_s2_trip_values)
 
-    sorted_s1_indexes = []
-    sorted_s2_indexes = []
+    num_indexes = 0
 
     s2_start_index = 0
     for s1_index in range(s1_len):
@@ -68,14 +105,65 @@ def find_indexes_of_next_arrival_times(
             if s2_arrival_time > s1_departure_time:
                 s2_trip = sorted_s2_trip_values[s2_index]
                 if s2_trip == s1_trip:
-                    sorted_s1_indexes.append(s1_index)
-                    sorted_s2_indexes.append(s2_index)
+                    sorted_s1_indexes[num_indexes] = s1_index
+                    sorted_s2_indexes[num_indexes] = s2_index
+                    num_indexes += 1
                     break
             else:
                 s2_start_index = s2_index + 1
 
+    return num_indexes
+
+if numba is not None:
+    find_indexes_of_next_arrival_times_jit = numba.njit(cache=True)(find_indexes_of_next_arrival_times_loop)
+else:
+    find_indexes_of_next_arrival_times_jit = None
+
+def find_indexes_of_next_arrival_times_numpy(
+    sorted_s1_trip_values, sorted_s1_departure_time_values,
+    sorted_s2_trip_values, sorted_s2_arrival_time_values
+):
+    # Vectorized implementation of find_indexes_of_next_arrival_times that does not require numba.
+    #
+    # For each departure, the next arrival with the same trip ID is the first s2 index
+    # with that trip ID that is not before the first arrival after the departure time.
+    # Each s2 index is encoded as a key (trip code * (s2_len + 1) + s2 index), so that sorting the keys
+    # groups the s2 indexes by trip ID in increasing order, and a single binary search
+    # finds the next arrival for each departure.
+
+    s1_len = len(sorted_s1_trip_values)
+    s2_len = len(sorted_s2_trip_values)
+
+    if s1_len == 0 or s2_len == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+    s2_unique_trip_values, s2_trip_codes = np.unique(sorted_s2_trip_values, return_inverse=True)
+
+    s2_keys = np.sort(s2_trip_codes.astype(np.int64) * (s2_len + 1) + np.arange(s2_len))
+
+    s1_trip_codes = np.searchsorted(s2_unique_trip_values, sorted_s1_trip_values)
+    s1_trip_codes[s1_trip_codes == len(s2_unique_trip_values)] = 0
+    s1_has_trip = s2_unique_trip_values[s1_trip_codes] == sorted_s1_trip_values
+
+    # index of the first arrival at s2 after each departure from s1, with any trip ID
+    next_s2_indexes = np.searchsorted(sorted_s2_arrival_time_values, sorted_s1_departure_time_values, side='right')
+
+    s1_keys = s1_trip_codes.astype(np.int64) * (s2_len + 1) + next_s2_indexes
+    key_indexes = np.searchsorted(s2_keys, s1_keys)
+    key_indexes[key_indexes == s2_len] = 0
+
+    s2_match_keys = s2_keys[key_indexes]
+
+    is_match = s1_has_trip & (s2_match_keys >= s1_keys) & (s2_match_keys // (s2_len + 1) == s1_trip_codes)
+
+    sorted_s1_indexes = np.nonzero(is_match)[0]
+    sorted_s2_indexes = s2_match_keys[is_match] % (s2_len + 1)
+
     return sorted_s1_indexes, sorted_s2_indexes
 
+def is_numeric(arr):
+    return isinstance(arr, np.ndarray) and (arr.dtype.kind in 'iuf')
+
 def get_matching_trips_and_arrival_times(
     s1_trip_values, s1_departure_time_values,
     s2_trip_values, s2_arrival_time_values,
@@ -5,9 +5,13 @@ import json
 import math
 from . import config
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import date
+import numpy as np
 import pandas as pd
+import ijson
 
 class CachedState:
     def __init__(self):
@@ -22,31 +26,24 @@ class CachedState:
 
         cache_path = self.cache_paths[route_id]
         print(f'loading state for route {route_id} from cache: {cache_path}')
-        buses = pd.read_csv(
-                cache_path,
-                dtype={
-                    'vid': str,
-                    'did': str,
-                },
-                float_precision='high', # keep precision for rounding lat/lon
-            ) \
-            .rename(columns={
-                'lat': 'LAT',
-                'lon': 'LON',
-                'vid': 'VID',
-                'did': 'DID',
-                'secsSinceReport': 'AGE',
-                'timestamp': 'RAW_TIME'
-            }) \
-            .reindex(['RAW_TIME', 'VID', 'LAT', 'LON', 'DID', 'AGE'], axis='columns')
-
-        # adjust each observation time for the number of seconds old the GPS location was when the observation was recorded
-        buses['TIME'] = (buses['RAW_TIME'] - buses['AGE'].fillna(0)) #.astype(np.int64)
-
-        buses = buses.drop(['RAW_TIME','AGE'], axis=1)
-        buses = buses.sort_values('TIME', axis=0)
-
-        return buses
+
+        with open(get_categories_path(cache_path), 'r') as f:
+            categories = json.loads(f.read())
+
+        records = read_records(cache_path)
+
+        # observations are written in the order they were received, so a stable sort keeps
+        # the original order of observations with the same time
+        sort_order = np.argsort(records['TIME'], kind='mergesort')
+        records = records[sort_order]
+
+        return pd.DataFrame({
+            'VID': get_category_values(records['VID'], categories['VID']),
+            'LAT': records['LAT'],
+            'LON': records['LON'],
+            'DID': get_category_values(records['DID'], categories['DID']),
+            'TIME': records['TIME'],
+        })
 
 def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> CachedState:
     # don't try to fetch historical vehicle data from the future
@@ -62,7 +59,8 @@ def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> Cache
     uncached_route_ids = []
     for route_id in route_ids:
         cache_path = get_cache_path(agency_id, d, start_time, end_time, route_id)
-        if Path(cache_path).exists():
+        # the categories file is written after the records file, so the cache is complete if it exists
+        if Path(get_categories_path(cache_path)).exists():
             state.add(route_id, cache_path)
         else:
             uncached_route_ids.append(route_id)
@@ -92,31 +90,64 @@ def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> Cache
 
     print(f"chunk_minutes = {chunk_minutes}")
 
-    chunk_start_time = start_time
-    allow_chunk_error = True # allow up to one trynapi error before raising an exception
+    # number of chunks to request from trynapi at the same time
+    trynapi_concurrency = os.environ.get('TRYNAPI_CONCURRENCY')
+    if trynapi_concurrency is None:
+        trynapi_concurrency = 4
+    else:
+        trynapi_concurrency = max(1, int(trynapi_concurrency))
+
+    print(f"trynapi_concurrency = {trynapi_concurrency}")
 
     state_cache_dir = Path(get_state_cache_dir(agency_id))
     if not state_cache_dir.exists():
         state_cache_dir.mkdir(parents = True, exist_ok = True)
 
     remove_route_temp_cache(agency_id)
+
+    # codes of VID and DID values in the temp cache file for each route
+    categories = {route_id: make_categories() for route_id in uncached_route_ids}
+
+    chunk_times = []
+    chunk_start_time = start_time
     while chunk_start_time < end_time:
-        # download trynapi data in chunks; each call return data for all routes
         chunk_end_time = min(chunk_start_time + 60 * chunk_minutes, end_time)
-        chunk_states = get_chunk_state(
-            agency_id,
-            chunk_start_time,
-            chunk_end_time,
-            uncached_route_ids,
-            chunk_minutes,
-            allow_chunk_error,
-        )
+        chunk_times.append((chunk_start_time, chunk_end_time))
         chunk_start_time = chunk_end_time
-        if chunk_states == False:
-            allow_chunk_error = False
-            continue
-        for chunk_state in chunk_states:
-            write_chunk_state(chunk_state, agency_id)
+
+    session = make_session(trynapi_concurrency)
+
+    # download trynapi data in chunks; each call returns data for all routes.
+    # several chunks are downloaded at once, but chunks are written to the temp cache files
+    # in time order. to limit memory usage, only a few chunks are kept in memory
+    # while waiting for earlier chunks to finish downloading.
+    with ThreadPoolExecutor(max_workers=trynapi_concurrency) as executor:
+        pending_chunks = deque()
+        next_chunk_index = 0
+
+        def request_next_chunk():
+            nonlocal next_chunk_index
+            if next_chunk_index < len(chunk_times):
+                chunk_start_time, chunk_end_time = chunk_times[next_chunk_index]
+                pending_chunks.append(executor.submit(
+                    get_chunk_state,
+                    agency_id,
+                    chunk_start_time,
+                    chunk_end_time,
+                    uncached_route_ids,
+                    session,
+                ))
+                next_chunk_index += 1
+
+        for i in range(trynapi_concurrency * 2):
+            request_next_chunk()
+
+        while len(pending_chunks) > 0:
+            chunk_states = pending_chunks.popleft().result()
+            request_next_chunk()
+
+            for chunk_state in chunk_states:
+                write_chunk_state(chunk_state, agency_id, categories[chunk_state['routeId']])
 
     # cache state per route so we don't have to request it again
     # if a route appears in a different list of routes
@@ -131,10 +162,13 @@ def get_state(agency_id: str, d: date, start_time, end_time, route_ids) -> Cache
         if not os.path.exists(temp_cache_path):
             # create empty cache file so that get_state doesn't need to request routes with no data again
             # if it is called again later
-            write_csv_header(temp_cache_path)
+            Path(temp_cache_path).touch()
 
         os.rename(temp_cache_path, cache_path)
 
+        with open(get_categories_path(cache_path), 'w') as f:
+            f.write(json.dumps({key: list(codes.keys()) for key, codes in categories[route_id].items()}))
+
         state.add(route_id, cache_path)
 
     return state
@@ -156,7 +190,7 @@ def get_state_cache_dir(agency_id):
     return os.path.join(
         source_dir,
         'data',
-        f"state_v2_{agency_id}",
+        f"state_v3_{agency_id}",
     )
 
 def get_route_temp_cache_path(agency_id: str, route_id: str) -> str:
@@ -164,48 +198,57 @@ def get_route_temp_cache_path(agency_id: str, route_id: str) -> str:
     source_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
     return os.path.join(
         get_state_cache_dir(agency_id),
-        f"state_{agency_id}_{route_id}_temp_cache.csv",
+        f"state_{agency_id}_{route_id}_temp_cache.bin",
     )
 
 def remove_route_temp_cache(agency_id: str):
-    """Removes all files with the ending temp_cache.csv in the
+    """Removes all files with the ending temp_cache.bin in the
     source data directory"""
-    source_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    dir = os.path.join(
-        source_dir,
-        'data',
-        f"state_v2_{agency_id}"
-    )
+    dir = get_state_cache_dir(agency_id)
     for path in os.listdir(dir):
-        if path.endswith('_temp_cache.csv'):
+        if path.endswith('_temp_cache.bin'):
             os.remove(os.path.join(dir, path))
 
 def get_cache_path(agency_id: str, d: date, start_time, end_time, route_id) -> str:
     validate_agency_route_path_attributes(agency_id, route_id)
     return os.path.join(
         get_state_cache_dir(agency_id),
-        f"{str(d)}/state_{agency_id}_{route_id}_{int(start_time)}_{int(end_time)}.csv",
+        f"{str(d)}/state_{agency_id}_{route_id}_{int(start_time)}_{int(end_time)}.bin",
     )
 
+def get_categories_path(cache_path: str) -> str:
+    return re.sub(r'\.bin$', '.json', cache_path)
+
+
+def make_session(max_connections) -> requests.Session:
+    """Returns a requests Session that reuses up to max_connections
+    HTTP connections to trynapi, which can be shared by multiple threads."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 def get_chunk_state(
     agency_id,
     chunk_start_time,
     chunk_end_time,
     uncached_route_ids,
-    chunk_minutes,
-    allow_error,
+    session=None,
 ):
     """Makes TrynAPI calls to assemble a chunk and returns list of chunk states,
-    with each state having the fields of routeId and states.
-    Returns False when allow_error is set to True, chunk_minutes is greater than 5,
-    and TrynAPI has an internal server error (data request too large).
+    with each state having the fields of routeId, records, and categories.
+    If TrynAPI has an internal server error (data request too large) and the chunk
+    is longer than 5 minutes, the chunk is split in half and each half is requested separately,
+    in which case the returned list contains the chunk states for the first half,
+    followed by the chunk states for the second half.
     """
     chunk_state = get_state_raw(
         agency_id,
         chunk_start_time,
         chunk_end_time,
         uncached_route_ids,
+        session,
     )
     if 'errors' in chunk_state:
         # trynapi returns an internal server error if you ask for too much data at once
@@ -214,56 +257,168 @@ def get_chunk_state(
         )
     if 'message' in chunk_state: # trynapi returns an internal server error if you ask for too much data at once
         error = f"trynapi error for time range {chunk_start_time}-{chunk_end_time}: {chunk_state['message']}"
-        if allow_error and chunk_minutes > 5:
+        chunk_minutes = (chunk_end_time - chunk_start_time) / 60
+        if chunk_minutes > 5:
             print(error)
-            chunk_minutes = math.ceil(chunk_minutes / 2)
-            print(f"chunk_minutes = {chunk_minutes}")
-            return False
-        else:
-            raise Exception(
-                f"trynapi error for time range {chunk_start_time}-{chunk_end_time}: {chunk_state['message']}"
+            chunk_mid_time = chunk_start_time + 60 * math.ceil(chunk_minutes / 2)
+            print(f"chunk_minutes = {math.ceil(chunk_minutes / 2)}")
+            return get_chunk_state(
+                agency_id,
+                chunk_start_time,
+                chunk_mid_time,
+                uncached_route_ids,
+                session,
+            ) + get_chunk_state(
+                agency_id,
+                chunk_mid_time,
+                chunk_end_time,
+                uncached_route_ids,
+                session,
             )
+        else:
+            raise Exception(error)
     if not ('data' in chunk_state):
         print(chunk_state)
         raise Exception(f'trynapi returned no data')
     return chunk_state['data']['state']['routes']
 
 
-# Properties of each vehicle as returned from tryn-api,
-# used for writing and reading chunk states to and from CSV files
-vehicle_keys = ['vid', 'lat', 'lon', 'did', 'secsSinceReport']
-
-def write_csv_header(path):
-    header_keys = ['timestamp'] + vehicle_keys
-    with open(path, 'w+') as chunk_out:
-        chunk_out.writelines([','.join(header_keys) + '\n'])
-
-def write_chunk_state(chunk_state, agency_id):
-    # TODO - use the write functions part of PR #578
-    """Writes chunks to a CSV for the given route in the given directory.
-    Appends states and creates a new file if one does not exist."""
+# GPS observations are cached in binary files containing a sequence of records with this dtype,
+# which can be appended to one chunk at a time and memory-mapped when reading.
+# VID and DID are stored as integer codes (or -1 for null values), and the list of strings for each code
+# is stored in a separate JSON file.
+# TIME is adjusted for the number of seconds old the GPS location was when the observation was recorded.
+StateRecordDtype = np.dtype([
+    ('TIME', np.int64),
+    ('LAT', np.float64),
+    ('LON', np.float64),
+    ('VID', np.int32),
+    ('DID', np.int32),
+])
+
+def make_categories() -> dict:
+    return {'VID': {}, 'DID': {}}
+
+def get_category_code(codes: dict, value) -> int:
+    if value is None:
+        return -1
+    value = str(value)
+    code = codes.get(value)
+    if code is None:
+        code = codes[value] = len(codes)
+    return code
+
+def get_category_values(codes: np.ndarray, values: list) -> np.ndarray:
+    values = np.array(values + [np.nan], dtype=object)
+    return values[codes] # code -1 selects nan
+
+def read_records(path) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=StateRecordDtype)
+    return np.memmap(path, dtype=StateRecordDtype, mode='r')
+
+class ChunkStateBuilder:
+    # Collects the GPS observations for one route in a chunk as the tryn-api response is parsed.
+    # VID and DID codes in the records are relative to this chunk, and are converted to the codes
+    # for the route's temp cache file in write_chunk_state.
+    def __init__(self, route_id):
+        self.route_id = route_id
+        self.categories = make_categories()
+        self.time_values = []
+        self.lat_values = []
+        self.lon_values = []
+        self.vid_codes = []
+        self.did_codes = []
+
+    def add(self, timestamp, vehicle: dict):
+        self.time_values.append(timestamp - (vehicle.get('secsSinceReport') or 0))
+        self.lat_values.append(vehicle.get('lat'))
+        self.lon_values.append(vehicle.get('lon'))
+        self.vid_codes.append(get_category_code(self.categories['VID'], vehicle.get('vid')))
+        self.did_codes.append(get_category_code(self.categories['DID'], vehicle.get('did')))
+
+    def get_chunk_state(self) -> dict:
+        records = np.empty(len(self.time_values), dtype=StateRecordDtype)
+        records['TIME'] = self.time_values
+        records['LAT'] = self.lat_values
+        records['LON'] = self.lon_values
+        records['VID'] = self.vid_codes
+        records['DID'] = self.did_codes
+
+        return {
+            'routeId': self.route_id,
+            'records': records,
+            'categories': {key: list(codes.keys()) for key, codes in self.categories.items()},
+        }
+
+def write_chunk_state(chunk_state, agency_id, categories):
+    """Appends the GPS observations in a chunk state to the temp cache file for the given route,
+    creating the file if it does not exist. `categories` contains the codes for VID and DID values
+    that were already written to the temp cache file, and is updated with any new values."""
     route_id = chunk_state['routeId']
     path = get_route_temp_cache_path(agency_id, route_id)
-    states = chunk_state['states']
-    if len(states) == 0:
+    records = chunk_state['records']
+    if len(records) == 0:
         return
 
-    if not os.path.exists(path):
-        write_csv_header(path)
+    records = records.copy()
+    for key in ['VID', 'DID']:
+        # the last element maps code -1 (null) to -1
+        code_map = np.array([
+            get_category_code(categories[key], value) for value in chunk_state['categories'][key]
+        ] + [-1], dtype=np.int32)
+        records[key] = code_map[records[key]]
 
-    with open(path, 'a') as chunk_out:
-        chunk_lines = []
-        for state in states:
-            timestamp = state['timestamp']
-            for vehicle in state['vehicles']:
-                chunk_line = ','.join(map(str, [timestamp]+ [
-                    vehicle[vehicle_key]
-                    for vehicle_key in vehicle_keys
-                ])) + '\n'
-                chunk_lines.append(chunk_line)
-        chunk_out.writelines(chunk_lines)
+    with open(path, 'ab') as chunk_out:
+        chunk_out.write(records.tobytes())
 
-def get_state_raw(agency_id, start_time, end_time, route_ids):
+def parse_state_response(response_file) -> dict:
+    """Parses the JSON response from a tryn-api state query incrementally from a file-like object,
+    so that the entire response never needs to be kept in memory at once.
+
+    Returns a dict with the same structure as the JSON response, except that each route in
+    data.state.routes is a chunk state with the fields routeId, records, and categories,
+    containing the GPS observations in the format of the binary state cache files.
+    """
+    routes_prefix = 'data.state.routes.item'
+    states_prefix = f'{routes_prefix}.states.item'
+    vehicles_prefix = f'{states_prefix}.vehicles.item'
+    vehicle_key_prefix = f'{vehicles_prefix}.'
+    vehicle_key_start = len(vehicle_key_prefix)
+
+    # everything besides the list of routes (e.g. errors) is small, so it is built as a normal dict
+    builder = ijson.ObjectBuilder()
+
+    routes = []
+    route_builder = None
+    timestamp = None
+    vehicle = None
+
+    for prefix, event, value in ijson.parse(response_file, use_float=True):
+        # the events for each vehicle are the most common, so they are checked first
+        if prefix.startswith(vehicle_key_prefix):
+            vehicle[prefix[vehicle_key_start:]] = value
+        elif not prefix.startswith(routes_prefix):
+            builder.event(event, value)
+        elif prefix == vehicles_prefix:
+            if event == 'start_map':
+                vehicle = {}
+            elif event == 'end_map':
+                route_builder.add(timestamp, vehicle)
+        elif prefix == f'{states_prefix}.timestamp':
+            timestamp = value
+        elif prefix == f'{routes_prefix}.routeId':
+            route_builder = ChunkStateBuilder(value)
+        elif prefix == routes_prefix and event == 'end_map':
+            routes.append(route_builder.get_chunk_state())
+            route_builder = None
+
+    response = builder.value
+    if isinstance(response, dict) and isinstance(response.get('data'), dict) and response['data'].get('state') is not None:
+        response['data']['state']['routes'] = routes
+    return response
+
+def get_state_raw(agency_id, start_time, end_time, route_ids, session=None):
 
     params = f'state(agencyId: {json.dumps(agency_id)}, startTime: {json.dumps(int(start_time))}, endTime: {json.dumps(int(end_time))}, routes: {json.dumps(route_ids)})'
 
@@ -287,13 +442,18 @@ def get_state_raw(agency_id, start_time, end_time, route_ids):
     print(params)
 
     query_url = f"{trynapi_url}/graphql?query={query}"
-    r = requests.get(query_url)
 
-    print(f"   response length = {len(r.text)}")
+    # the response is parsed while it is being downloaded, instead of reading the entire response
+    # into memory first, since large chunks may contain hundreds of MB of JSON
+    with (session or requests).get(query_url, stream=True) as r:
+        r.raw.decode_content = True
+        try:
+            response = parse_state_response(r.raw)
+        except ijson.JSONError:
+            print(f'invalid response from {query_url} (status {r.status_code})')
+            raise
+
+        print(f"   response length = {r.raw.tell()}")
 
-    try:
-        return json.loads(r.text)
-    except:
-        print(f'invalid response from {query_url}: {r.text}')
-        raise
+    return response
 
@@ -1,4 +1,6 @@
 from datetime import datetime, date, timedelta
+from contextlib import redirect_stdout
+import io
 import os
 import pytz
 import numpy as np
@@ -21,6 +23,38 @@ def quantile_sorted(sorted_arr, quantile):
     else:
         return quantile_lower
 
+def quantile_sorted_columns(sorted_arr, counts, quantile):
+    # Vectorized version of quantile_sorted for each column of a 2D array.
+    #
+    # Each column of sorted_arr should be sorted, and only the first counts[k] values of the k-th column
+    # are used (e.g. when NaN values are sorted at the end of each column by np.sort).
+    #
+    # Returns an array with the quantile of each column (or NaN for columns with no values),
+    # using the same calculation as quantile_sorted.
+
+    num_rows, num_columns = sorted_arr.shape
+
+    if num_rows == 0:
+        return np.full(num_columns, np.nan)
+
+    quantile_indexes = (counts - 1) * quantile
+    quantile_indexes_int = quantile_indexes.astype(int)
+    quantile_indexes_fractional = quantile_indexes - quantile_indexes_int
+
+    column_indexes = np.arange(num_columns)
+
+    quantiles_lower = sorted_arr[np.clip(quantile_indexes_int, 0, num_rows - 1), column_indexes]
+    quantiles_upper = sorted_arr[np.clip(quantile_indexes_int + 1, 0, num_rows - 1), column_indexes]
+
+    quantiles = np.where(
+        quantile_indexes_fractional > 0,
+        quantiles_lower + (quantiles_upper - quantiles_lower) * quantile_indexes_fractional,
+        quantiles_lower
+    )
+    quantiles[counts == 0] = np.nan
+
+    return quantiles
+
 def parse_date(date_str):
     (y,m,d) = date_str.split('-')
     return date(int(y),int(m),int(d))
@@ -121,4 +155,23 @@ def get_intervals(start_time, end_time, interval_length):
         ))
         rounded_start_time = new_start_time
 
-    return time_str_intervals
\ No newline at end of file
+    return time_str_intervals
+
+def call_with_captured_output(fn, *args, **kwargs) -> tuple:
+    # Calls fn(*args, **kwargs) and returns a tuple (everything it printed to stdout, return value).
+    #
+    # Used by functions that run in separate worker processes (e.g. with --jobs), which return
+    # their output to the parent process so that it can be printed in the same order as when running
+    # one at a time, instead of interleaving output from different processes.
+    #
+    # If fn raises an exception, the output printed before the exception is stored in the exception's
+    # output attribute, so that workers can still return it to the parent process.
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            result = fn(*args, **kwargs)
+    except Exception as ex:
+        ex.output = output.getvalue()
+        raise
+
+    return output.getvalue(), result
@@ -7,6 +7,15 @@ def get_stats(time_values, start_time=None, end_time=None):
 def combine_stats(interval_stats_arr):
     return MultiIntervalWaitTimeStats(interval_stats_arr)
 
+def get_quantile_for_intervals(time_values, timestamp_intervals, quantile):
+    # Returns a list with the wait time quantile (in minutes) for each (start_time, end_time) interval
+    # in timestamp_intervals, or None for intervals without any wait times. time_values is a sorted array of
+    # arrival or departure times, as for get_stats.
+    return [
+        get_stats(time_values, start_time, end_time).get_quantile(quantile)
+        for start_time, end_time in timestamp_intervals
+    ]
+
 # WaitTimeStats allows computing statistics about wait times within an interval,
 # (such as averages, percentiles, and histograms),
 # given a sorted array of arrival or departure times (Unix timestamps in seconds),
@@ -112,22 +121,22 @@ class WaitTimeStats:
 
         cdf_domain, cdf_range = cdf_points.T
 
-        quantile_values = []
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+
+        segment_end_indexes = np.searchsorted(cdf_range, quantiles)
+        segment_start_indexes = np.maximum(segment_end_indexes - 1, 0)
+
+        start_domains = cdf_domain[segment_start_indexes]
+        start_ranges = cdf_range[segment_start_indexes]
 
-        for quantile in quantiles:
-            segment_end_index = np.searchsorted(cdf_range, quantile)
-            if segment_end_index == 0:
-                quantile_values.append(cdf_domain[0])
-            else:
-                segment_start_index = segment_end_index - 1
-                # linear interpolation to find wait time where value of CDF = quantile
-                quantile_value = cdf_domain[segment_start_index] + \
-                    (quantile - cdf_range[segment_start_index]) / \
-                    (cdf_range[segment_end_index] - cdf_range[segment_start_index]) * \
-                    (cdf_domain[segment_end_index] - cdf_domain[segment_start_index])
-                quantile_values.append(quantile_value)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # linear interpolation to find wait time where value of CDF = quantile
+            quantile_values = start_domains + \
+                (quantiles - start_ranges) / \
+                (cdf_range[segment_end_indexes] - start_ranges) * \
+                (cdf_domain[segment_end_indexes] - start_domains)
 
-        return np.array(quantile_values)
+        return np.where(segment_end_indexes == 0, cdf_domain[0], quantile_values)
 
     def get_quantile(self, quantile):
         quantiles = self.get_quantiles([quantile])
@@ -148,17 +157,7 @@ class WaitTimeStats:
 
         cdf_domain, cdf_range = cdf_points.T
 
-        histogram = []
-        prev_cumulative_value = None
-        for bin_index, bin_value in enumerate(bins):
-            cumulative_value = evaluate_cdf(bin_value, cdf_domain, cdf_range)
-
-            if prev_cumulative_value is not None:
-                histogram.append(cumulative_value - prev_cumulative_value)
-
-            prev_cumulative_value = cumulative_value
-
-        return np.array(histogram)
+        return np.diff(evaluate_cdf_values(bins, cdf_domain, cdf_range))
 
     def get_probability_less_than(self, wait_time):
         cdf_points = self.get_cumulative_distribution()
@@ -244,20 +243,12 @@ class IntervalWaitTimeStats(WaitTimeStats):
 
         return total_wait / interval_elapsed_time / 60
 
-    def get_cumulative_distribution(self):
+    def get_wait_time_values(self):
+        # Returns an array of all of the wait times (in seconds) between which the CDF is piecewise linear,
+        # or None if there are no wait times within the interval.
         if self.is_empty:
             return None
 
-        if self.cdf_points is not None:
-            return self.cdf_points
-
-        interval_elapsed_time = self.interval_end - self.interval_start
-
-        start_arrival_index = self.start_arrival_index
-        end_arrival_index = self.end_arrival_index
-        interval_start = self.interval_start
-        interval_end = self.interval_end
-
         end_wait_time = self.end_wait_time
         end_elapsed_time = self.end_elapsed_time
 
@@ -266,53 +257,64 @@ class IntervalWaitTimeStats(WaitTimeStats):
         has_arrival = len(interval_headways) > 0
 
         if end_wait_time is not None:
-            wait_time_values = np.r_[
+            return np.r_[
                 interval_headways,
                 end_wait_time,
                 end_wait_time + end_elapsed_time,
                 0:(1 if has_arrival else 0), # only include 0 wait time if there are any arrivals within the interval
             ]
         elif has_arrival:
-            wait_time_values = np.r_[0, interval_headways]
+            return np.r_[0, interval_headways]
         else:
             return None
 
+    def get_cumulative_distribution(self):
+        if self.is_empty:
+            return None
+
+        if self.cdf_points is not None:
+            return self.cdf_points
+
+        wait_time_values = self.get_wait_time_values()
+        if wait_time_values is None:
+            return None
+
+        interval_elapsed_time = self.interval_end - self.interval_start
+
+        end_wait_time = self.end_wait_time
+
         # sorted_wait_time_values are all of the x-coordinates
         # between which the CDF is piecewise linear
         sorted_wait_time_values = np.sort(wait_time_values)
 
         num_wait_time_values = len(sorted_wait_time_values)
 
-        prev_wait_time = None
-
-        tot_elapsed = 0 # number of seconds in interval with wait time less than the current wait time
-
-        # each point is (wait time in seconds, percentage of interval having wait time less than that).
-        # CDF of wait times is piecewise linear between the returned points.
-        points = []
-
-        for i in range(0, len(sorted_wait_time_values)):
-            wait_time = sorted_wait_time_values[i]
+        wait_time_diffs = np.diff(sorted_wait_time_values)
 
-            if prev_wait_time is None or wait_time > prev_wait_time:
-                num_occurrences_with_smaller_wait_time = num_wait_time_values - i
-                if end_wait_time is not None and wait_time <= end_wait_time:
-                    # for wait times less than or equal to end_wait_time,
-                    # adjust num_occurrences_with_smaller_wait_time to avoid counting end_wait_time and end_wait_time + end_elapsed_time
-                    # otherwise, no adjustment needed
-                    num_occurrences_with_smaller_wait_time -= 2
+        # for each wait time after the first, the number of wait time values greater than or equal to it
+        # (i.e. the number of triangles with at least that height)
+        num_occurrences_with_smaller_wait_time = num_wait_time_values - np.arange(1, num_wait_time_values)
+        if end_wait_time is not None:
+            # for wait times less than or equal to end_wait_time,
+            # adjust num_occurrences_with_smaller_wait_time to avoid counting end_wait_time and end_wait_time + end_elapsed_time
+            # otherwise, no adjustment needed
+            num_occurrences_with_smaller_wait_time -= 2 * (sorted_wait_time_values[1:] <= end_wait_time)
 
-                if prev_wait_time is None:
-                    elapsed = 0
-                else:
-                    # the number of seconds in the interval that someone would wait between prev_wait_time and wait_time
-                    elapsed = (wait_time - prev_wait_time) * num_occurrences_with_smaller_wait_time
+        # the number of seconds in the interval that someone would wait between each wait time and the previous wait time
+        # (duplicate wait times add 0 seconds)
+        elapsed = wait_time_diffs * num_occurrences_with_smaller_wait_time
 
-                tot_elapsed += elapsed
+        # number of seconds in interval with wait time less than each wait time
+        tot_elapsed = np.zeros(num_wait_time_values, dtype=elapsed.dtype)
+        np.cumsum(elapsed, out=tot_elapsed[1:])
 
-                points.append((wait_time / 60, tot_elapsed / interval_elapsed_time))
+        # only include the first occurrence of each unique wait time
+        is_unique = np.ones(num_wait_time_values, dtype=bool)
+        np.not_equal(wait_time_diffs, 0, out=is_unique[1:])
 
-                prev_wait_time = wait_time
+        # each point is (wait time in seconds, percentage of interval having wait time less than that).
+        # CDF of wait times is piecewise linear between the returned points.
+        points = np.column_stack((sorted_wait_time_values[is_unique] / 60, tot_elapsed[is_unique] / interval_elapsed_time))
 
         # if the logic above is correct,
         # the first returned point should be (min wait time, 0.0), and
@@ -322,14 +324,14 @@ class IntervalWaitTimeStats(WaitTimeStats):
             print('Invalid cumulative distribution:', file=sys.stderr)
             print(points, file=sys.stderr)
             print('Interval headways:', file=sys.stderr)
-            print(interval_headways, file=sys.stderr)
-            print('Sorted wait time values:', file=sys.stderr)
-            print(sorted_wait_time_values, file=sys.stderr)
-            print(f'End elapsed time: {end_elapsed_time}', file=sys.stderr)
+            print(self.interval_headways, file=sys.stderr)
+            print('Wait time values:', file=sys.stderr)
+            print(wait_time_values, file=sys.stderr)
+            print(f'End elapsed time: {self.end_elapsed_time}', file=sys.stderr)
             print(f'End wait time: {end_wait_time}', file=sys.stderr)
             raise AssertionError('Invalid cumulative distribution')
 
-        self.cdf_points = np.array(points)
+        self.cdf_points = points
 
         return self.cdf_points
 
@@ -413,18 +415,38 @@ class MultiIntervalWaitTimeStats(WaitTimeStats):
 
         combined_domain = np.unique(np.concatenate(cdf_domains))
 
-        combined_cdf_points = []
+        total_values = np.zeros(len(combined_domain))
+        for cdf_domain, cdf_range in zip(cdf_domains, cdf_ranges):
+            total_values += evaluate_cdf_values(combined_domain, cdf_domain, cdf_range)
+
+        self.cdf_points = np.column_stack((combined_domain, total_values / num_intervals))
 
-        for wait_time in combined_domain:
-            total_value = 0
-            for cdf_domain, cdf_range in zip(cdf_domains, cdf_ranges):
-                total_value += evaluate_cdf(wait_time, cdf_domain, cdf_range)
+        return self.cdf_points
 
-            combined_cdf_points.append((wait_time, total_value / num_intervals))
+def evaluate_cdf_values(wait_time_values, cdf_domain, cdf_range) -> np.ndarray:
+    # Returns an array with the value of the CDF for each wait time in wait_time_values,
+    # computed the same way as evaluate_cdf.
+    wait_time_values = np.asarray(wait_time_values, dtype=np.float64)
 
-        self.cdf_points = np.array(combined_cdf_points)
+    segment_end_indexes = np.searchsorted(cdf_domain, wait_time_values)
 
-        return self.cdf_points
+    num_points = len(cdf_domain)
+    segment_start_indexes = np.clip(segment_end_indexes - 1, 0, num_points - 1)
+    clipped_segment_end_indexes = np.minimum(segment_end_indexes, num_points - 1)
+
+    prev_values = cdf_range[segment_start_indexes]
+    extra_wait_times = wait_time_values - cdf_domain[segment_start_indexes]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # linear interpolation to find value of CDF for wait time
+        values = prev_values + \
+            extra_wait_times / \
+            (cdf_domain[clipped_segment_end_indexes] - cdf_domain[segment_start_indexes]) * \
+            (cdf_range[clipped_segment_end_indexes] - prev_values)
+
+    values = np.where(extra_wait_times == 0, prev_values, values)
+    values = np.where(segment_end_indexes == 0, 0.0, values)
+    return np.where(segment_end_indexes >= num_points, 1.0, values)
 
 def evaluate_cdf(wait_time, cdf_domain, cdf_range):
     segment_end_index = np.searchsorted(cdf_domain, wait_time)
@@ -1,12 +1,25 @@
 import backend_path
 import unittest
 import datetime
+import json
+import os
+import tempfile
+from unittest import mock
 import numpy as np
 import pandas as pd
-from backend.models import arrival_history
+from backend.models import arrival_history, util
 
 class ArrivalHistoryTest(unittest.TestCase):
 
+    def setUp(self):
+        # save arrival histories in a temporary data directory
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+
+        get_data_dir = mock.patch.object(util, 'get_data_dir', return_value=data_dir.name)
+        get_data_dir.start()
+        self.addCleanup(get_data_dir.stop)
+
     def test_get_data_frame(self):
         d = datetime.date(2019,12,28)
         start_time = 1577530800
@@ -69,5 +82,131 @@ class ArrivalHistoryTest(unittest.TestCase):
         self.assertEqual(df['TIME'].values[0], 1577530990)
         self.assertEqual(df['TIME'].values[-1], 1577550900)
 
+    def test_get_by_date_use_cache(self):
+        d = datetime.date(2019,12,29)
+        start_time = 1577617200
+
+        arrivals_df = pd.DataFrame([
+                ['V1', 1577617300, 1577617360, 3, 'S1', '1', 2],
+                ['V1', 1577617390, 1577617410, 4, 'S2', '1', 2],
+            ],
+            columns=[
+                'VID','TIME','DEPARTURE_TIME','DIST','SID','DID','TRIP'
+            ]
+        )
+
+        arrival_history.save_for_date(arrival_history.from_data_frame('test', 'cached', arrivals_df, start_time, start_time + 86400), d)
+
+        history = arrival_history.get_by_date('test', 'cached', d, use_cache=True)
+        self.assertIs(arrival_history.get_by_date('test', 'cached', d, use_cache=True), history)
+        self.assertIsNot(arrival_history.get_by_date('test', 'cached', d), history)
+
+        # saving the history again modifies the cache file, so it is reloaded
+        arrival_history.save_for_date(arrival_history.from_data_frame('test', 'cached', arrivals_df[:1], start_time, start_time + 86400), d)
+        cache_path = arrival_history.get_cache_path('test', 'cached', d)
+        mtime_ns = os.stat(cache_path).st_mtime_ns + 1000000
+        os.utime(cache_path, ns=(mtime_ns, mtime_ns))
+
+        reloaded_history = arrival_history.get_by_date('test', 'cached', d, use_cache=True)
+        self.assertIsNot(reloaded_history, history)
+        self.assertEqual(len(reloaded_history.get_data_frame()), 1)
+
+    def test_columnar_format(self):
+        stops_data = {
+            'S1': {'arrivals': {
+                '1': [{'t': 1577530900, 'e': 1577530960, 'd': 3, 'v': 'V1', 'i': 2}, {'t': 1577540900, 'e': 1577540960, 'd': 6, 'v': 'V2', 'i': 3}],
+                '0': [{'t': 1577551020, 'e': 1577551030, 'd': 11, 'v': 'V1', 'i': 4}],
+            }},
+            'S2': {'arrivals': {
+                '1': [{'t': 1577530990, 'e': 1577531010, 'd': 4, 'v': 'V1', 'i': 2}],
+            }},
+        }
+
+        history = arrival_history.ArrivalHistory('test', 'A', stops_data, 1577530800, 1577617200)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'arrivals.npz')
+            arrival_history.save_columnar(history, path)
+            columnar_history = arrival_history.load_columnar(path)
+
+        self.assertEqual(columnar_history.agency_id, 'test')
+        self.assertEqual(columnar_history.route_id, 'A')
+        self.assertEqual(columnar_history.start_time, 1577530800)
+        self.assertEqual(columnar_history.end_time, 1577617200)
+        self.assertEqual(columnar_history.version, arrival_history.DefaultVersion)
+
+        self.assertEqual(json.dumps(columnar_history.get_data()), json.dumps(history.get_data()))
+
+        for params in [{}, {'stop_id': 'S1'}, {'direction_id': '1', 'vehicle_id': 'V1'}, {'stop_id': 'S3'}, {'end_time': 1577540900}]:
+            pd.testing.assert_frame_equal(
+                columnar_history.get_data_frame(**params),
+                history.get_data_frame(**params)
+            )
+
+        df = columnar_history.get_data_frame()
+        self.assertEqual(list(df['SID'].values), ['S1', 'S1', 'S1', 'S2'])
+        self.assertEqual(list(df['DID'].values), ['1', '1', '0', '1'])
+        self.assertEqual(list(df['TIME'].values), [1577530900, 1577540900, 1577551020, 1577530990])
+
+    def test_get_index(self):
+        stops_data = {
+            'S1': {'arrivals': {
+                '1': [{'t': 100, 'v': 'V1'}, {'t': 200, 'v': 'V2'}, {'t': 300, 'v': 'V1'}],
+                '0': [{'t': 150, 'v': 'V1'}],
+            }},
+            'S2': {'arrivals': {
+                '1': [{'t': 110, 'v': 'V1'}, {'t': 210, 'v': 'V2'}],
+            }},
+        }
+
+        history = arrival_history.ArrivalHistory('test', 'A', stops_data, version='v2')
+
+        stop_ranges, is_sorted = history.get_index()
+        self.assertTrue(is_sorted)
+        self.assertEqual(stop_ranges, {
+            'S1': [('1', 0, 3), ('0', 3, 4)],
+            'S2': [('1', 4, 6)],
+        })
+
+        df = history.get_data_frame(direction_id='1', start_time=110, end_time=300)
+        self.assertEqual(list(df['TIME'].values), [200, 110, 210])
+        self.assertEqual(list(df['SID'].values), ['S1', 'S2', 'S2'])
+
+        df = history.get_data_frame(stop_id='S1', direction_id='1', vehicle_id='V1', start_time=150)
+        self.assertEqual(list(df['TIME'].values), [300])
+
+        df = history.get_data_frame(stop_id='S1', direction_id='2')
+        self.assertTrue(df.empty)
+
+    def test_find_closest_arrival_times(self):
+        stops_data = {
+            'S1': {'arrivals': {
+                '1': [{'t': 100, 'v': 'V1'}, {'t': 200, 'v': 'V2'}, {'t': 300, 'v': 'V1'}],
+                '0': [{'t': 150, 'v': 'V1'}, {'t': 250, 'v': 'V2'}],
+            }},
+            'S2': {'arrivals': {
+                '1': [{'t': 110, 'v': 'V1'}, {'t': 210, 'v': 'V2'}],
+            }},
+        }
+
+        history = arrival_history.ArrivalHistory('test', 'A', stops_data, version='v2')
+
+        closest_times = history.find_closest_arrival_times(
+            ['S1', 'S1', 'S1', 'S1', 'S1', 'S2', 'S2', 'S3', 'S1'],
+            ['V1', 'V1', 'V1', 'V1', 'V2', 'V1', 'V2', 'V1', 'V3'],
+            [0, 124, 125, 126, 226, 1000, 200, 100, 100],
+        )
+        # at 125, arrivals at 100 and 150 are equally close, and 100 appears first
+        self.assertEqual(closest_times.tolist()[:7], [100, 100, 100, 150, 250, 110, 210])
+        self.assertTrue(np.isnan(closest_times[7:]).all())
+
+        # at 225, arrivals at 200 and 250 are equally close, and 200 appears first
+        closest_times = history.find_closest_arrival_times(['S1', 'S1', 'S2'], None, [225, 280, 160])
+        self.assertEqual(closest_times.tolist(), [200, 300, 110])
+
+        self.assertEqual(history.find_closest_arrival_time('S1', 'V2', 180), 200)
+        self.assertEqual(history.find_closest_arrival_time('S1', None, 140), 150)
+        self.assertIsNone(history.find_closest_arrival_time('S2', 'V3', 100))
+
 if __name__ == '__main__':
     unittest.main()
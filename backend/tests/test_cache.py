@@ -0,0 +1,176 @@
+import backend_path
+import unittest
+import os
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+from backend.models import cache
+
+class CacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        c = cache.LRUCache('test', 3000)
+
+        c.set('a', np.zeros(100)) # 800 bytes
+        c.set('b', np.zeros(100))
+        c.set('c', np.zeros(100))
+
+        self.assertIsNotNone(c.get('a')) # 'b' is now least recently used
+
+        c.set('d', np.zeros(100))
+
+        self.assertIsNone(c.get('b'))
+        self.assertIsNotNone(c.get('a'))
+        self.assertIsNotNone(c.get('c'))
+        self.assertIsNotNone(c.get('d'))
+
+        # values larger than the cache are not stored
+        c.set('e', np.zeros(1000))
+        self.assertIsNone(c.get('e'))
+
+        stats = c.get_stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 4)
+        self.assertEqual(stats['misses'], 2)
+        self.assertLessEqual(stats['bytes'], 3000)
+        self.assertGreaterEqual(stats['bytes'], 2400)
+
+    def test_ttl(self):
+        c = cache.LRUCache('test', 10000)
+
+        c.set('a', 1, ttl=0.05)
+        c.set('b', 2)
+
+        self.assertEqual(c.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('b'), 2)
+        self.assertEqual(c.get_stats()['entries'], 1)
+
+    def test_get_or_compute(self):
+        c = cache.LRUCache('test', 10000)
+
+        calls = []
+        def compute():
+            calls.append(1)
+            return 'value'
+
+        self.assertEqual(c.get_or_compute('a', compute), 'value')
+        self.assertEqual(c.get_or_compute('a', compute), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_compute_version(self):
+        c = cache.LRUCache('test', 10000)
+
+        versions = [1]
+        calls = []
+        def compute():
+            calls.append(1)
+            return f'value{versions[0]}'
+
+        self.assertEqual(c.get_or_compute('a', compute, get_version=lambda: versions[0]), 'value1')
+        self.assertEqual(c.get_or_compute('a', compute, get_version=lambda: versions[0]), 'value1')
+        self.assertEqual(len(calls), 1)
+
+        versions[0] = 2
+        self.assertEqual(c.get_or_compute('a', compute, get_version=lambda: versions[0]), 'value2')
+        self.assertEqual(len(calls), 2)
+
+        # values are always recomputed if the version is unknown
+        versions[0] = None
+        c.get_or_compute('a', compute, get_version=lambda: versions[0])
+        c.get_or_compute('a', compute, get_version=lambda: versions[0])
+        self.assertEqual(len(calls), 4)
+
+    def test_get_or_compute_concurrent(self):
+        c = cache.LRUCache('test', 10000)
+
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        results = []
+        def get():
+            results.append(c.get_or_compute('a', compute, get_version=lambda: 1))
+
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(c.get_stats()['shared_loads'], 4)
+
+    def test_get_or_compute_concurrent_error(self):
+        c = cache.LRUCache('test', 10000)
+
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            raise FileNotFoundError('not found')
+
+        errors = []
+        def get():
+            try:
+                c.get_or_compute('a', compute)
+            except FileNotFoundError as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=get) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_get_file_version(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'test.json')
+            self.assertIsNone(cache.get_file_version(path))
+
+            with open(path, 'w') as f:
+                f.write('{}')
+
+            version = cache.get_file_version(path)
+            self.assertIsNotNone(version)
+
+            os.utime(path, ns=(version + 1000000000, version + 1000000000))
+            self.assertEqual(cache.get_file_version(path), version + 1000000000)
+
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+            self.assertIsNone(cache.get_file_version(path, max_age=3600))
+
+    def test_get_size(self):
+        arr = np.zeros(1000)
+        self.assertGreaterEqual(cache.get_size(arr), 8000)
+
+        df = pd.DataFrame({'TIME': np.arange(1000), 'SID': ['S1'] * 1000})
+        self.assertGreaterEqual(cache.get_size(df), 8000 + 1000 * 8)
+
+        # large dicts and lists are estimated from a sample of their items
+        data = {str(i): {'t': i, 'v': f'V{i}'} for i in range(10000)}
+        size = cache.get_size(data)
+        self.assertGreater(size, 10000 * 100)
+        self.assertLess(size, 10000 * 1000)
+
+        # shared objects are only counted once
+        self.assertLess(cache.get_size([arr, arr]), 2 * 8000)
+
+    def test_get_cache(self):
+        c = cache.get_cache('test_get_cache', 1)
+        self.assertIs(cache.get_cache('test_get_cache', 2), c)
+        self.assertEqual(c.max_bytes, 1024 * 1024)
+        self.assertIn('test_get_cache', [stats['name'] for stats in cache.get_all_stats()])
+
+if __name__ == '__main__':
+    unittest.main()
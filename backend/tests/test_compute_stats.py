@@ -0,0 +1,164 @@
+import backend_path
+import unittest
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import mock
+import pandas as pd
+
+# compute_stats.py is a command line script in the backend directory, which imports `models` directly
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute_stats
+from models import arrival_history, config, precomputed_stats, routeconfig, timetables, util
+
+stop_ids = ['S1', 'S2', 'S3', 'S4']
+
+def make_route_config(route_id):
+    return routeconfig.RouteConfig('test', {
+        'id': route_id,
+        'title': route_id,
+        'url': '',
+        'type': 3,
+        'sort_order': 0,
+        'gtfs_route_id': route_id,
+        'directions': [
+            {'id': '0', 'title': '0', 'gtfs_direction_id': '0', 'gtfs_shape_id': 'SH0', 'stop_geometry': {}, 'stops': stop_ids},
+            {'id': '1', 'title': '1', 'gtfs_direction_id': '1', 'gtfs_shape_id': 'SH1', 'stop_geometry': {}, 'stops': stop_ids[::-1]},
+        ],
+        'stops': {
+            stop_id: {'id': stop_id, 'title': stop_id, 'lat': 37.7 + i * 0.005, 'lon': -122.4}
+            for i, stop_id in enumerate(stop_ids)
+        },
+    })
+
+def make_arrivals(date_start_time, headway, stop_seconds):
+    # arrivals for trips in both directions every `headway` seconds from 6 AM to 10 PM
+    rows = []
+    trip = 0
+    for trip_start_time in range(date_start_time + 6 * 3600, date_start_time + 22 * 3600, headway):
+        for dir_id, dir_stop_ids in [('0', stop_ids), ('1', stop_ids[::-1])]:
+            for i, stop_id in enumerate(dir_stop_ids):
+                arrival_time = trip_start_time + i * stop_seconds
+                rows.append([f'V{trip % 5}', arrival_time, arrival_time + 20, 10.0, stop_id, dir_id, i, 1, trip])
+            trip += 1
+    return pd.DataFrame(rows, columns=['VID','TIME','DEPARTURE_TIME','DIST','SID','DID','STOP_INDEX','OBS_GROUP','TRIP'])
+
+class ComputeStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        # save routes, timetables, arrival histories and stats in a temporary data directory
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+
+        get_data_dir = mock.patch.object(util, 'get_data_dir', return_value=data_dir.name)
+        get_data_dir.start()
+        self.addCleanup(get_data_dir.stop)
+
+        self.d = datetime.date(2019, 12, 2)
+        self.agency = config.get_agency('test')
+        self.date_start_time = int(util.get_localized_datetime(self.d, '00:00', self.agency.tz).timestamp())
+        self.routes = [make_route_config('A'), make_route_config('B')]
+
+        routeconfig.save_routes('test', self.routes)
+
+        date_key = str(self.d)
+        date_keys_path = Path(timetables.get_date_keys_cache_path('test'))
+        date_keys_path.parent.mkdir(parents=True, exist_ok=True)
+        date_keys_path.write_text(json.dumps({'date_keys': {str(self.d): date_key}}))
+
+        for route in self.routes:
+            timetable_path = Path(timetables.get_cache_path('test', route.id, date_key))
+            timetable_path.parent.mkdir(parents=True, exist_ok=True)
+
+            scheduled_arrivals = make_arrivals(self.date_start_time, 900, 120)
+            timetable_path.write_text(json.dumps({
+                'timezone_id': self.agency.timezone_id,
+                'arrivals': {
+                    dir_id: {
+                        stop_id: [
+                            {'t': int(row.TIME - self.date_start_time), 'e': int(row.DEPARTURE_TIME - self.date_start_time), 'i': str(row.TRIP)}
+                            for row in stop_arrivals.itertuples()
+                        ]
+                        for stop_id, stop_arrivals in dir_arrivals.groupby('SID')
+                    }
+                    for dir_id, dir_arrivals in scheduled_arrivals.groupby('DID')
+                },
+            }))
+
+            self.save_history(route.id, make_arrivals(self.date_start_time + 60, 900, 130))
+
+        self.computed_route_ids = []
+        original_compute_stats_for_route = compute_stats.compute_stats_for_route
+
+        def compute_stats_for_route(d, agency, route_id, scheduled=False):
+            self.computed_route_ids.append(route_id)
+            return original_compute_stats_for_route(d, agency, route_id, scheduled)
+
+        compute_stats_for_route_patch = mock.patch.object(compute_stats, 'compute_stats_for_route', compute_stats_for_route)
+        compute_stats_for_route_patch.start()
+        self.addCleanup(compute_stats_for_route_patch.stop)
+
+    def save_history(self, route_id, arrivals):
+        history = arrival_history.from_data_frame('test', route_id, arrivals, self.date_start_time, self.date_start_time + 86400)
+        arrival_history.save_for_date(history, self.d)
+
+    def compute_stats(self, routes, incremental):
+        self.computed_route_ids = []
+        with redirect_stdout(io.StringIO()):
+            compute_stats.compute_stats(self.d, self.agency, routes, save_to_s3=False, incremental=incremental)
+        return sorted(self.computed_route_ids)
+
+    def get_saved_stats(self):
+        time_str_intervals, timestamp_intervals = compute_stats.get_intervals(self.d, self.agency.tz)
+        return {
+            (stat_id, start_time_str, end_time_str): precomputed_stats.get_precomputed_stats('test', stat_id, self.d, start_time_str, end_time_str).data
+            for stat_id in precomputed_stats.AllStatIds
+            for start_time_str, end_time_str in time_str_intervals
+        }
+
+    def test_incremental_stats(self):
+        self.assertEqual(self.compute_stats(self.routes, incremental=False), ['A', 'B'])
+        self.assertEqual(set(precomputed_stats.get_manifest('test', self.d).keys()), {'A', 'B'})
+
+        self.assertEqual(self.compute_stats(self.routes, incremental=True), [])
+
+        # only the route with a modified arrival history is recomputed
+        self.save_history('B', make_arrivals(self.date_start_time + 60, 600, 110))
+
+        self.assertEqual(self.compute_stats(self.routes, incremental=True), ['B'])
+        incremental_stats = self.get_saved_stats()
+
+        self.assertEqual(self.compute_stats(self.routes, incremental=False), ['A', 'B'])
+        self.assertEqual(incremental_stats, self.get_saved_stats())
+
+        for stats_data in incremental_stats.values():
+            self.assertEqual(set(stats_data['routes'].keys()), {'A', 'B'})
+
+        self.assertNotEqual(
+            incremental_stats[(precomputed_stats.StatIds.Combined, None, None)]['routes']['A'],
+            incremental_stats[(precomputed_stats.StatIds.Combined, None, None)]['routes']['B']
+        )
+
+        # a route removed from the route list is removed from the saved stats, even if no routes changed
+        self.assertEqual(self.compute_stats(self.routes[1:], incremental=True), [])
+
+        for stats_data in self.get_saved_stats().values():
+            self.assertEqual(set(stats_data['routes'].keys()), {'B'})
+        self.assertEqual(set(precomputed_stats.get_manifest('test', self.d).keys()), {'B'})
+
+        # all routes are recomputed after changing how stats are computed
+        stats_computation_version = compute_stats.StatsComputationVersion
+        try:
+            compute_stats.StatsComputationVersion += 1
+            self.assertEqual(self.compute_stats(self.routes, incremental=True), ['A', 'B'])
+        finally:
+            compute_stats.StatsComputationVersion = stats_computation_version
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+import backend_path
+import unittest
+import numpy as np
+import pandas as pd
+from backend.models import eclipses, routeconfig, util
+
+class EclipsesTest(unittest.TestCase):
+
+    def test_resample_buses(self):
+        route_state = pd.DataFrame([
+                ['V2', '0', 37.8, -122.4, 990],
+                ['V1', '1', 37.7, -122.4, 1000],
+                ['V1', '1', 37.7, -122.4, 1001], # duplicate observation
+                ['V1', '1', 37.7009, -122.4, 1060], # moved ~100 m
+                ['V1', '0', 37.7009, -122.4, 4000], # after 30+ minute gap
+            ],
+            columns=['VID','DID','LAT','LON','TIME']
+        )
+
+        buses = eclipses.resample_buses(route_state)
+
+        self.assertEqual(list(buses.columns), ['VID','DID','LAT','LON','TIME','OBS_GROUP'])
+        self.assertEqual(buses['TIME'].dtype, np.int64)
+        self.assertEqual(list(buses.index), list(range(10)))
+
+        self.assertEqual(list(buses['VID']), ['V1'] * 8 + ['V2'] * 2)
+        self.assertEqual(list(buses['DID']), ['1', '1', '1', '1', '1', '', '0', '', '0', ''])
+        self.assertEqual(list(buses['TIME']), [1000, 1015, 1030, 1045, 1060, 0, 4000, 0, 990, 0])
+        self.assertEqual(list(buses['OBS_GROUP']), [1, 1, 1, 1, 1, 0, 2, 0, 1, 0])
+
+        np.testing.assert_allclose(buses['LAT'].values, [
+            37.7, 37.700225, 37.70045, 37.700675, 37.7009, 0, 37.7009, 0, 37.8, 0
+        ])
+        np.testing.assert_allclose(buses['LON'].values, [
+            -122.4, -122.4, -122.4, -122.4, -122.4, 0, -122.4, 0, -122.4, 0
+        ])
+
+    def test_resample_buses_empty(self):
+        route_state = pd.DataFrame({
+            'VID': np.array([], dtype=object),
+            'DID': np.array([], dtype=object),
+            'LAT': np.array([], dtype=np.float64),
+            'LON': np.array([], dtype=np.float64),
+            'TIME': np.array([], dtype=np.int64),
+        })
+
+        buses = eclipses.resample_buses(route_state)
+
+        self.assertTrue(buses.empty)
+        self.assertEqual(list(buses.columns), ['VID','DID','LAT','LON','TIME','OBS_GROUP'])
+
+    def test_stop_distances(self):
+        route_config = routeconfig.RouteConfig('test', {
+            'id': 'A',
+            'title': 'A',
+            'url': '',
+            'type': 3,
+            'sort_order': 0,
+            'gtfs_route_id': 'A',
+            'directions': [],
+            'stops': {
+                'S1': {'id': 'S1', 'title': 'S1', 'lat': 37.7, 'lon': -122.4},
+                'S2': {'id': 'S2', 'title': 'S2', 'lat': 37.705, 'lon': -122.41},
+            },
+        })
+
+        rng = np.random.RandomState(0)
+        buses = pd.DataFrame({
+            'LAT': 37.7 + rng.uniform(-0.01, 0.01, 2000),
+            'LON': -122.4 + rng.uniform(-0.02, 0.02, 2000),
+        })
+
+        stop_distances = eclipses.StopDistances(buses, route_config, max_radius=200)
+
+        for stop_id in ['S1', 'S2']:
+            stop_info = route_config.get_stop_info(stop_id)
+            all_distance_values = util.haver_distance(stop_info.lat, stop_info.lon, buses['LAT'].values, buses['LON'].values)
+            expected_rows = np.nonzero(all_distance_values < 200)[0]
+
+            row_values, distance_values = stop_distances.get_nearby_rows(stop_id)
+
+            self.assertGreater(len(expected_rows), 0)
+            self.assertEqual(row_values.tolist(), expected_rows.tolist())
+            self.assertEqual(distance_values.tolist(), all_distance_values[expected_rows].tolist())
+
+    def test_possible_arrivals_for_direction(self):
+        stop_lats = [37.700, 37.702, 37.704, 37.706]
+        route_config = routeconfig.RouteConfig('test', {
+            'id': 'A',
+            'title': 'A',
+            'url': '',
+            'type': 3,
+            'sort_order': 0,
+            'gtfs_route_id': 'A',
+            'directions': [
+                {'id': '0', 'title': '0', 'gtfs_direction_id': '0', 'gtfs_shape_id': 'SH0', 'stop_geometry': {}, 'stops': ['S1', 'S2', 'S3', 'S4']},
+                {'id': '1', 'title': '1', 'gtfs_direction_id': '1', 'gtfs_shape_id': 'SH1', 'stop_geometry': {}, 'stops': ['S4', 'S3', 'S2', 'S1']},
+            ],
+            'stops': {
+                f'S{i+1}': {'id': f'S{i+1}', 'title': f'S{i+1}', 'lat': lat, 'lon': -122.4}
+                for i, lat in enumerate(stop_lats)
+            },
+        })
+
+        # V1 travels from S1 to S4 and back, V2 travels from S4 to S1, waiting at S3 for a few minutes
+        rows = []
+        for i, lat in enumerate(np.arange(37.6995, 37.7066, 0.0003)):
+            rows.append(['V1', '0', lat, -122.4, 1000 + i * 20])
+            rows.append(['V1', '1', 37.7066 - (lat - 37.6995), -122.4, 3000 + i * 20])
+        for i, lat in enumerate(np.arange(37.7066, 37.6995, -0.0003)):
+            rows.append(['V2', '1', lat, -122.4001, 2000 + i * 20 + (300 if lat < 37.704 else 0)])
+        route_state = pd.DataFrame(rows, columns=['VID','DID','LAT','LON','TIME']).sort_values('TIME')
+
+        buses = eclipses.resample_buses(route_state)
+        buses = buses[buses['TIME'] != 0]
+
+        stop_distances = eclipses.StopDistances(buses, route_config, max_radius=200)
+
+        for dir_info in route_config.get_direction_infos():
+            possible_arrivals = eclipses.get_possible_arrivals_for_direction(buses, stop_distances, dir_info, max_radius=200)
+
+            stop_arrays = dir_info.get_stop_arrays()
+            radius_values = stop_arrays.get_radius_values(200)
+
+            expected_possible_arrivals = pd.concat([
+                eclipses.get_possible_arrivals_for_stop(buses, stop_distances, stop_id,
+                    direction_id=dir_info.id,
+                    stop_index=stop_index,
+                    adjacent_stop_ids=[
+                        stop_arrays.stop_ids[other_index]
+                        for other_index in (stop_arrays.prev_index_values[stop_index], stop_arrays.next_index_values[stop_index])
+                        if other_index >= 0
+                    ],
+                    radius=radius_values[stop_index],
+                    is_terminal=stop_arrays.is_terminal_values[stop_index],
+                )
+                for stop_index, stop_id in enumerate(dir_info.get_stop_ids())
+            ], ignore_index=True)
+
+            self.assertEqual(list(possible_arrivals.columns), eclipses.ArrivalsColumns)
+            self.assertEqual(
+                possible_arrivals.values.tolist(),
+                expected_possible_arrivals.values.tolist()
+            )
+
+            # each vehicle passes each stop once, except V1 which stays near the S4 terminal between trips
+            self.assertEqual(list(possible_arrivals.groupby('SID').size().items()), [
+                (stop_id, 2 if stop_id == 'S4' else 3) for stop_id in ['S1', 'S2', 'S3', 'S4']
+            ])
+
+            if dir_info.id == '0':
+                terminal_arrival = possible_arrivals[(possible_arrivals['SID'] == 'S4') & (possible_arrivals['VID'] == 'V1')]
+                self.assertEqual(terminal_arrival['TIME'].tolist(), [1400])
+                self.assertEqual(terminal_arrival['DEPARTURE_TIME'].tolist(), [3080])
+                self.assertEqual(terminal_arrival['STOP_INDEX'].tolist(), [3])
+
+    def test_arrivals_with_ascending_stop_index(self):
+        stop_ids = [f'S{i}' for i in range(10)]
+
+        def make_dir_info(loop):
+            direction = {'id': '0', 'title': '0', 'gtfs_direction_id': '0', 'gtfs_shape_id': 'SH0', 'stop_geometry': {}, 'stops': stop_ids}
+            if loop:
+                direction['loop'] = True
+            route_config = routeconfig.RouteConfig('test', {
+                'id': 'A',
+                'title': 'A',
+                'url': '',
+                'type': 3,
+                'sort_order': 0,
+                'gtfs_route_id': 'A',
+                'directions': [direction],
+                'stops': {
+                    stop_id: {'id': stop_id, 'title': stop_id, 'lat': 37.7, 'lon': -122.4}
+                    for stop_id in stop_ids
+                },
+            })
+            return route_config.get_direction_info('0')
+
+        def get_arrivals(stop_indexes, loop=False, dist_values=None):
+            num_arrivals = len(stop_indexes)
+            time_values = 1000 + np.arange(num_arrivals) * 60
+            dir_arrivals = pd.DataFrame({
+                'VID': ['V1'] * num_arrivals,
+                'TIME': time_values,
+                'DEPARTURE_TIME': time_values + 10,
+                'DIST': dist_values if dist_values is not None else np.full(num_arrivals, 50.0),
+                'SID': [stop_ids[stop_index] for stop_index in stop_indexes],
+                'DID': ['0'] * num_arrivals,
+                'STOP_INDEX': stop_indexes,
+                'OBS_GROUP': [1] * num_arrivals,
+                'TRIP': [-1] * num_arrivals,
+            }, columns=eclipses.ArrivalsColumns)
+
+            arrivals, next_trip = eclipses.get_arrivals_with_ascending_stop_index(dir_arrivals, make_dir_info(loop), 5)
+            return arrivals['STOP_INDEX'].tolist(), arrivals['TRIP'].tolist(), arrivals['TIME'].tolist(), next_trip
+
+        # twisty route where the possible arrivals contain out-of-order stop indexes
+        self.assertEqual(get_arrivals([1,2,6,3,7,4,5,6,3,4,7,8,9]), (
+            [1, 2, 3, 4, 5, 6, 7, 8, 9],
+            [5] * 9,
+            [1000, 1060, 1180, 1300, 1360, 1420, 1600, 1660, 1720],
+            6
+        ))
+
+        # vehicle turns back before the terminal, then completes a trip.
+        # at stop index 3 it uses the second arrival, which is closer to the stop
+        self.assertEqual(get_arrivals(
+            [0,1,2,3,3,4,5,9,8,7,6,5,4,3,2,1,0,1,2,3,4,5,6,7,8,9],
+            dist_values=[50,50,50,80,20] + [50] * 21
+        ), (
+            [0, 1, 2, 3, 4, 5, 9, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
+            [5] * 7 + [6] * 10,
+            [1000, 1060, 1120, 1240, 1300, 1360, 1420, 1960, 2020, 2080, 2140, 2200, 2260, 2320, 2380, 2440, 2500],
+            7
+        ))
+
+        # loop routes can continue around the loop more than once
+        self.assertEqual(get_arrivals([7,8,9,0,1,2,3,4,5,6,7,8,9,0,1,2], loop=True), (
+            [7, 8, 9, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0, 1, 2],
+            [5] * 16,
+            list(range(1000, 1960, 60)),
+            6
+        ))
+
+        # vehicle reverses direction on a loop route
+        self.assertEqual(get_arrivals([2,3,4,3,2,1,0,9,8,7,6,5,4,5,6,7,8,9,0,1], loop=True), (
+            [2, 3, 4, 5, 6, 7, 8, 9, 0, 1],
+            [5] * 10,
+            [1000, 1060, 1120, 1660, 1840, 1900, 1960, 2020, 2080, 2140],
+            6
+        ))
+
+    def test_clean_arrivals(self):
+        stop_ids = [f'S{i}' for i in range(6)]
+        route_config = routeconfig.RouteConfig('test', {
+            'id': 'A',
+            'title': 'A',
+            'url': '',
+            'type': 3,
+            'sort_order': 0,
+            'gtfs_route_id': 'A',
+            'directions': [
+                {'id': '0', 'title': '0', 'gtfs_direction_id': '0', 'gtfs_shape_id': 'SH0', 'stop_geometry': {}, 'stops': stop_ids},
+            ],
+            'stops': {
+                stop_id: {'id': stop_id, 'title': stop_id, 'lat': 37.7 + i * 0.002, 'lon': -122.4}
+                for i, stop_id in enumerate(stop_ids)
+            },
+        })
+
+        rows = []
+        # V1 skips stop S3 on its first trip, then makes another trip in a separate observation group
+        for stop_index, time in zip([0, 1, 2, 4], [1030, 1090, 1150, 1210]):
+            rows.append(['V1', time, time + 10, 10.0, stop_ids[stop_index], '0', stop_index, 1, -1])
+        for stop_index, time in zip([0, 1, 2], [2000, 2060, 2120]):
+            rows.append(['V1', time, time + 10, 10.0, stop_ids[stop_index], '0', stop_index, 2, -1])
+        for stop_index, time in zip([0, 1, 2, 3], [1000, 1060, 1120, 1180]):
+            rows.append(['V2', time, time + 10, 10.0, stop_ids[stop_index], '0', stop_index, 1, -1])
+        # a single possible arrival can't be part of a trip
+        rows.append(['V3', 1500, 1500, 10.0, 'S5', '0', 5, 1, -1])
+
+        possible_arrivals = pd.DataFrame(rows[::-1], columns=eclipses.ArrivalsColumns)
+
+        # V1 was observed near S3 at the same time that V2 arrived at S3
+        buses = pd.DataFrame([
+                ['V2', '0', 37.7, -122.4, 1000, 1],
+                ['V1', '0', 37.706, -122.4, 1180, 1],
+                ['V3', '0', 37.71, -122.4, 1500, 1],
+            ],
+            columns=['VID','DID','LAT','LON','TIME','OBS_GROUP']
+        )
+
+        arrivals = eclipses.clean_arrivals(possible_arrivals, buses, route_config)
+
+        self.assertEqual(list(arrivals.columns), eclipses.ArrivalsColumns)
+        self.assertEqual(list(zip(arrivals['TIME'], arrivals['VID'], arrivals['SID'], arrivals['TRIP'])), [
+            (1000, 'V2', 'S0', 2),
+            (1030, 'V1', 'S0', 0),
+            (1060, 'V2', 'S1', 2),
+            (1090, 'V1', 'S1', 0),
+            (1120, 'V2', 'S2', 2),
+            (1150, 'V1', 'S2', 0),
+            (1180, 'V1', 'S3', 0),
+            (1180, 'V2', 'S3', 2),
+            (1210, 'V1', 'S4', 0),
+            (2000, 'V1', 'S0', 1),
+            (2060, 'V1', 'S1', 1),
+            (2120, 'V1', 'S2', 1),
+        ])
+        self.assertEqual(arrivals['TRIP'].dtype, np.int64)
+
+if __name__ == '__main__':
+    unittest.main()
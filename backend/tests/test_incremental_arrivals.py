@@ -0,0 +1,191 @@
+import backend_path
+import unittest
+import datetime
+import io
+import tempfile
+from contextlib import redirect_stdout
+from unittest import mock
+import numpy as np
+import pandas as pd
+from backend.models import config, eclipses, incremental_arrivals, routeconfig, util
+
+stop_ids = [f'S{i}' for i in range(8)]
+stop_lats = [37.7 + i * 0.004 for i in range(8)]
+
+def make_route_config():
+    return routeconfig.RouteConfig('test', {
+        'id': 'A',
+        'title': 'A',
+        'url': '',
+        'type': 3,
+        'sort_order': 0,
+        'gtfs_route_id': 'A',
+        'directions': [
+            {'id': '0', 'title': '0', 'gtfs_direction_id': '0', 'gtfs_shape_id': 'SH0', 'stop_geometry': {}, 'stops': stop_ids},
+            {'id': '1', 'title': '1', 'gtfs_direction_id': '1', 'gtfs_shape_id': 'SH1', 'stop_geometry': {}, 'stops': stop_ids[::-1]},
+        ],
+        'stops': {
+            stop_id: {'id': stop_id, 'title': stop_id, 'lat': lat, 'lon': -122.4}
+            for stop_id, lat in zip(stop_ids, stop_lats)
+        },
+    })
+
+def make_vehicle_gps_rows(vehicle_id, start_time, num_trips, trip_seconds=1200, layover_seconds=300):
+    # GPS observations every 30 seconds for a vehicle going back and forth between the terminals,
+    # waiting at each terminal between trips
+    rows = []
+    t = start_time
+    for trip in range(num_trips):
+        direction_id = str(trip % 2)
+        start_lat, end_lat = (stop_lats[0], stop_lats[-1]) if direction_id == '0' else (stop_lats[-1], stop_lats[0])
+        for s in range(0, trip_seconds + 1, 30):
+            rows.append([vehicle_id, start_lat + (end_lat - start_lat) * s / trip_seconds, -122.4, direction_id, t + s])
+        t += trip_seconds
+        for s in range(30, layover_seconds, 30):
+            rows.append([vehicle_id, end_lat, -122.4, direction_id, t + s])
+        t += layover_seconds
+    return rows
+
+class IncrementalArrivalsTest(unittest.TestCase):
+
+    def setUp(self):
+        # save incremental states in a temporary data directory
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+
+        get_data_dir = mock.patch.object(util, 'get_data_dir', return_value=data_dir.name)
+        get_data_dir.start()
+        self.addCleanup(get_data_dir.stop)
+
+    def make_state(self, start_time):
+        arrivals = eclipses.make_arrivals_frame([
+            ['V1', start_time + 100, start_time + 160, 3.5, 'S1', '1', 0, 1, 0],
+            ['V1', start_time + 190, start_time + 210, 4.25, 'S2', '1', 1, 1, 0],
+        ])
+
+        buses = pd.DataFrame([
+                ['V1', 37.7, -122.4, '1', start_time + 200],
+                ['V1', 37.70091234567, -122.4, '1', start_time + 260],
+            ],
+            columns=['VID', 'LAT', 'LON', 'DID', 'TIME']
+        )
+
+        return incremental_arrivals.RouteState(
+            start_time=start_time,
+            end_time=start_time + 300,
+            next_trip=1,
+            committed_until={'V1': {'1': start_time + 210}},
+            arrivals=arrivals,
+            buses=buses,
+        )
+
+    def test_save_state(self):
+        d = datetime.date(2019,12,28)
+        start_time = 1577530800
+
+        incremental_arrivals.remove_states('test', d)
+        self.assertIsNone(incremental_arrivals.get_state('test', 'A', d, start_time))
+
+        state = self.make_state(start_time)
+        incremental_arrivals.save_state('test', 'A', d, state)
+
+        loaded_state = incremental_arrivals.get_state('test', 'A', d, start_time)
+        self.assertEqual(loaded_state.start_time, start_time)
+        self.assertEqual(loaded_state.end_time, start_time + 300)
+        self.assertEqual(loaded_state.next_trip, 1)
+        self.assertEqual(loaded_state.committed_until, {'V1': {'1': start_time + 210}})
+        pd.testing.assert_frame_equal(loaded_state.arrivals, state.arrivals, check_dtype=False)
+        pd.testing.assert_frame_equal(loaded_state.buses, state.buses, check_dtype=False)
+
+        # saving a newer state replaces the data files from the previous state
+        state.end_time = start_time + 600
+        incremental_arrivals.save_state('test', 'A', d, state)
+        self.assertEqual(incremental_arrivals.get_state_data('test', 'A', d, start_time)['end_time'], start_time + 600)
+
+        # saving the state of a route doesn't remove the data files of another route with a longer ID
+        incremental_arrivals.save_state('test', 'A_OWL', d, state)
+        state.end_time = start_time + 900
+        incremental_arrivals.save_state('test', 'A', d, state)
+        self.assertEqual(incremental_arrivals.get_state('test', 'A_OWL', d, start_time).end_time, start_time + 600)
+
+        incremental_arrivals.remove_states('test', d)
+        self.assertIsNone(incremental_arrivals.get_state_data('test', 'A', d, start_time))
+
+    def test_update_arrivals(self):
+        agency = config.get_agency('test')
+        route_config = make_route_config()
+        d = datetime.date(2019,10,2)
+        start_time = 1570000000
+
+        # V3 makes a round trip, stops reporting GPS observations for longer than InactiveVehicleSeconds,
+        # then makes another round trip
+        idle_start_time = start_time + 4500
+        idle_end_time = idle_start_time + 4000
+        self.assertGreater(idle_end_time - idle_start_time, incremental_arrivals.InactiveVehicleSeconds)
+
+        gps = pd.DataFrame(
+            make_vehicle_gps_rows('V1', start_time, 8) +
+            make_vehicle_gps_rows('V2', start_time + 700, 7) +
+            make_vehicle_gps_rows('V3', start_time + 1500, 2) +
+            make_vehicle_gps_rows('V3', idle_end_time, 2),
+            columns=['VID', 'LAT', 'LON', 'DID', 'TIME']
+        ).sort_values('TIME', kind='mergesort')
+
+        last_gps_time = gps['TIME'].max()
+
+        with redirect_stdout(io.StringIO()):
+            expected_arrivals = eclipses.find_arrivals(agency, gps, route_config, d)
+
+        self.assertEqual(expected_arrivals['TRIP'].nunique(), 19)
+
+        def get_arrival_keys(arrivals):
+            return sorted(zip(arrivals['VID'], arrivals['DID'], arrivals['SID'], arrivals['TIME'], arrivals['DEPARTURE_TIME']))
+
+        def get_trips(arrivals):
+            # arrivals in each trip, ignoring the trip IDs
+            return sorted(sorted(zip(trip_arrivals['VID'], trip_arrivals['SID'], trip_arrivals['TIME'])) for trip, trip_arrivals in arrivals.groupby('TRIP'))
+
+        for window in [120, 900, 3600]:
+            state = incremental_arrivals.RouteState(start_time, start_time)
+            checked_idle_vehicle = False
+
+            end_time = start_time
+            while state.end_time <= last_gps_time + incremental_arrivals.InactiveVehicleSeconds:
+                end_time += window
+                new_buses = gps[(gps['TIME'].values >= state.end_time) & (gps['TIME'].values < end_time)]
+
+                with redirect_stdout(io.StringIO()):
+                    arrivals, state = incremental_arrivals.update_arrivals(agency, route_config, d, state, new_buses, end_time)
+
+                # arrivals already committed in a previous update are not returned again
+                self.assertFalse(arrivals.duplicated(['VID', 'DID', 'SID', 'TIME']).any())
+
+                # while V3 is idle, both of its trips are committed and only recent GPS observations are kept
+                if not checked_idle_vehicle and end_time > idle_start_time + incremental_arrivals.InactiveVehicleSeconds + window and end_time < idle_end_time:
+                    self.assertEqual(state.arrivals[state.arrivals['VID'] == 'V3']['TRIP'].nunique(), 2)
+                    self.assertEqual(set(state.committed_until['V3'].keys()), {'0', '1'})
+                    self.assertGreater(state.buses['TIME'].min(), start_time + window)
+                    checked_idle_vehicle = True
+
+            if window < 3600:
+                self.assertTrue(checked_idle_vehicle)
+
+            self.assertEqual(get_arrival_keys(arrivals), get_arrival_keys(expected_arrivals))
+            self.assertEqual(get_trips(arrivals), get_trips(expected_arrivals))
+
+            # after all vehicles are inactive, all trips are committed with unique trip IDs
+            self.assertEqual(get_arrival_keys(state.arrivals), get_arrival_keys(expected_arrivals))
+            self.assertEqual(state.next_trip, state.arrivals['TRIP'].max() + 1)
+
+    def test_get_committed_until_values(self):
+        arrivals = pd.DataFrame({
+            'VID': ['V1', 'V1', 'V2'],
+            'DID': ['1', '0', '1'],
+        })
+
+        values = incremental_arrivals.get_committed_until_values(arrivals, {'V1': {'1': 100}})
+        self.assertEqual(values[0], 100)
+        self.assertTrue(np.isneginf(values[1:]).all())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import backend_path
+import unittest
+import datetime
+import os
+import tempfile
+from unittest import mock
+import pandas as pd
+import pytz
+from backend.models import arrival_history, metrics, util
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        # save arrival histories in a temporary data directory
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+
+        get_data_dir = mock.patch.object(util, 'get_data_dir', return_value=data_dir.name)
+        get_data_dir.start()
+        self.addCleanup(get_data_dir.stop)
+
+    def save_history(self, d, start_time, departure_times):
+        arrivals_df = pd.DataFrame(
+            [['V1', t - 30, t, 3, 'S1', '1', i] for i, t in enumerate(departure_times)],
+            columns=['VID','TIME','DEPARTURE_TIME','DIST','SID','DID','TRIP']
+        )
+        arrival_history.save_for_date(arrival_history.from_data_frame('test', 'metrics', arrivals_df, start_time, start_time + 86400), d)
+
+    def test_metrics_recomputed_after_history_reload(self):
+        d = datetime.date(2019,12,27)
+        start_time = 1577444400
+
+        self.save_history(d, start_time, [start_time + 3600, start_time + 4200, start_time + 4800])
+
+        route_metrics = metrics.AgencyMetrics('test').get_route_metrics('metrics')
+        rng = metrics.Range([d], None, None, pytz.timezone('America/Los_Angeles'))
+
+        headways = route_metrics.get_headways('1', 'S1', rng)
+        self.assertEqual(list(headways), [10, 10])
+        self.assertIs(route_metrics.get_headways('1', 'S1', rng), headways)
+
+        # recomputing the arrival history for a past date modifies the cache file, so the headways are recomputed
+        self.save_history(d, start_time, [start_time + 3600, start_time + 4800])
+        cache_path = arrival_history.get_cache_path('test', 'metrics', d)
+        mtime_ns = os.stat(cache_path).st_mtime_ns + 1000000
+        os.utime(cache_path, ns=(mtime_ns, mtime_ns))
+
+        self.assertEqual(list(route_metrics.get_headways('1', 'S1', rng)), [20])
+
+if __name__ == '__main__':
+    unittest.main()
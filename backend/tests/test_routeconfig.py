@@ -0,0 +1,104 @@
+import backend_path
+import unittest
+import tempfile
+from unittest import mock
+import numpy as np
+from backend.models import routeconfig, util
+
+def make_route_data(route_id, title=None):
+    return {
+        'id': route_id,
+        'title': title if title is not None else route_id,
+        'url': '',
+        'type': 3,
+        'sort_order': 0,
+        'gtfs_route_id': route_id,
+        'directions': [
+            {'id': '0', 'title': 'Outbound', 'gtfs_direction_id': '0', 'gtfs_shape_id': 'SH0', 'stop_geometry': {}, 'stops': ['S1', 'S2', 'S3']},
+            {'id': '1', 'title': 'Inbound', 'gtfs_direction_id': '1', 'gtfs_shape_id': 'SH1', 'stop_geometry': {}, 'stops': ['S3', 'S4', 'S1', 'S4']},
+        ],
+        'stops': {
+            stop_id: {'id': stop_id, 'title': stop_id, 'lat': 37.7, 'lon': -122.4}
+            for stop_id in ['S1', 'S2', 'S3', 'S4', 'S5']
+        },
+    }
+
+class RouteConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        # save route lists in a temporary data directory
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+
+        get_data_dir = mock.patch.object(util, 'get_data_dir', return_value=data_dir.name)
+        get_data_dir.start()
+        self.addCleanup(get_data_dir.stop)
+
+    def test_directions_for_stop(self):
+        route_config = routeconfig.RouteConfig('test', make_route_data('A'))
+
+        self.assertEqual(route_config.get_directions_for_stop('S1'), ['0', '1'])
+        self.assertEqual(route_config.get_directions_for_stop('S2'), ['0'])
+        self.assertEqual(route_config.get_directions_for_stop('S4'), ['1', '1'])
+        self.assertEqual(route_config.get_directions_for_stop('S5'), [])
+
+    def test_stop_index(self):
+        route_config = routeconfig.RouteConfig('test', make_route_data('A'))
+
+        dir_info = route_config.get_direction_info('1')
+        self.assertIs(dir_info, route_config.get_direction_info('1'))
+        self.assertEqual(dir_info.get_stop_index('S3'), 0)
+        self.assertEqual(dir_info.get_stop_index('S4'), 1)
+        self.assertEqual(dir_info.get_stop_index('S2'), None)
+        self.assertEqual(route_config.get_direction_info('2'), None)
+
+    def test_stop_arrays(self):
+        route_data = make_route_data('A')
+        route_data['directions'][1]['loop'] = True
+        for index, stop_id in enumerate(['S1', 'S2', 'S3', 'S4', 'S5']):
+            route_data['stops'][stop_id]['lat'] = 37.7 + index * 0.001
+
+        route_config = routeconfig.RouteConfig('test', route_data)
+
+        stop_arrays = route_config.get_direction_info('0').get_stop_arrays()
+        self.assertIs(stop_arrays, route_config.get_direction_info('0').get_stop_arrays())
+        self.assertEqual(list(stop_arrays.is_terminal_values), [True, False, True])
+        self.assertEqual(list(stop_arrays.prev_index_values), [-1, 0, 1])
+        self.assertEqual(list(stop_arrays.next_index_values), [1, 2, -1])
+        self.assertTrue(np.isnan(stop_arrays.prev_distance_values[0]))
+        self.assertTrue(np.isnan(stop_arrays.next_distance_values[2]))
+
+        stop_distance = util.haver_distance(37.7, -122.4, 37.701, -122.4)
+        self.assertEqual(list(stop_arrays.get_radius_values(200)), [round(stop_distance)] * 3)
+        self.assertEqual(list(stop_arrays.get_radius_values(50)), [50] * 3)
+
+        # the first and last stops of a loop are adjacent
+        loop_stop_arrays = route_config.get_direction_info('1').get_stop_arrays()
+        self.assertEqual(list(loop_stop_arrays.prev_index_values), [3, 0, 1, 2])
+        self.assertEqual(list(loop_stop_arrays.next_index_values), [1, 2, 3, 0])
+        self.assertTrue(np.all(np.isfinite(loop_stop_arrays.prev_distance_values)))
+        self.assertTrue(np.all(np.isfinite(loop_stop_arrays.next_distance_values)))
+
+    def test_cached_route_list(self):
+        routeconfig.save_routes('test', [
+            routeconfig.RouteConfig('test', make_route_data('A')),
+            routeconfig.RouteConfig('test', make_route_data('B')),
+        ])
+
+        route_config = routeconfig.get_route_config('test', 'B')
+        self.assertEqual(route_config.id, 'B')
+        self.assertIs(route_config, routeconfig.get_route_config('test', 'B'))
+        self.assertEqual([route.id for route in routeconfig.get_route_list('test')], ['A', 'B'])
+        self.assertEqual(routeconfig.get_route_config('test', 'C'), None)
+
+        # saving the routes again replaces the cached route list
+        routeconfig.save_routes('test', [
+            routeconfig.RouteConfig('test', make_route_data('B', 'New B')),
+        ])
+
+        self.assertEqual(routeconfig.get_route_config('test', 'B').title, 'New B')
+        self.assertEqual(routeconfig.get_route_config('test', 'A'), None)
+        self.assertEqual([route.id for route in routeconfig.get_route_list('test')], ['B'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,25 @@
 import backend_path
 import unittest
 import json
+import tempfile
+from unittest import mock
 from graphene.test import Client
 import pandas as pd
 import datetime
-from backend.models import arrival_history, routeconfig
+from backend.models import arrival_history, routeconfig, util
 from backend.models.schema import metrics_api
 
 class SchemaTest(unittest.TestCase):
 
+    def setUp(self):
+        # save routes and arrival histories in a temporary data directory
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+
+        get_data_dir = mock.patch.object(util, 'get_data_dir', return_value=data_dir.name)
+        get_data_dir.start()
+        self.addCleanup(get_data_dir.stop)
+
     def test_route_metrics_query(self):
 
         routeconfig.save_routes('test', [], save_to_s3=False)
@@ -89,6 +89,48 @@ class TripTimesTest(unittest.TestCase):
         np.testing.assert_equal(trip_min[inverse_order], [5, 60, 50, 51.5, 100, np.nan, np.nan])
         np.testing.assert_equal(arrival_times[inverse_order], [ 6300, 12600, 15000, 21090, 36000, np.nan, np.nan])
 
+    def test_find_indexes_of_next_arrival_times(self):
+        rng = np.random.RandomState(0)
+
+        for i in range(200):
+            s1_len = rng.randint(0, 40)
+            s2_len = rng.randint(0, 40)
+            num_trips = rng.randint(1, 6)
+
+            s1_time_values = np.sort(rng.randint(0, 100, s1_len))
+            s2_time_values = np.sort(rng.randint(0, 100, s2_len))
+            if i % 2 == 0:
+                s1_time_values = s1_time_values.astype(float)
+                s2_time_values = s2_time_values.astype(float)
+
+            # trip IDs are repeated, as on loop routes, and some trip IDs only appear at one stop
+            s1_trip_values = rng.randint(0, num_trips, s1_len)
+            s2_trip_values = rng.randint(1, num_trips + 1, s2_len)
+
+            expected_s1_indexes = []
+            expected_s2_indexes = []
+            for s1_index in range(s1_len):
+                for s2_index in range(s2_len):
+                    if s2_time_values[s2_index] > s1_time_values[s1_index] and s2_trip_values[s2_index] == s1_trip_values[s1_index]:
+                        expected_s1_indexes.append(s1_index)
+                        expected_s2_indexes.append(s2_index)
+                        break
+
+            for find_indexes in [
+                trip_times.find_indexes_of_next_arrival_times,
+                trip_times.find_indexes_of_next_arrival_times_numpy,
+            ]:
+                s1_indexes, s2_indexes = find_indexes(s1_trip_values, s1_time_values, s2_trip_values, s2_time_values)
+                self.assertEqual(list(s1_indexes), expected_s1_indexes)
+                self.assertEqual(list(s2_indexes), expected_s2_indexes)
+
+            s1_indexes = np.zeros(s1_len, dtype=int)
+            s2_indexes = np.zeros(s1_len, dtype=int)
+            num_indexes = trip_times.find_indexes_of_next_arrival_times_loop(
+                s1_trip_values, s1_time_values, s2_trip_values, s2_time_values, s1_indexes, s2_indexes
+            )
+            self.assertEqual(list(s1_indexes[:num_indexes]), expected_s1_indexes)
+            self.assertEqual(list(s2_indexes[:num_indexes]), expected_s2_indexes)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,248 @@
+import backend_path
+import unittest
+import datetime
+import io
+import json
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+import pandas as pd
+from backend.models import trynapi, config
+
+class FakeTrynapiServer:
+    # local HTTP server that responds to tryn-api GraphQL state queries
+    # with one observation per vehicle per minute
+
+    def __init__(self, delay=0.05, max_minutes=None):
+        self.delay = delay
+        self.max_minutes = max_minutes
+        self.requests = []
+        self.num_active_requests = 0
+        self.max_active_requests = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)['query'][0]
+                body = json.dumps(server.get_response(query)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get_response(self, query):
+        start_time = int(re.search(r'startTime: (\d+)', query).group(1))
+        end_time = int(re.search(r'endTime: (\d+)', query).group(1))
+        route_ids = json.loads(re.search(r'routes: (\[.*?\])', query).group(1))
+
+        with self.lock:
+            self.requests.append((start_time, end_time))
+            self.num_active_requests += 1
+            self.max_active_requests = max(self.max_active_requests, self.num_active_requests)
+
+        time.sleep(self.delay)
+
+        with self.lock:
+            self.num_active_requests -= 1
+
+        if self.max_minutes is not None and end_time - start_time > self.max_minutes * 60:
+            return {'message': 'Internal server error'}
+
+        return {'data': {'state': {
+            'agencyId': 'test',
+            'startTime': start_time,
+            'routes': [{
+                'routeId': route_id,
+                'states': [{
+                    'timestamp': timestamp,
+                    'vehicles': [{
+                        'vid': f'{route_id}_1',
+                        'lat': 37.7,
+                        'lon': -122.4,
+                        'did': '0',
+                        'secsSinceReport': 5,
+                    }]
+                } for timestamp in range(start_time, end_time, 60)]
+            } for route_id in route_ids]
+        }}}
+
+class TrynapiTest(unittest.TestCase):
+
+    def get_state(self, server, start_time, end_time, route_ids, env):
+        d = datetime.date(2019, 12, 28)
+
+        with mock.patch.object(config, 'trynapi_url', server.url), mock.patch.dict(os.environ, env):
+            state = trynapi.get_state('test', d, start_time, end_time, route_ids)
+
+        for cache_path in state.cache_paths.values():
+            self.addCleanup(os.remove, cache_path)
+            self.addCleanup(os.remove, trynapi.get_categories_path(cache_path))
+
+        return state
+
+    def assert_state_complete(self, state, start_time, end_time, route_ids):
+        for route_id in route_ids:
+            buses = state.get_for_route(route_id)
+            self.assertEqual(list(buses['TIME'].values), list(range(start_time - 5, end_time - 5, 60)))
+            self.assertEqual(set(buses['VID'].values), {f'{route_id}_1'})
+
+    def test_get_state(self):
+        start_time = 1577530800
+        end_time = start_time + 3 * 3600
+        route_ids = ['A', 'B']
+
+        with FakeTrynapiServer() as server:
+            state = self.get_state(server, start_time, end_time, route_ids, {
+                'TRYNAPI_MAX_CHUNK': '60',
+                'TRYNAPI_CONCURRENCY': '3',
+            })
+
+        self.assertEqual(len(server.requests), 6)
+        self.assertGreater(server.max_active_requests, 1)
+        self.assertLessEqual(server.max_active_requests, 3)
+
+        self.assert_state_complete(state, start_time, end_time, route_ids)
+
+    def test_get_state_splits_chunks(self):
+        start_time = 1577534400
+        end_time = start_time + 2 * 3600
+        route_ids = ['A', 'B']
+
+        # server returns an error for any chunk longer than 10 minutes,
+        # so each 30 minute chunk is split into 15 minute chunks, which are split again
+        with FakeTrynapiServer(max_minutes=10) as server:
+            state = self.get_state(server, start_time, end_time, route_ids, {
+                'TRYNAPI_MAX_CHUNK': '60',
+                'TRYNAPI_CONCURRENCY': '2',
+            })
+
+        self.assertEqual(len([r for r in server.requests if r[1] - r[0] <= 600]), 16)
+
+        self.assert_state_complete(state, start_time, end_time, route_ids)
+
+    def test_get_state_error(self):
+        start_time = 1577538000
+        end_time = start_time + 3600
+        route_ids = ['A']
+
+        with FakeTrynapiServer(max_minutes=1) as server:
+            with self.assertRaises(Exception):
+                self.get_state(server, start_time, end_time, route_ids, {
+                    'TRYNAPI_MAX_CHUNK': '30',
+                })
+
+    def test_write_chunk_state(self):
+        Path(trynapi.get_state_cache_dir('test')).mkdir(parents=True, exist_ok=True)
+        trynapi.remove_route_temp_cache('test')
+
+        cache_path = trynapi.get_route_temp_cache_path('test', 'C')
+        categories_path = trynapi.get_categories_path(cache_path)
+        self.addCleanup(os.remove, cache_path)
+        self.addCleanup(os.remove, categories_path)
+
+        categories = trynapi.make_categories()
+
+        def make_chunk_state(states):
+            builder = trynapi.ChunkStateBuilder('C')
+            for state in states:
+                for vehicle in state['vehicles']:
+                    builder.add(state['timestamp'], vehicle)
+            return builder.get_chunk_state()
+
+        trynapi.write_chunk_state(make_chunk_state([
+            {'timestamp': 1000, 'vehicles': [
+                {'vid': 'V2', 'lat': 37.712345678901234, 'lon': -122.4, 'did': '1', 'secsSinceReport': 5},
+                {'vid': 'V1', 'lat': 37.8, 'lon': -122.5, 'did': None, 'secsSinceReport': None},
+            ]},
+            {'timestamp': 1015, 'vehicles': []},
+        ]), 'test', categories)
+
+        # the second chunk is appended to the same file, with codes for each VID and DID
+        # relative to the first chunk
+        trynapi.write_chunk_state(make_chunk_state([
+            {'timestamp': 1030, 'vehicles': [
+                {'vid': 'V1', 'lat': 37.81, 'lon': -122.51, 'did': '0', 'secsSinceReport': 40},
+            ]},
+        ]), 'test', categories)
+
+        self.assertEqual(os.path.getsize(cache_path), 3 * trynapi.StateRecordDtype.itemsize)
+
+        with open(categories_path, 'w') as f:
+            f.write(json.dumps({key: list(codes.keys()) for key, codes in categories.items()}))
+
+        state = trynapi.CachedState()
+        state.add('C', cache_path)
+        buses = state.get_for_route('C')
+
+        self.assertEqual(list(buses.columns), ['VID', 'LAT', 'LON', 'DID', 'TIME'])
+        self.assertEqual(list(buses['TIME'].values), [990, 995, 1000])
+        self.assertEqual(list(buses['VID'].values), ['V1', 'V2', 'V1'])
+        self.assertEqual(list(buses['DID'].values[:2]), ['0', '1'])
+        self.assertTrue(pd.isnull(buses['DID'].values[2]))
+        self.assertEqual(list(buses['LAT'].values), [37.81, 37.712345678901234, 37.8])
+        self.assertEqual(list(buses['LON'].values), [-122.51, -122.4, -122.5])
+
+    def test_parse_state_response(self):
+        response = trynapi.parse_state_response(io.BytesIO(json.dumps({'data': {'state': {
+            'agencyId': 'test',
+            'startTime': 1000,
+            'routes': [
+                {'routeId': 'A', 'states': [
+                    {'timestamp': 1000, 'vehicles': [
+                        {'vid': 'V1', 'lat': 37.712345678901234, 'lon': -122.4, 'did': '0', 'secsSinceReport': 5},
+                        {'vid': 'V2', 'lat': 37.8, 'lon': -122.5, 'did': None, 'secsSinceReport': None},
+                    ]},
+                    {'timestamp': 1015, 'vehicles': [
+                        {'vid': 'V1', 'lat': 37.71, 'lon': -122.41, 'did': '0', 'secsSinceReport': 0},
+                    ]},
+                ]},
+                {'routeId': 'B', 'states': []},
+            ],
+        }}}).encode('utf-8')))
+
+        self.assertEqual(response['data']['state']['agencyId'], 'test')
+
+        routes = response['data']['state']['routes']
+        self.assertEqual([route['routeId'] for route in routes], ['A', 'B'])
+
+        records = routes[0]['records']
+        self.assertEqual(routes[0]['categories'], {'VID': ['V1', 'V2'], 'DID': ['0']})
+        self.assertEqual(list(records['TIME']), [995, 1000, 1015])
+        self.assertEqual(list(records['LAT']), [37.712345678901234, 37.8, 37.71])
+        self.assertEqual(list(records['LON']), [-122.4, -122.5, -122.41])
+        self.assertEqual(list(records['VID']), [0, 1, 0])
+        self.assertEqual(list(records['DID']), [0, -1, 0])
+
+        self.assertEqual(len(routes[1]['records']), 0)
+
+        response = trynapi.parse_state_response(io.BytesIO(b'{"message": "Internal server error"}'))
+        self.assertEqual(response, {'message': 'Internal server error'})
+
+        response = trynapi.parse_state_response(io.BytesIO(b'{"errors": [{"message": "error"}], "data": {"state": null}}'))
+        self.assertEqual(response['errors'], [{'message': 'error'}])
+
+if __name__ == '__main__':
+    unittest.main()
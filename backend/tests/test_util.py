@@ -17,6 +17,23 @@ class UtilTest(unittest.TestCase):
 
         self.assertEqual(util.quantile_sorted(arr[:-1], 0.5), 5.5)
 
+    def test_quantile_sorted_columns(self):
+        arr = np.array([
+            [1.1, 3.0, np.nan],
+            [2.2, 4.0, np.nan],
+            [3.3, np.nan, np.nan],
+            [4.4, np.nan, np.nan],
+        ])
+        counts = np.array([4, 2, 0])
+
+        for quantile in [0, 0.1, 0.5, 0.9, 1]:
+            quantiles = util.quantile_sorted_columns(arr, counts, quantile)
+            self.assertEqual(quantiles[0], util.quantile_sorted(arr[:4, 0], quantile))
+            self.assertEqual(quantiles[1], util.quantile_sorted(arr[:2, 1], quantile))
+            self.assertTrue(np.isnan(quantiles[2]))
+
+        self.assertTrue(np.isnan(util.quantile_sorted_columns(np.zeros((0, 2)), np.array([0, 0]), 0.5)).all())
+
     def test_parse_date(self):
         self.assertEqual(util.parse_date('2019-12-27'), datetime.date(2019,12,27))
 
@@ -89,5 +106,17 @@ class UtilTest(unittest.TestCase):
             369.11
         )
 
+    def test_call_with_captured_output(self):
+        def add(a, b=0):
+            print(f'adding {a} and {b}')
+            return a + b
+
+        self.assertEqual(util.call_with_captured_output(add, 1, b=2), ('adding 1 and 2\n', 3))
+
+        # output printed before an exception is stored in the exception
+        with self.assertRaises(TypeError) as cm:
+            util.call_with_captured_output(add, 1, b='2')
+        self.assertEqual(cm.exception.output, 'adding 1 and 2\n')
+
 if __name__ == '__main__':
     unittest.main()
@@ -139,5 +139,70 @@ class WaitTimesTest(unittest.TestCase):
         self.assertAlmostEqual(histogram[2], 0.108, places=3)
         self.assertEqual(len(combined.get_sampled_waits()), 421)
 
+    def test_combined_cumulative_distribution(self):
+        rng = np.random.RandomState(0)
+
+        interval_stats_arr = [
+            wait_times.get_stats(np.sort(rng.randint(0, 86400, rng.randint(0, 100))), 25200, 68400)
+            for i in range(30)
+        ]
+        combined = wait_times.combine_stats(interval_stats_arr)
+
+        cdf_domain, cdf_range = combined.get_cumulative_distribution().T
+
+        # value of the combined CDF at each wait time is the average value of the CDFs for each interval
+        interval_cdfs = [stats.get_cumulative_distribution().T for stats in interval_stats_arr if not stats.is_empty]
+        for wait_time, cdf_value in zip(cdf_domain[::10], cdf_range[::10]):
+            expected_value = sum(
+                wait_times.evaluate_cdf(wait_time, interval_domain, interval_range)
+                for interval_domain, interval_range in interval_cdfs
+            ) / len(interval_cdfs)
+            self.assertEqual(cdf_value, expected_value)
+
+        self.assertEqual(cdf_range[0], 0)
+        self.assertEqual(cdf_range[-1], 1)
+
+        wait_time_values = [-1, 0, cdf_domain[5], (cdf_domain[5] + cdf_domain[6]) / 2, 15.5, 1000]
+        self.assertEqual(
+            list(wait_times.evaluate_cdf_values(wait_time_values, cdf_domain, cdf_range)),
+            [wait_times.evaluate_cdf(wait_time, cdf_domain, cdf_range) for wait_time in wait_time_values]
+        )
+
+        quantiles = [0, 0.1, 0.5, 0.9, 1]
+        self.assertEqual(list(combined.get_quantiles(quantiles)), [combined.get_quantile(quantile) for quantile in quantiles])
+
+        bins = [0, 5, 10, 20, 90]
+        histogram = combined.get_histogram(bins)
+        for i in range(len(bins) - 1):
+            self.assertEqual(histogram[i], combined.get_probability_less_than(bins[i + 1]) - combined.get_probability_less_than(bins[i]))
+
+    def test_get_quantile_for_intervals(self):
+        rng = np.random.RandomState(0)
+
+        # include duplicate times and repeated headways
+        time_values = np.sort(np.r_[rng.randint(0, 86400, 150), np.arange(3600, 7200, 300), 3600])
+
+        timestamp_intervals = [
+            (None, None),
+            (10800, 25200),
+            (25200, 36000),
+            (36000, 36060), # no arrivals within interval
+            (-1000, 100), # before first arrival
+            (86000, 90000), # after last arrival
+            (90000, 95000), # empty
+            (3600, 7200),
+        ]
+
+        for quantile in [0, 0.1, 0.5, 0.9, 1]:
+            quantile_values = wait_times.get_quantile_for_intervals(time_values, timestamp_intervals, quantile)
+
+            self.assertEqual(len(quantile_values), len(timestamp_intervals))
+
+            for (start_time, end_time), quantile_value in zip(timestamp_intervals, quantile_values):
+                self.assertEqual(quantile_value, wait_times.get_stats(time_values, start_time, end_time).get_quantile(quantile))
+
+        self.assertIsNone(wait_times.get_quantile_for_intervals(time_values, timestamp_intervals, 0.5)[6])
+        self.assertEqual(wait_times.get_quantile_for_intervals(np.array([], dtype=np.int64), timestamp_intervals, 0.5), [None] * 8)
+
 if __name__ == '__main__':
     unittest.main()
@@ -65,10 +65,7 @@ if __name__ == '__main__':
             stop_info = route_config.get_stop_info(stop_id)
             dir_info = route_config.get_direction_info(row.DID)
 
-            try:
-                stop_index = dir_info.get_stop_ids().index(stop_id)
-            except ValueError:
-                stop_index = None
+            stop_index = dir_info.get_stop_index(stop_id)
 
             dwell_time = util.render_dwell_time(row.DEPARTURE_TIME - row.TIME)
             dist_str = f'{row.DIST}'.rjust(3)